@@ -24,6 +24,8 @@ from gi.repository import GdkPixbuf
 from gi.repository import GLib
 
 import lib.document
+import lib.autosave
+import lib.command
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
@@ -235,9 +237,13 @@ class Application (object):
         app_canvas = self.builder.get_object("app_canvas")
 
         # Working document: model and controller
-        model = lib.document.Document(self.brush)
+        model = lib.document.Document(self.brush, journal=True)
         self.doc = document.Document(self, app_canvas, model)
         app_canvas.set_model(model)
+        cmdstack = model.command_stack
+        budget_mib = self.preferences["history.undo_memory_budget"]
+        cmdstack.memory_budget = int(budget_mib * 1024**2)
+        cmdstack.min_steps = self.preferences["history.min_undo_steps"]
 
         signal_callback_objs.append(self.doc)
         signal_callback_objs.append(self.doc.modes)
@@ -286,6 +292,19 @@ class Application (object):
         self.kbm.start_listening()
         self.filehandler.doc = self.doc
         self.filehandler.filename = None
+
+        # Background autosaving of the working document
+        self.autosaver = lib.autosave.Autosaver(
+            model,
+            join(self.user_datapath, "autosave"),
+            interval=self.preferences["saving.autosave_interval"],
+            idle_delay=self.preferences["saving.autosave_idle_delay"],
+        )
+        self.filehandler.current_file_observers.append(
+            self._current_file_changed_cb,
+        )
+        if self.preferences["saving.autosave"]:
+            self.autosaver.start()
         Gtk.AccelMap.load(join(self.user_confpath, 'accelmap.conf'))
 
         # Load the default background image if one exists
@@ -373,6 +392,8 @@ class Application (object):
                 self.filehandler.filename = fn
             else:
                 self.filehandler.open_file(fn)
+        else:
+            self.filehandler.offer_recovery()
 
         # Load last scratchpad
         sp_autosave_key = "scratchpad.last_opened_scratchpad"
@@ -394,6 +415,10 @@ class Application (object):
         if fullscreen:
             self.drawWindow.fullscreen_cb()
 
+    def _current_file_changed_cb(self, filename):
+        """Nothing needs autosaving just after a save, load, or New"""
+        self.autosaver.reset()
+
     def save_settings(self):
         """Saves the current settings to persistent storage."""
         self.brushmanager.save_brushes_for_devices()
@@ -458,6 +483,15 @@ class Application (object):
             'ui.toolbar_icon_size': 'large',
             'ui.dark_theme_variant': True,
             'saving.default_format': 'openraster',
+            'saving.png_compression': 'default',  # see lib.pixbufsurface
+            'saving.autosave': True,
+            'saving.autosave_interval': lib.autosave.DEFAULT_INTERVAL,
+            'saving.autosave_idle_delay': lib.autosave.DEFAULT_IDLE_DELAY,
+            # Undo history limits (see lib.command.CommandStack)
+            'history.undo_memory_budget': (
+                lib.command.DEFAULT_UNDO_MEMORY_BUDGET // 1024**2
+            ),  # MiB
+            'history.min_undo_steps': lib.command.DEFAULT_MIN_UNDO_STEPS,
             'brushmanager.selected_brush': None,
             'brushmanager.selected_groups': [],
             'frame.color_rgba': (0.12, 0.12, 0.12, 0.92),
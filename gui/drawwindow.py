@@ -656,6 +656,7 @@ class DrawWindow (Gtk.Window):
         if not self.app.filehandler.confirm_destructive_action(title=_('Quit'), question=_('Really Quit?')):
             return True
 
+        self.app.autosaver.close()
         self.app.doc.model.cleanup()
         Gtk.main_quit()
         return False
@@ -21,6 +21,9 @@ from gettext import ngettext
 
 from lib import document, helpers, tiledsurface
 from lib import fileutils
+from lib import workingfile
+from lib import journal
+from lib import thumbnailcache
 from lib.errors import FileHandlingError
 import drawwindow
 import gtk2compat
@@ -33,6 +36,11 @@ SAVE_FORMAT_PNGTRANS = 3
 SAVE_FORMAT_PNGMULTI = 4
 SAVE_FORMAT_JPEG = 5
 SAVE_FORMAT_PNGAUTO = 6
+SAVE_FORMAT_WORKING = 7
+SAVE_FORMAT_DZI = 8
+
+#: Number of recent files whose thumbnails are fetched in advance
+RECENT_THUMBNAILS_PREFETCH = 8
 
 
 # Utility function to work around the fact that gtk FileChooser/FileFilter
@@ -83,41 +91,51 @@ class FileHandler(object):
         self.file_opened_observers = []
         self.active_scrap_filename = None
         self.lastsavefailed = False
+        self.thumbnails = thumbnailcache.ThumbnailCache()
         self.set_recent_items()
 
         self.file_filters = [
             # (name, patterns)
-            (_("All Recognized Formats"), ("*.ora", "*.png", "*.jpg", "*.jpeg")),
+            (_("All Recognized Formats"), ("*.ora", "*.mypaint", "*.png",
+                                           "*.jpg", "*.jpeg")),
             (_("OpenRaster (*.ora)"), ("*.ora",)),
+            (_("MyPaint working file (*.mypaint)"), ("*.mypaint",)),
             (_("PNG (*.png)"), ("*.png",)),
             (_("JPEG (*.jpg; *.jpeg)"), ("*.jpg", "*.jpeg")),
         ]
         saveformat_keys = [
             SAVE_FORMAT_ANY,
             SAVE_FORMAT_ORA,
+            SAVE_FORMAT_WORKING,
             SAVE_FORMAT_PNGSOLID,
             SAVE_FORMAT_PNGTRANS,
             SAVE_FORMAT_PNGMULTI,
             SAVE_FORMAT_JPEG,
+            SAVE_FORMAT_DZI,
         ]
         saveformat_values = [
             # (name, extension, options)
             (_("By extension (prefer default format)"), None, {}),
             (_("OpenRaster (*.ora)"), '.ora', {}),
+            (_("MyPaint working file (*.mypaint)"), '.mypaint', {}),
             (_("PNG solid with background (*.png)"), '.png', {'alpha': False}),
             (_("PNG transparent (*.png)"), '.png', {'alpha': True}),
             (_("Multiple PNG transparent (*.XXX.png)"), '.png', {'multifile': True}),
             (_("JPEG 90% quality (*.jpg; *.jpeg)"), '.jpg', {'quality': 90}),
+            (_("Deep Zoom tile pyramid (*.dzi)"), '.dzi', {}),
         ]
         self.saveformats = OrderedDict(zip(saveformat_keys, saveformat_values))
         self.ext2saveformat = {
             ".ora": (SAVE_FORMAT_ORA, "image/openraster"),
+            ".mypaint": (SAVE_FORMAT_WORKING, workingfile.MIMETYPE),
             ".png": (SAVE_FORMAT_PNGAUTO, "image/png"),
             ".jpeg": (SAVE_FORMAT_JPEG, "image/jpeg"),
             ".jpg": (SAVE_FORMAT_JPEG, "image/jpeg"),
+            ".dzi": (SAVE_FORMAT_DZI, "application/xml"),
         }
         self.config2saveformat = {
             'openraster': SAVE_FORMAT_ORA,
+            'mypaint-working': SAVE_FORMAT_WORKING,
             'jpeg-90%': SAVE_FORMAT_JPEG,
             'png-solid': SAVE_FORMAT_PNGSOLID,
         }
@@ -134,6 +152,12 @@ class FileHandler(object):
             if "mypaint" in i.get_applications() and os.path.exists(fileutils.uri2filename(i.get_uri()))
         ]
         self.recent_items.reverse()
+        # The most recent files are the likeliest to be previewed soon
+        recent_filenames = [
+            fileutils.uri2filename(i.get_uri())
+            for i in self.recent_items[-RECENT_THUMBNAILS_PREFETCH:]
+        ]
+        self.thumbnails.prefetch(reversed(recent_filenames))
 
     def get_filename(self):
         return self._filename
@@ -262,6 +286,51 @@ class FileHandler(object):
         self.set_recent_items()
         self.app.doc.reset_view(True, True, True)
 
+    @drawwindow.with_wait_cursor
+    def offer_recovery(self):
+        """Offers to recover the work of a crashed session
+
+        Crashed sessions leave their recovery journals behind (see
+        `lib.journal`). If there are any, the user can choose to rebuild
+        the most recent one's document, or discard them all.
+        """
+        journals = journal.find_recoverable(self.doc.model.TEMPDIR_STUB_NAME)
+        if not journals:
+            return
+        d = gtk.Dialog(_("Recover Unsaved Work"), self.app.drawWindow,
+                       gtk.DIALOG_MODAL)
+        b = d.add_button(gtk.STOCK_DISCARD, gtk.RESPONSE_REJECT)
+        b.set_image(gtk.image_new_from_stock(gtk.STOCK_DELETE,
+                                             gtk.ICON_SIZE_BUTTON))
+        d.add_button(_("_Later"), gtk.RESPONSE_CANCEL)
+        d.add_button(_("_Recover"), gtk.RESPONSE_OK)
+        d.set_default_response(gtk.RESPONSE_OK)
+        l = gtk.Label()
+        l.set_markup("<b>%s</b>\n\n%s" % (
+            _("MyPaint did not exit cleanly last time."),
+            _("Unsaved work from that session can be recovered."),
+        ))
+        l.set_padding(10, 10)
+        l.show()
+        d.vbox.pack_start(l)
+        response = d.run()
+        d.destroy()
+        if response == gtk.RESPONSE_OK:
+            try:
+                self.doc.model.recover_from_journal(
+                    journals[0],
+                    feedback_cb=self.gtk_main_tick,
+                )
+            except FileHandlingError as e:
+                self.app.message_dialog(str(e), type=gtk.MESSAGE_ERROR)
+                return
+            self.filename = None
+            self.app.doc.reset_view(True, True, True)
+            journal.discard(journals[0])
+        elif response == gtk.RESPONSE_REJECT:
+            for dirname in journals:
+                journal.discard(dirname)
+
     @staticmethod
     def gtk_main_tick():
         if gtk2compat.USE_GTK3:
@@ -279,6 +348,7 @@ class FileHandler(object):
                 filename,
                 feedback_cb=self.gtk_main_tick,
                 convert_to_srgb=(display_colorspace_setting == "srgb"),
+                lazy=True,
             )
         except FileHandlingError as e:
             self.app.message_dialog(str(e), type=gtk.MESSAGE_ERROR)
@@ -353,7 +423,7 @@ class FileHandler(object):
         if not thumbnail_pixbuf:
             options["render_background"] = not options.get("alpha", False)
             thumbnail_pixbuf = self.doc.model.render_thumbnail(**options)
-        helpers.freedesktop_thumbnail(filename, thumbnail_pixbuf)
+        self.thumbnails.store(filename, thumbnail_pixbuf)
 
     @drawwindow.with_wait_cursor
     def save_scratchpad(self, filename, export=False, **options):
@@ -380,6 +450,7 @@ class FileHandler(object):
         prefs = self.app.preferences
         display_colorspace_setting = prefs["display.colorspace"]
         options['save_srgb_chunks'] = (display_colorspace_setting == "srgb")
+        options.setdefault('png_compression', prefs["saving.png_compression"])
         try:
             x, y, w, h = doc.model.get_bbox()
             if w == 0 and h == 0:
@@ -409,15 +480,24 @@ class FileHandler(object):
         filename = file_chooser.get_preview_filename()
         if filename:
             filename = filename.decode('utf-8')
-            pixbuf = helpers.freedesktop_thumbnail(filename)
-            if pixbuf:
-                # if pixbuf is smaller than 256px in width, copy it onto a transparent 256x256 pixbuf
-                pixbuf = helpers.pixbuf_thumbnail(pixbuf, 256, 256, True)
-                preview.set_from_pixbuf(pixbuf)
-                file_chooser.set_preview_widget_active(True)
-            else:
-                #TODO display "no preview available" image
-                pass
+            # Thumbnails not already in memory arrive later, by which
+            # time the user may have moved on to another file.
+            def thumbnail_cb(thumb_filename, pixbuf):
+                current = file_chooser.get_preview_filename()
+                if current is None or current.decode('utf-8') != filename:
+                    return
+                self._show_preview(file_chooser, preview, pixbuf)
+            self.thumbnails.request(filename, thumbnail_cb)
+
+    def _show_preview(self, file_chooser, preview, pixbuf):
+        if pixbuf:
+            # if pixbuf is smaller than 256px in width, copy it onto a transparent 256x256 pixbuf
+            pixbuf = helpers.pixbuf_thumbnail(pixbuf, 256, 256, True)
+            preview.set_from_pixbuf(pixbuf)
+            file_chooser.set_preview_widget_active(True)
+        else:
+            #TODO display "no preview available" image
+            pass
 
     def get_open_dialog(self, filename=None, start_in_folder=None, file_filters=[]):
         dialog = gtk.FileChooserDialog(_("Open..."), self.app.drawWindow,
@@ -706,7 +786,7 @@ class FileHandler(object):
 
     def list_prefixed_dir(self, prefix):
         filenames = []
-        for ext in ['png', 'ora', 'jpg', 'jpeg']:
+        for ext in ['png', 'ora', 'mypaint', 'jpg', 'jpeg']:
             filenames += glob(prefix + '[0-9]*.' + ext)
             filenames += glob(prefix + '[0-9]*.' + ext.upper())
             # For the special linked scratchpads
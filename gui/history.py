@@ -7,11 +7,13 @@
 # (at your option) any later version.
 
 
-"""Color and brush history view widgets"""
+"""Color, brush, and undo history view widgets"""
 
 
 ## Imports
 
+from gettext import gettext as _
+
 import gi
 from gi.repository import Gtk
 from gi.repository import GObject
@@ -177,6 +179,45 @@ class ColorHistoryView (Gtk.HBox, ColorAdjuster):
         """Event: a color history button was clicked"""
 
 
+class UndoMemoryView (Gtk.Label):
+    """Shows the length of the undo history, and the memory it uses"""
+
+    def __init__(self, app):
+        Gtk.Label.__init__(self)
+        self.set_border_width(widgets.SPACING)
+        self._stack = app.doc.model.command_stack
+        self._update_id = None
+        self._stack.stack_updated += self._stack_updated_cb
+        self._update()
+
+    def _stack_updated_cb(self, stack):
+        # Measuring looks again at the layers changed since the last
+        # update, so it's done at most once per burst of updates.
+        if self._update_id is None:
+            self._update_id = GObject.idle_add(self._update_idle_cb)
+
+    def _update_idle_cb(self):
+        self._update_id = None
+        self._update()
+        return False
+
+    def _update(self):
+        stack = self._stack
+        mib = 1024.0**2
+        #TRANSLATORS: Undo history status: number of steps, how many of
+        #TRANSLATORS: them were moved to disk, the memory used by the
+        #TRANSLATORS: rest, and the max memory allowed, in megabytes
+        template = _(u"Undo: {steps} steps ({spilled} on disk), "
+                     u"{used:.0f} of {budget:.0f} MiB")
+        text = template.format(
+            steps=len(stack.undo_stack),
+            spilled=stack.spilled_steps,
+            used=stack.get_memory_use() / mib,
+            budget=stack.memory_budget / mib,
+        )
+        self.set_text(text)
+
+
 class ColorPreview (Gtk.AspectFrame):
     """Updatable widget displaying a single color"""
 
@@ -214,7 +255,8 @@ class HistoryPanel (Gtk.VBox):
     tool_widget_icon_name = "document-open-recent"
     tool_widget_title = "Recent Brushes & Colors"
     tool_widget_description = ("The most recently used brush\n"
-                               "presets and painting colors")
+                               "presets and painting colors,\n"
+                               "and the undo history's memory use")
 
     def __init__(self):
         Gtk.VBox.__init__(self)
@@ -224,3 +266,5 @@ class HistoryPanel (Gtk.VBox):
         self.pack_start(color_hist_view, True, False, 0)
         brush_hist_view = BrushHistoryView(app)
         self.pack_start(brush_hist_view, True, False, 0)
+        undo_memory_view = UndoMemoryView(app)
+        self.pack_start(undo_memory_view, False, False, 0)
@@ -886,13 +886,22 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         hq_zoom = False
         if self.app and self.app.preferences['view.high_quality_zoom']:
             hq_zoom = True
+        filter_weight = 0.0
         if hq_zoom:
-            # can cause a very clear slowdown on some hardware
-            # (we probably could avoid this by doing rendering differently)
-            mipmap_level = max(0, int(floor(log(1.0/self.scale, 2))))
+            # Render from the finer of the two nearest mipmap levels, but
+            # prefiltered towards the coarser one by the fractional part
+            # of the ideal level. Cairo's cheap bilinear filter is then
+            # good enough for the remaining downscale by less than 2x.
+            # The filtered tiles are cached, so redraws and panning cost
+            # the same as without HQ zoom. Compositing new tiles costs
+            # up to 4x as much as at the ceil() level below, like plain
+            # HQ zoom did, plus a quarter for the coarser level.
+            level = max(0.0, log(1.0/self.scale, 2))
+            mipmap_level = int(floor(level))
+            if mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL:
+                filter_weight = level - mipmap_level
         else:
             mipmap_level = max(0, int(ceil(log(1/self.scale, 2))))
-        # OPTIMIZE: if we would render tile scanlines, we could probably use the better one above...
         mipmap_level = min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
         transformation.scale(2**mipmap_level, 2**mipmap_level)
 
@@ -919,9 +928,11 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         # https://bugs.freedesktop.org/show_bug.cgi?id=28670
         surface = pixbufsurface.Surface(x1, y1, x2-x1+1, y2-y1+1)
 
-        return transformation, surface, sparse, mipmap_level, clip_region
+        return (transformation, surface, sparse, mipmap_level, clip_region,
+                filter_weight)
 
-    def render_execute(self, cr, transformation, surface, sparse, mipmap_level, clip_region):
+    def render_execute(self, cr, transformation, surface, sparse,
+                       mipmap_level, clip_region, filter_weight=0.0):
         translation_only = self.is_translation_only()
         model_bbox = surface.x, surface.y, surface.w, surface.h
 
@@ -947,7 +958,8 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         self.doc._layers.render_into(
             surface, tiles, mipmap_level,
             overlay=self.overlay_layer,
-            opaque_base_tile=fake_alpha_check_tile
+            opaque_base_tile=fake_alpha_check_tile,
+            filter_weight=filter_weight,
         )
 
         gdk.cairo_set_source_pixbuf(
@@ -959,6 +971,10 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         if self.scale > self.pixelize_threshold:
             pattern = cr.get_source()
             pattern.set_filter(cairo.FILTER_NEAREST)
+        elif filter_weight > 0:
+            # Already prefiltered, see render_prepare()
+            pattern = cr.get_source()
+            pattern.set_filter(cairo.FILTER_BILINEAR)
 
         cr.paint()
 
@@ -0,0 +1,237 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Background autosaving from copy-on-write document snapshots
+
+Saving a big document takes seconds, which is far too long to hold up
+painting for. An autosave only needs a consistent copy of the document
+to work from, though, and the snapshots used for undo provide one
+cheaply. Surface snapshots share the live document's tiles, which are
+marked read-only, so any further painting copies a tile before changing
+it (see `lib.tiledsurface.MyPaintSurface.save_snapshot()`).
+
+An `Autosaver` takes a snapshot of its document on the main thread,
+then builds a detached copy of the document from it in a background
+thread, and saves that as a working file (see `lib.workingfile`).
+Autosaves happen once the user has stopped changing the document for a
+few seconds, or at regular intervals during long spells of work.
+
+The time the main thread spent taking the snapshot and the time taken
+by the save in the background are both logged, and passed to
+`Autosaver.autosave_finished()`.
+
+"""
+
+## Imports
+
+import os
+import time
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GObject
+
+import lib.workingfile
+from lib.observable import event
+
+
+## Module constants
+
+#: Default time between autosaves while the document keeps changing (s)
+DEFAULT_INTERVAL = 300
+
+#: Default time to wait after the last change before autosaving (s)
+DEFAULT_IDLE_DELAY = 10
+
+#: Name of the autosave file within the autosave directory
+AUTOSAVE_FILENAME = u"autosave" + lib.workingfile.FILE_EXTENSION
+
+# How often the triggers are checked (s)
+_POLL_INTERVAL = 1
+
+
+## Class defs
+
+class Autosaver (object):
+    """Saves a document in the background when it's been changed
+
+    The document is considered changed whenever its command stack is
+    updated, and busy whenever its canvas is being modified. Nothing is
+    autosaved while a lazy load is still decoding layers, because the
+    pending layers' tiles aren't in memory yet.
+
+    """
+
+    def __init__(self, doc, dirname, interval=DEFAULT_INTERVAL,
+                 idle_delay=DEFAULT_IDLE_DELAY):
+        """Initialize, ready to start
+
+        :param lib.document.Document doc: the document to autosave
+        :param unicode dirname: directory to save into
+        :param float interval: max time between autosaves, in seconds
+        :param float idle_delay: quiet time before autosaving, in seconds
+
+        Autosaving is off until `start()` is called.
+        """
+        super(Autosaver, self).__init__()
+        self._doc = doc
+        self.dirname = dirname
+        self.interval = interval
+        self.idle_delay = idle_delay
+        self._timeout_id = None
+        self._thread = None
+        self._result = None  # (filename, blocked, elapsed) or None
+        self._changed = False
+        now = time.time()
+        self._last_activity = now
+        self._last_autosave = now
+        doc.command_stack.stack_updated += self._stack_updated_cb
+        doc.canvas_area_modified += self._canvas_area_modified_cb
+
+    @property
+    def filename(self):
+        """The autosave file, which may not exist yet"""
+        return os.path.join(self.dirname, AUTOSAVE_FILENAME)
+
+    ## Starting and stopping
+
+    def start(self):
+        """Starts checking for changes to autosave"""
+        if self._timeout_id is not None:
+            return
+        self._timeout_id = GObject.timeout_add_seconds(
+            _POLL_INTERVAL,
+            self._poll_timer_cb,
+        )
+
+    def stop(self):
+        """Stops autosaving, letting any autosave underway finish"""
+        if self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def close(self):
+        """Stops autosaving, and waits for any autosave underway"""
+        self.stop()
+        self.wait()
+
+    def reset(self):
+        """Forgets any changes, e.g. after the document was saved"""
+        self._changed = False
+        self._last_autosave = time.time()
+
+    ## Change tracking
+
+    def _stack_updated_cb(self, stack):
+        self._changed = True
+        self._last_activity = time.time()
+
+    def _canvas_area_modified_cb(self, doc, x, y, w, h):
+        self._last_activity = time.time()
+
+    def _poll_timer_cb(self):
+        if not self._changed or self._thread is not None:
+            return True
+        now = time.time()
+        idle = (now - self._last_activity) >= self.idle_delay
+        overdue = (now - self._last_autosave) >= self.interval
+        if idle or overdue:
+            self.autosave()
+        return True
+
+    ## Autosaving
+
+    def autosave(self):
+        """Starts an autosave right now, unless one is underway
+
+        :returns: whether an autosave was started
+        :rtype: bool
+
+        The snapshot is taken before this returns, and the file is
+        written by a background thread. Use `wait()` to wait for it.
+        """
+        if self._thread is not None:
+            return False
+        doc = self._doc
+        if doc.layer_stack.lazy_load_pending:
+            return False
+        t0 = time.time()
+        sshot = doc.save_snapshot()
+        blocked = time.time() - t0
+        self._changed = False
+        self._last_autosave = t0
+        self._thread = threading.Thread(
+            target=self._save_snapshot,
+            args=(doc.__class__, sshot, blocked),
+            name="autosave",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _save_snapshot(self, doc_class, sshot, blocked):
+        """Internal: saves a snapshot (runs in the background thread)"""
+        t0 = time.time()
+        filename = self.filename
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            doc = doc_class.new_from_snapshot(sshot)
+            # Saves to a new name first, so the last good autosave
+            # survives a failure. That also avoids a backup copy.
+            new_filename = filename + u".new"
+            if os.path.exists(new_filename):
+                os.remove(new_filename)
+            doc.save_mypaint(new_filename)
+            try:
+                os.rename(new_filename, filename)
+            except OSError:
+                os.remove(filename)  # normal under Windows
+                os.rename(new_filename, filename)
+        except Exception:
+            logger.exception("Autosave to %r failed", filename)
+            self._result = None
+        else:
+            elapsed = time.time() - t0
+            logger.info(
+                "Autosaved to %r: main thread blocked for %.3fs, "
+                "saved in %.3fs in the background",
+                filename, blocked, elapsed,
+            )
+            self._result = (filename, blocked, elapsed)
+        GObject.idle_add(self._save_finished_idle_cb)
+
+    def _save_finished_idle_cb(self):
+        """Internal: reports the end of an autosave on the main thread"""
+        thread = self._thread
+        if thread is None:
+            return False  # already done by wait()
+        thread.join()
+        self._thread = None
+        result = self._result
+        self._result = None
+        if result is not None:
+            self.autosave_finished(*result)
+        return False
+
+    def wait(self):
+        """Waits for any autosave underway to finish"""
+        if self._thread is not None:
+            self._save_finished_idle_cb()
+
+    @event
+    def autosave_finished(self, filename, blocked, elapsed):
+        """Event: an autosave finished successfully
+
+        :param unicode filename: the file that was written
+        :param float blocked: time the main thread spent on it (s)
+        :param float elapsed: time the background save took (s)
+
+        This is always called from the main thread.
+        """
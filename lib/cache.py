@@ -42,6 +42,22 @@ class LRUCache (object):
         self._hits = 0
         self._misses = 0
 
+    def discard_matching(self, predicate):
+        """Removes the items whose keys match a predicate
+
+        :param callable predicate: called with each key
+
+        >>> cache = LRUCache()
+        >>> for i in xrange(5):
+        ...     cache[i] = str(i)
+        >>> cache.discard_matching(lambda k: k % 2)
+        >>> [i for i in xrange(5) if i in cache]
+        [0, 2, 4]
+
+        """
+        for key in [k for k in self._cache if predicate(k)]:
+            del self._cache[key]
+
     def __len__(self):
         return len(self._cache)
 
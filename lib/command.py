@@ -14,32 +14,94 @@ import helpers
 from observable import event
 import tiledsurface
 import lib.stroke
+import lib.workingfile
 from warnings import warn
 
 from copy import deepcopy
+import os
+import time
 import weakref
 from gettext import gettext as _
 from logging import getLogger
 logger = getLogger(__name__)
 
 
+## Module constants
+
+#: Default memory budget for the undo history, in bytes
+DEFAULT_UNDO_MEMORY_BUDGET = 1024 * 1024**2
+
+#: Default number of undo steps kept in memory whatever their size
+DEFAULT_MIN_UNDO_STEPS = 10
+
+#: Subdirectory of the document's tempdir for spilled undo steps
+UNDO_SPILL_SUBDIR = u"undo"
+
+
 ## Command stack and action interface
 
 
 class CommandStack (object):
-    """Undo/redo stack"""
+    """Undo/redo stack
+
+    The length of the undo history is limited by the memory it uses,
+    rather than by a fixed number of steps. Most of that memory is in
+    the tiles of the layer snapshots which commands keep, so the stack
+    keeps count of the unique tiles its commands refer to. Tiles shared
+    by several commands are counted once. Layers which are still part of
+    the document aren't searched, and tiles still in use by the document
+    itself aren't counted at all, since they'd be in memory anyway.
+
+    When the total goes over `memory_budget`, the tiles used only by the
+    oldest commands are spilled: written out to compressed files in the
+    document's tempdir, and replaced in the commands' snapshots by
+    stand-ins which read them back on demand (see
+    `lib.workingfile.spill_tiles()`). Commands are reloaded when they
+    are undone. The last `min_steps` steps are always kept in memory.
+    Documents without a tempdir can't spill, so for them the oldest
+    commands are dropped instead.
+
+    """
 
-    MAXLEN = 30   # FIXME: dynamic size (psutil)?
+    def __init__(self, doc=None, memory_budget=DEFAULT_UNDO_MEMORY_BUDGET,
+                 min_steps=DEFAULT_MIN_UNDO_STEPS, **kwargs):
+        """Initialize, empty
 
-    def __init__(self, **kwargs):
+        :param lib.document.Document doc: document the commands change
+        :param int memory_budget: Max undo memory use, in bytes
+        :param int min_steps: Number of undo steps always kept
+
+        Without a `doc`, tiles shared with the document can't be
+        discounted, so the memory use reported is an overestimate.
+        """
         super(CommandStack, self).__init__()
+        self._doc = None
+        if doc is not None:
+            self._doc = weakref.proxy(doc)
+        self.memory_budget = memory_budget
+        self.min_steps = min_steps
         self.undo_stack = []
         self.redo_stack = []
+        # Accounting for the tiles retained by commands on the stacks
+        self._command_tile_ids = {}  # {cmd: [id(tile), ...]}
+        self._tile_refs = {}  # {id(tile): [tile, refcount, nbytes]}
+        self._retained_bytes = 0
+        # The tiles used by the document's layers, per layer. Entries
+        # are forgotten when their layer's content changes.
+        self._live_layer_tile_ids = {}  # {id(layer): (ref, set(id(tile)))}
+        self._live_tile_counts = {}  # {id(tile): number of layers}
+        if doc is not None:
+            doc.layer_stack.layer_content_changed += \
+                self._layer_content_changed_cb
+        # Commands whose tiles were spilled to disk
+        self._spilled = set()
+        self._spill_count = 0
         self.stack_updated()
 
     def __repr__(self):
-        return ("<CommandStack undo_len=%d redo_len=%d>" %
-                (len(self.undo_stack), len(self.redo_stack),))
+        return ("<CommandStack undo_len=%d redo_len=%d retained=%dK>" %
+                (len(self.undo_stack), len(self.redo_stack),
+                 self._retained_bytes // 1024))
 
     def clear(self):
         self._discard_undo()
@@ -47,9 +109,13 @@ class CommandStack (object):
         self.stack_updated()
 
     def _discard_undo(self):
+        for cmd in self.undo_stack:
+            self._untrack_command(cmd)
         self.undo_stack = []
 
     def _discard_redo(self):
+        for cmd in self.redo_stack:
+            self._untrack_command(cmd)
         self.redo_stack = []
 
     def do(self, command):
@@ -64,6 +130,7 @@ class CommandStack (object):
         self._discard_redo()
         command.redo()
         self.undo_stack.append(command)
+        self._track_command(command)
         self.reduce_undo_history()
         self.stack_updated()
 
@@ -76,8 +143,12 @@ class CommandStack (object):
         if not self.undo_stack:
             return
         command = self.undo_stack.pop()
+        if command in self._spilled:
+            self._reload_command(command)
         command.undo()
         self.redo_stack.append(command)
+        self._retrack_command(command)
+        self.reduce_undo_history()
         self.stack_updated()
         return command
 
@@ -93,20 +164,276 @@ class CommandStack (object):
         command = self.redo_stack.pop()
         command.redo()
         self.undo_stack.append(command)
+        self._retrack_command(command)
         self.stack_updated()
         return command
 
     def reduce_undo_history(self):
-        """Trims the undo stack"""
-        stack = self.undo_stack
-        self.undo_stack = []
-        steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
-            if not item.automatic_undo:
-                steps += 1
-            if steps == self.MAXLEN:  # and memory > ...
+        """Trims the undo stack to fit the memory budget
+
+        The oldest commands are spilled to disk, or discarded if that
+        isn't possible, until the memory used by the history fits
+        `memory_budget`, or until only `min_steps` steps (not counting
+        automatic commands) are left in memory.
+        """
+        # The total retained is an upper bound: most of the time there's
+        # no need to find out how much of it is shared with the doc.
+        if self._retained_bytes <= self.memory_budget:
+            return
+        live_ids = self._get_live_tile_ids()
+        memory_use = self._get_memory_use(live_ids)
+        if memory_use <= self.memory_budget:
+            return
+        spill_dir = self._get_spill_dir()
+        if spill_dir is not None:
+            self._spill_old_commands(spill_dir, live_ids, memory_use)
+            return
+        steps = len([c for c in self.undo_stack if not c.automatic_undo])
+        dropped = 0
+        while (self.undo_stack and memory_use > self.memory_budget
+               and steps > self.min_steps):
+            cmd = self.undo_stack.pop(0)
+            if not cmd.automatic_undo:
+                steps -= 1
+            freed = self._untrack_command(cmd)
+            memory_use -= sum(n for (i, n) in freed if i not in live_ids)
+            dropped += 1
+        if dropped:
+            logger.debug("Dropped %d oldest undo steps: %dK now used",
+                         dropped, memory_use // 1024)
+
+    ## Memory accounting
+
+    def _track_command(self, cmd):
+        """Internal: starts counting the tiles a command refers to
+
+        Layers which are part of the document aren't searched, so only
+        the tiles in snapshots, deltas, and layers which only the
+        command still refers to are counted.
+        """
+        tile_ids = []
+        refs = self._tile_refs
+        for tile in _iter_retained_tiles(cmd, self._get_live_layer_ids()):
+            tile_id = id(tile)
+            ref = refs.get(tile_id)
+            if ref is None:
+                nbytes = tile.nbytes
+                refs[tile_id] = [tile, 1, nbytes]
+                self._retained_bytes += nbytes
+            else:
+                ref[1] += 1
+            tile_ids.append(tile_id)
+        self._command_tile_ids[cmd] = tile_ids
+
+    def _untrack_command(self, cmd):
+        """Internal: stops counting a command's tiles
+
+        :returns: (tile_id, nbytes) for each tile no longer counted
+        :rtype: list
+        """
+        self._spilled.discard(cmd)
+        freed = []
+        refs = self._tile_refs
+        for tile_id in self._command_tile_ids.pop(cmd, ()):
+            ref = refs[tile_id]
+            ref[1] -= 1
+            if ref[1] <= 0:
+                del refs[tile_id]
+                self._retained_bytes -= ref[2]
+                freed.append((tile_id, ref[2]))
+        return freed
+
+    def _retrack_command(self, cmd):
+        """Internal: recounts a command's tiles after undo or redo
+
+        Undoing or redoing may add layers the command refers to to the
+        document, or take them out of it.
+        """
+        if cmd in self._spilled:
+            return
+        self._untrack_command(cmd)
+        self._track_command(cmd)
+
+    def _get_live_layers(self):
+        """Internal: the document's layers, including its background"""
+        if self._doc is None:
+            return []
+        try:
+            root = self._doc.layer_stack
+        except ReferenceError:
+            return []
+        layers = [root, root.background_layer]
+        layers.extend(root.deepiter())
+        return layers
+
+    def _get_live_layer_ids(self):
+        """Internal: ids of the document's layers, for skipping them"""
+        return set(id(layer) for layer in self._get_live_layers())
+
+    def _layer_content_changed_cb(self, root, layer, *args):
+        """Internal: forgets the tiles of layers whose content changed"""
+        if layer is root:
+            self._forget_live_layer(id(root.background_layer))
+        self._forget_live_layer(id(layer))
+
+    def _forget_live_layer(self, layer_id):
+        """Internal: stops counting the tiles of a layer as in use"""
+        entry = self._live_layer_tile_ids.pop(layer_id, None)
+        if entry is None:
+            return
+        counts = self._live_tile_counts
+        for tile_id in entry[1]:
+            count = counts[tile_id] - 1
+            if count:
+                counts[tile_id] = count
+            else:
+                del counts[tile_id]
+
+    def _get_live_tile_ids(self):
+        """Internal: ids of the tiles the document is using itself
+
+        :returns: a dict whose keys are the ids of the tiles
+        :rtype: dict
+
+        The tiles of each layer are remembered until its content
+        changes, so only the layers changed since the last call, or
+        added to the document since then, are looked at again.
+        """
+        layers = dict((id(l), l) for l in self._get_live_layers())
+        entries = self._live_layer_tile_ids
+        for layer_id, (layer_ref, tile_ids) in entries.items():
+            if layer_ref() is not layers.get(layer_id):
+                self._forget_live_layer(layer_id)
+        counts = self._live_tile_counts
+        for layer_id, layer in layers.iteritems():
+            if layer_id in entries:
+                continue
+            tile_ids = _get_layer_tile_ids(layer)
+            for tile_id in tile_ids:
+                counts[tile_id] = counts.get(tile_id, 0) + 1
+            entries[layer_id] = (weakref.ref(layer), tile_ids)
+        return counts
+
+    def _get_memory_use(self, live_ids):
+        """Internal: bytes retained, minus those of the given tiles"""
+        refs = self._tile_refs
+        shared = sum(refs[i][2] for i in refs.viewkeys() & live_ids)
+        return self._retained_bytes - shared
+
+    def get_memory_use(self):
+        """Estimates the memory used by the undo and redo history
+
+        :returns: bytes of tile data kept alive only by the history
+        :rtype: int
+
+        This is cheap enough to call after every change: only the tiles
+        of layers changed since the last call are looked at again.
+        """
+        return self._get_memory_use(self._get_live_tile_ids())
+
+    ## Spilling old commands to disk
+
+    @property
+    def spilled_steps(self):
+        """Number of commands whose data is on disk"""
+        return len(self._spilled)
+
+    def _get_spill_dir(self):
+        """Internal: directory for spill files, or None if there's none"""
+        if self._doc is None:
+            return None
+        try:
+            tempdir = self._doc.tempdir
+        except ReferenceError:
+            return None
+        if tempdir is None:
+            return None
+        spill_dir = os.path.join(tempdir, UNDO_SPILL_SUBDIR)
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        return spill_dir
+
+    def _spill_old_commands(self, spill_dir, live_ids, memory_use):
+        """Internal: spills the oldest commands' tiles until under budget
+
+        Only tiles used by nothing but the commands being spilled are
+        written out. Tiles shared with the document, or with any newer
+        command kept in memory, stay where they are.
+        """
+        t0 = time.time()
+        # Oldest first, stopping short of the newest min_steps steps
+        steps = len([c for c in self.undo_stack if not c.automatic_undo])
+        batch = []
+        batch_refs = {}  # {id(tile): refs from commands in batch}
+        saved = 0
+        refs = self._tile_refs
+        for cmd in self.undo_stack:
+            if memory_use - saved <= self.memory_budget:
+                break
+            if steps <= self.min_steps:
                 break
+            if not cmd.automatic_undo:
+                steps -= 1
+            if cmd in self._spilled:
+                continue
+            batch.append(cmd)
+            for tile_id in self._command_tile_ids.get(cmd, ()):
+                count = batch_refs.get(tile_id, 0) + 1
+                batch_refs[tile_id] = count
+                ref = refs[tile_id]
+                if count == ref[1] and tile_id not in live_ids:
+                    saved += ref[2]
+        if not batch:
+            return
+        tiles = [
+            refs[i][0] for (i, count) in batch_refs.iteritems()
+            if count == refs[i][1] and refs[i][2] > 0 and i not in live_ids
+        ]
+        if tiles:
+            self._spill_count += 1
+            filename = os.path.join(
+                spill_dir,
+                u"spill%06d%s" % (self._spill_count,
+                                  lib.workingfile.TILES_SUFFIX),
+            )
+            stubs = lib.workingfile.spill_tiles(tiles, filename)
+            replacements = dict(
+                (id(tile), stub) for (tile, stub) in zip(tiles, stubs)
+            )
+            live_layer_ids = self._get_live_layer_ids()
+            for cmd in batch:
+                for tiledict in _iter_tiledicts(cmd, live_layer_ids):
+                    for pos, tile in tiledict.items():
+                        stub = replacements.get(id(tile))
+                        if stub is not None:
+                            tiledict[pos] = stub
+        for cmd in batch:
+            self._untrack_command(cmd)
+            self._track_command(cmd)
+            self._spilled.add(cmd)
+        logger.info(
+            "Spilled %d undo steps to disk in %.3fs, freeing %dK",
+            len(batch), time.time() - t0, saved // 1024,
+        )
+
+    def _reload_command(self, cmd):
+        """Internal: reads a spilled command's tiles back into memory"""
+        t0 = time.time()
+        nbytes = 0
+        refs = self._tile_refs
+        for tile in _iter_retained_tiles(cmd, self._get_live_layer_ids()):
+            if not isinstance(tile, lib.workingfile.MappedTile):
+                continue
+            tile_bytes = tile.rgba.nbytes  # decompresses it
+            nbytes += tile_bytes
+            # The tile may be shared with other spilled commands
+            ref = refs.get(id(tile))
+            if ref is not None:
+                self._retained_bytes += tile_bytes - ref[2]
+                ref[2] = tile_bytes
+        self._spilled.discard(cmd)
+        logger.info("Reloaded a spilled undo step (%dK) in %.3fs",
+                    nbytes // 1024, time.time() - t0)
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -120,6 +447,10 @@ class CommandStack (object):
         if cmd is None:
             return None
         cmd.update(**kwargs)
+        # Updates may replace the command's snapshots
+        self._untrack_command(cmd)
+        self._track_command(cmd)
+        self.reduce_undo_history()
         self.stack_updated()  # the display_name may have changed
         return cmd
 
@@ -129,6 +460,65 @@ class CommandStack (object):
         pass
 
 
+def _iter_tiledicts(obj, skipped=()):
+    """Internal: yields the tile dicts of surfaces and their snapshots
+
+    :param obj: a Command, layer, layer snapshot, or container of them
+    :param skipped: ids of objects not to search, e.g. live layers
+
+    Only containers, commands, layers, surfaces, and snapshots of layers
+    and surfaces are searched. That's enough to find the pixel data
+    retained by commands, without wandering off into the rest of the
+    program.
+    """
+    seen = set(skipped)
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if isinstance(obj, weakref.ProxyTypes) or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, _TILEDICT_HOLDERS):
+            yield obj.tiledict
+        elif isinstance(obj, dict):
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif isinstance(obj, _SEARCHED_OBJECTS):
+            pending.extend(vars(obj).itervalues())
+
+
+def _iter_retained_tiles(obj, skipped=()):
+    """Internal: yields the tiles kept alive by a command or layer
+
+    :param obj: a Command, layer, layer snapshot, or container of them
+    :param skipped: ids of objects not to search, e.g. live layers
+
+    Each tile found by `_iter_tiledicts()` is yielded once.
+    """
+    seen = set()
+    for tiledict in _iter_tiledicts(obj, skipped):
+        for tile in tiledict.itervalues():
+            if id(tile) in seen or tile in _MARKER_TILES:
+                continue
+            seen.add(id(tile))
+            yield tile
+
+
+def _get_layer_tile_ids(layer):
+    """Internal: ids of the tiles of a layer's own surface
+
+    Layers whose tiles haven't been loaded yet aren't loaded just for
+    this: they notify when they are.
+    """
+    surface = getattr(layer, "_surface", None)
+    if not isinstance(surface, tiledsurface.MyPaintSurface):
+        return set()
+    elif surface.load_is_pending:
+        return set()
+    return set(id(tile) for tile in surface.tiledict.itervalues())
+
+
 class Command (object):
     """A reversible change to the document model
 
@@ -208,6 +598,33 @@ class Command (object):
         """
         raise NotImplementedError
 
+    ## Crash recovery journal (see lib.journal)
+
+    def get_journal_params(self):
+        """Parameters for replaying the command from a recovery journal
+
+        :returns: keyword args for `new_from_journal()`, or None
+        :rtype: dict
+
+        This is called after the command has been done. Commands which
+        can't be described by a few small parameters made of plain data
+        (numbers, strings, and tuples, lists and dicts of them) return
+        None, and the journal writes a full checkpoint instead.
+        """
+        return None
+
+    @classmethod
+    def new_from_journal(cls, doc, params):
+        """Recreates a command from `get_journal_params()` output
+
+        :param lib.document.Document doc: the model to be changed
+        :param dict params: parameters recorded in the journal
+        :returns: a new command, ready for `lib.document.Document.do()`
+
+        The document's current layer is restored before this is called.
+        """
+        return cls(doc, **params)
+
     ## Deprecated utility functions for subclasses
 
     def _notify_canvas_observers(self, layer_bboxes):
@@ -224,6 +641,13 @@ class Command (object):
         self.doc.canvas_area_modified(*redraw_bbox)
 
 
+# Types searched by _iter_retained_tiles()
+_TILEDICT_HOLDERS = (tiledsurface.MyPaintSurface, tiledsurface.SurfaceSnapshot)
+_SEARCHED_OBJECTS = (Command, lib.layer.LayerBase, lib.layer.LayerBaseSnapshot,
+                     lib.layer.PaintingLayerDelta)
+_MARKER_TILES = (tiledsurface.transparent_tile, tiledsurface.mipmap_dirty_tile)
+
+
 class Brushwork (Command):
     """Some seconds of painting on the current layer"""
 
@@ -251,16 +675,15 @@ class Brushwork (Command):
         self._stroke_seq = None
         # When recorded, undo & redo switch the model between these states
         self._time_before = None
-        self._sshot_before = None
         self._time_after = None
-        self._sshot_after = None
+        self._delta = None  # just the tiles changed, before and after
         # For display
         self.description = description
         # State vars
         self._recording_started = False
         self._recording_finished = False
         self.split_due = False
-        self._sshot_after_applied = False
+        self._delta_applied = False
 
     @property
     def display_name(self):
@@ -286,12 +709,11 @@ class Brushwork (Command):
         model = self.doc
         layer = model.layer_stack.deepget(self._layer_path)
         assert self._recording_finished, "Call stop_recording() first"
-        assert self._sshot_before is not None
-        assert self._sshot_after is not None
+        assert self._delta is not None
         assert self._time_before is not None
-        if not self._sshot_after_applied:
-            layer.load_snapshot(self._sshot_after)
-            self._sshot_after_applied = True
+        if not self._delta_applied:
+            self._delta.restore_after(layer)
+            self._delta_applied = True
         # Update painting time
         assert self._time_after is not None
         model.unsaved_painting_time = self._time_after
@@ -301,23 +723,59 @@ class Brushwork (Command):
         model = self.doc
         layer = model.layer_stack.deepget(self._layer_path)
         assert self._recording_finished, "Call stop_recording() first"
-        layer.load_snapshot(self._sshot_before)
+        self._delta.restore_before(layer)
         model.unsaved_painting_time = self._time_before
-        self._sshot_after_applied = False
+        self._delta_applied = False
 
     def update(self, brushinfo):
         """Retrace the last stroke with a new brush"""
         model = self.doc
         layer = model.layer_stack.deepget(self._layer_path)
         assert self._recording_finished, "Call stop_recording() first"
-        assert self._sshot_after_applied, \
+        assert self._delta_applied, \
             "command.Brushwork must be applied before being updated"
-        layer.load_snapshot(self._sshot_before)
+        self._delta.restore_before(layer)
         stroke = self._stroke_seq.copy_using_different_brush(brushinfo)
+        layer.start_recording_delta()
         layer.render_stroke(stroke)
         self._stroke_seq = stroke
-        layer.add_stroke_shape(stroke, self._sshot_before)
-        self._sshot_after = layer.save_snapshot()
+        self._delta = layer.stop_recording_delta(stroke)
+
+    def get_journal_params(self):
+        """Recorded stroke data, for replaying the brushwork"""
+        stroke = self._stroke_seq
+        return dict(
+            layer_path=tuple(self._layer_path),
+            description=self.description,
+            abrupt_start=self._abrupt_start,
+            brush_settings=stroke.brush_settings,
+            brush_name=stroke.brush_name,
+            brush_state=stroke.brush_state,
+            stroke_data=stroke.stroke_data,
+            total_painting_time=stroke.total_painting_time,
+        )
+
+    @classmethod
+    def new_from_journal(cls, doc, params):
+        """Repaints recorded brushwork, as a command ready to be done"""
+        params = dict(params)
+        stroke = lib.stroke.Stroke()
+        for name in ("brush_settings", "brush_name", "brush_state",
+                     "stroke_data", "total_painting_time"):
+            setattr(stroke, name, params.pop(name))
+        stroke.finished = True
+        cmd = cls(doc, **params)
+        layer = doc.layer_stack.deepget(cmd._layer_path)
+        cmd._time_before = doc.unsaved_painting_time
+        layer.start_recording_delta()
+        layer.render_stroke(stroke, abrupt_start=cmd._abrupt_start)
+        cmd._stroke_seq = stroke
+        cmd._time_after = cmd._time_before + stroke.total_painting_time
+        cmd._delta = layer.stop_recording_delta(stroke)
+        cmd._delta_applied = True
+        cmd._recording_started = True
+        cmd._recording_finished = True
+        return cmd
 
     def _check_recording_started(self):
         """Ensure command is in the recording phase"""
@@ -338,14 +796,13 @@ class Brushwork (Command):
             return
         self._stroke_target_layer = layer
 
-        assert self._sshot_before is None
+        assert self._delta is None
         assert self._time_before is None
         assert self._stroke_seq is None
-        self._sshot_before = layer.save_snapshot()
+        layer.start_recording_delta()
         self._time_before = model.unsaved_painting_time
         self._stroke_seq = lib.stroke.Stroke()
         self._stroke_seq.start_recording(model.brush)
-        assert self._sshot_after is None
         self._recording_started = True
 
     def stroke_to(self, dtime, x, y, pressure, xtilt, ytilt):
@@ -420,18 +877,16 @@ class Brushwork (Command):
         if layer is None:
             return False  # wasn't suitable for painting, thus nothing changed
         if revert:
-            assert self._sshot_before is not None
             logger.debug(
                 "Brushwork: stop_recording: rollback %0.3fs",
                 self._stroke_seq.total_painting_time,
             )
-            layer.load_snapshot(self._sshot_before)
+            layer.stop_recording_delta(self._stroke_seq, revert=True)
             return False  # nothing changed
         t0 = self._time_before
         self._time_after = t0 + self._stroke_seq.total_painting_time
-        layer.add_stroke_shape(self._stroke_seq, self._sshot_before)
-        self._sshot_after = layer.save_snapshot()
-        self._sshot_after_applied = True  # changes happened before redo()
+        self._delta = layer.stop_recording_delta(self._stroke_seq)
+        self._delta_applied = True  # changes happened before redo()
         tiles_changed = (not self._stroke_seq.empty)
         logger.debug(
             "Brushwork: stop_recording: %0.3fs, tiles_changed=%r",
@@ -506,6 +961,22 @@ class FloodFill (Command):
             layers.current.load_snapshot(self.snapshot)
             self.snapshot = None
 
+    def get_journal_params(self):
+        return dict(
+            x=self.x, y=self.y,
+            color=tuple(self.color),
+            bbox=tuple(self.bbox),
+            tolerance=self.tolerance,
+            sample_merged=self.sample_merged,
+            make_new_layer=self.make_new_layer,
+        )
+
+    @classmethod
+    def new_from_journal(cls, doc, params):
+        params = dict(params)
+        params["bbox"] = helpers.Rect(*params["bbox"])
+        return cls(doc, **params)
+
 
 class TrimLayer (Command):
     """Trim the current layer to the extent of the document frame"""
@@ -526,6 +997,9 @@ class TrimLayer (Command):
         layer = self.doc.layer_stack.current
         layer.load_snapshot(self.before)
 
+    def get_journal_params(self):
+        return {}
+
 
 class ClearLayer (Command):
     """Clears the current layer"""
@@ -546,6 +1020,9 @@ class ClearLayer (Command):
         layer.load_snapshot(self._before)
         self._before = None
 
+    def get_journal_params(self):
+        return {}
+
 
 class LoadLayer (Command):
     """Loads a layer from a surface"""
@@ -611,6 +1088,9 @@ class MergeVisibleLayers (Command):
         rootstack.deeppop(self._merged_layer_path)
         rootstack.current_path = self._old_current_path
 
+    def get_journal_params(self):
+        return {}
+
 
 class MergeLayerDown (Command):
     """Merge the current layer and the one below it into a new layer"""
@@ -655,6 +1135,9 @@ class MergeLayerDown (Command):
         self._lower_layer = None
         rootstack.current_path = self._upper_path
 
+    def get_journal_params(self):
+        return {}
+
 
 class NormalizeLayerMode (Command):
     """Normalize a layer's mode & opacity, incorporating its backdrop
@@ -692,6 +1175,9 @@ class NormalizeLayerMode (Command):
         self._old_layer = None
         layers.current_path = self._old_current_path
 
+    def get_journal_params(self):
+        return dict(path=self._path)
+
 
 class AddLayer (Command):
     """Creates and inserts a new painting layer into the layer stack"""
@@ -726,6 +1212,26 @@ class AddLayer (Command):
         layers.set_current_path(self._prev_currentlayer_path)
         self._prev_currentlayer_path = None
 
+    def get_journal_params(self):
+        params = dict(self._layer_kwds)
+        params.update(
+            insert_path=tuple(self._insert_path),
+            name=self._layer.name,
+            layer_class=self._layer_class.__name__,
+        )
+        return params
+
+    @classmethod
+    def new_from_journal(cls, doc, params):
+        params = dict(params)
+        layer_class = getattr(lib.layer, params["layer_class"], None)
+        if not (isinstance(layer_class, type)
+                and issubclass(layer_class, lib.layer.LayerBase)):
+            raise ValueError("Unknown layer class %r"
+                             % (params["layer_class"],))
+        params["layer_class"] = layer_class
+        return cls(doc, **params)
+
 
 class RemoveLayer (Command):
     """Removes the current layer"""
@@ -773,6 +1279,9 @@ class RemoveLayer (Command):
         layers.set_current_path(self._unwanted_path)
         self._removed_layer = None
 
+    def get_journal_params(self):
+        return {}
+
 
 class SelectLayer (Command):
     """Select a layer"""
@@ -794,6 +1303,9 @@ class SelectLayer (Command):
         layers = self.doc.layer_stack
         layers.set_current_path(self.prev_path)
 
+    def get_journal_params(self):
+        return dict(path=self.path)
+
 
 class MoveLayer (Command):
     """Moves a layer around the canvas
@@ -902,6 +1414,24 @@ class MoveLayer (Command):
         redraw_bboxes = layer.translate(-dx, -dy)
         self._notify_canvas_observers(redraw_bboxes)
 
+    def get_journal_params(self):
+        return dict(
+            layer_path=tuple(self._layer_path),
+            x0=self._x0, y0=self._y0,
+            x=self._x, y=self._y,
+        )
+
+    @classmethod
+    def new_from_journal(cls, doc, params):
+        params = dict(params)
+        x = params.pop("x")
+        y = params.pop("y")
+        cmd = cls(doc, **params)
+        cmd.move_to(x, y)
+        while cmd.process_move():
+            pass
+        return cmd
+
 
 class DuplicateLayer (Command):
     """Make an exact copy of the current layer"""
@@ -925,6 +1455,9 @@ class DuplicateLayer (Command):
         orig_layer = layers.deepget(self._path)
         self._notify_canvas_observers([orig_layer.get_full_redraw_bbox()])
 
+    def get_journal_params(self):
+        return {}
+
 
 class BubbleLayerUp (Command):
     """Move the current layer up through the stack"""
@@ -939,6 +1472,9 @@ class BubbleLayerUp (Command):
         layers = self.doc.layer_stack
         layers.bubble_layer_down(layers.current_path)
 
+    def get_journal_params(self):
+        return {}
+
 
 class BubbleLayerDown (Command):
     """Move the current layer down through the stack"""
@@ -953,6 +1489,9 @@ class BubbleLayerDown (Command):
         layers = self.doc.layer_stack
         layers.bubble_layer_up(layers.current_path)
 
+    def get_journal_params(self):
+        return {}
+
 
 class RestackLayer (Command):
     """Move a layer from one position in the stack to another
@@ -1087,6 +1626,9 @@ class RestackLayer (Command):
         redraw_bboxes = [a.get_full_redraw_bbox() for a in affected]
         self._notify_canvas_observers(redraw_bboxes)
 
+    def get_journal_params(self):
+        return dict(src_path=self._src_path, targ_path=self._targ_path)
+
 
 class RenameLayer (Command):
     """Renames the current layer"""
@@ -1111,6 +1653,9 @@ class RenameLayer (Command):
     def undo(self):
         self.layer.name = self.old_name
 
+    def get_journal_params(self):
+        return dict(name=self.new_name)
+
 
 class SetLayerVisibility (Command):
     """Sets the visibility status of a layer"""
@@ -1139,6 +1684,9 @@ class SetLayerVisibility (Command):
         self.layer.visible = visible
         self._new_visibility = visible
 
+    def get_journal_params(self):
+        return dict(visible=self._new_visibility, path=self._path)
+
     @property
     def display_name(self):
         if self._new_visibility:
@@ -1179,6 +1727,9 @@ class SetLayerLocked (Command):
         redraw_bboxes = [self.layer.get_full_redraw_bbox()]
         self._notify_canvas_observers(redraw_bboxes)
 
+    def get_journal_params(self):
+        return dict(locked=self.new_locked, path=self._path)
+
     @property
     def display_name(self):
         if self.new_locked:
@@ -1224,6 +1775,9 @@ class SetLayerOpacity (Command):
         layer = self.layer
         layer.opacity = self._old_opacity
 
+    def get_journal_params(self):
+        return dict(opacity=self._new_opacity, path=self._path)
+
 
 class SetLayerMode (Command):
     """Sets the combining mode for a layer"""
@@ -1259,6 +1813,9 @@ class SetLayerMode (Command):
         layer.mode = self._old_mode
         layer.opacity = self._old_opacity
 
+    def get_journal_params(self):
+        return dict(mode=self._new_mode, path=self._path)
+
 
 class SetFrameEnabled (Command):
     """Enable or disable the document frame"""
@@ -1282,6 +1839,9 @@ class SetFrameEnabled (Command):
     def undo(self):
         self.doc.set_frame_enabled(self.before, user_initiated=False)
 
+    def get_journal_params(self):
+        return dict(enable=self.after)
+
 
 class UpdateFrame (Command):
     """Update frame dimensions"""
@@ -1311,6 +1871,9 @@ class UpdateFrame (Command):
         self.doc.update_frame(*self.old_frame, user_initiated=False)
         self.doc.set_frame_enabled(self.old_enabled, user_initiated=False)
 
+    def get_journal_params(self):
+        return dict(frame=list(self.new_frame))
+
 
 class ExternalLayerEdit (Command):
     """An edit made in a external application"""
@@ -0,0 +1,283 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Deep Zoom tile pyramid export
+
+Web viewers such as OpenSeadragon show huge images as a pyramid of small
+tiles: the Deep Zoom (DZI) format. A ``.dzi`` file describes the image,
+and a ``*_files`` directory next to it holds one subdirectory of tiles
+per level. Each level is half the size of the one above it, down to a
+single pixel.
+
+The larger levels are rendered tile by tile straight from the layers'
+mipmaps, so no flat image of the whole canvas is ever made. Levels
+smaller than the last mipmap level are scaled down from it. Rendering
+happens in the calling thread, because the layer stack's render cache
+isn't thread safe, but compressing and writing the tiles happens in a
+pool of worker threads. The native encoders release the GIL while they
+compress, so this keeps all cores busy.
+
+Fully transparent tiles are not written at all. Viewers show nothing
+where a tile is missing, which looks the same.
+
+"""
+
+## Imports
+
+import os
+import sys
+import math
+import time
+import shutil
+import xml.etree.ElementTree as ET
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+from gettext import gettext as _
+
+import mypaintlib
+import helpers
+import tiledsurface
+import pixbufsurface
+from lib.workerpool import WorkerPool
+from errors import FileHandlingError
+
+
+## Module constants
+
+#: Size of the exported tiles, in pixels (a multiple of the tile size)
+TILE_SIZE = 256
+
+_DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+
+N = tiledsurface.N
+
+
+## Public functions
+
+def save_dzi(root, filename, bbox, tile_format="png", alpha=False,
+             quality=90, threads=None, feedback_cb=None, **kwargs):
+    """Exports a layer stack as a Deep Zoom tile pyramid
+
+    :param lib.layer.RootLayerStack root: the stack to export
+    :param unicode filename: the ``.dzi`` file to write
+    :param tuple bbox: the area to export, in model coordinates
+    :param str tile_format: "png" or "jpg"
+    :param bool alpha: Export with transparency (PNG tiles only)
+    :param int quality: JPEG quality, 0 to 100
+    :param int threads: number of encoder threads (default: see
+      `lib.workerpool.DEFAULT_THREADS`)
+    :param callable feedback_cb: Called periodically while exporting
+    :param \*\*kwargs: ``png_compression`` and ``save_srgb_chunks`` are
+      used as in `lib.pixbufsurface.save_as_png()`. The rest are
+      passed to the stack's `blit_tile_into()`.
+
+    Any existing tiles directory for `filename` is replaced.
+
+    """
+    tile_format = tile_format.lower()
+    if tile_format == "jpeg":
+        tile_format = "jpg"
+    if tile_format not in ("png", "jpg"):
+        raise ValueError("Unsupported tile format %r" % (tile_format,))
+    if tile_format == "jpg":
+        alpha = False
+    save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
+    profile = kwargs.pop("png_compression", None) or "default"
+    compression = pixbufsurface.PNG_COMPRESSION_PROFILES[profile]
+    kwargs["render_background"] = not alpha
+
+    x, y, w, h = bbox
+    if w <= 0 or h <= 0:
+        x, y, w, h = 0, 0, N, N  # allow saving empty documents
+    max_level = int(math.ceil(math.log(max(w, h), 2)))
+
+    t0 = time.time()
+    basename, ext = os.path.splitext(filename)
+    files_dir = basename + "_files"
+    if os.path.isdir(files_dir):
+        shutil.rmtree(files_dir)
+    os.makedirs(files_dir)
+
+    writer = WorkerPool(threads, feedback_cb)
+    write_args = (tile_format, alpha, quality, compression, save_srgb_chunks)
+    content_bbox = root.get_bbox()
+    num_written = 0
+    num_skipped = 0
+    try:
+        # Larger levels: straight from the mipmaps.
+        last_mipmap = min(tiledsurface.MAX_MIPMAP_LEVEL, max_level)
+        level_img = None
+        for mipmap_level in xrange(0, last_mipmap + 1):
+            level = max_level - mipmap_level
+            level_dir = _make_level_dir(files_dir, level)
+            lx = x >> mipmap_level
+            ly = y >> mipmap_level
+            lw = _scaled_size(w, mipmap_level)
+            lh = _scaled_size(h, mipmap_level)
+            if mipmap_level == last_mipmap:
+                level_img = numpy.zeros((lh, lw, 4), 'uint8')
+            for col, row, px, py, tw, th in _iter_tiles(lw, lh):
+                model_rect = helpers.Rect(
+                    (lx + px) << mipmap_level, (ly + py) << mipmap_level,
+                    tw << mipmap_level, th << mipmap_level,
+                )
+                if alpha and not content_bbox.overlaps(model_rect):
+                    num_skipped += 1
+                    continue
+                tile = _render_tile(root, lx + px, ly + py, tw, th,
+                                    mipmap_level, alpha, kwargs)
+                if level_img is not None:
+                    level_img[py:py+th, px:px+tw] = tile
+                if alpha and not tile[..., 3].any():
+                    num_skipped += 1
+                    continue
+                path = _tile_path(level_dir, col, row, tile_format)
+                writer.submit(_write_tile, path, tile, *write_args)
+                num_written += 1
+        # Smaller levels: scaled down from the last mipmap level.
+        for level in xrange(max_level - last_mipmap - 1, -1, -1):
+            level_img = _halve(level_img, alpha)
+            level_dir = _make_level_dir(files_dir, level)
+            lh, lw = level_img.shape[0:2]
+            for col, row, px, py, tw, th in _iter_tiles(lw, lh):
+                tile = level_img[py:py+th, px:px+tw]
+                if alpha and not tile[..., 3].any():
+                    num_skipped += 1
+                    continue
+                path = _tile_path(level_dir, col, row, tile_format)
+                writer.submit(_write_tile, path, tile, *write_args)
+                num_written += 1
+        writer.close()
+    except:
+        writer.abort()
+        raise
+
+    _write_dzi_xml(filename, w, h, tile_format)
+    logger.info("%.3fs exporting %r: %d tiles written, %d blank ones skipped",
+                time.time() - t0, filename, num_written, num_skipped)
+
+
+## Helper functions
+
+def _scaled_size(size, level):
+    """Size of a dimension, halved `level` times, rounding up"""
+    return max(1, -(-size >> level))
+
+
+def _make_level_dir(files_dir, level):
+    level_dir = os.path.join(files_dir, str(level))
+    os.mkdir(level_dir)
+    return level_dir
+
+
+def _tile_path(level_dir, col, row, tile_format):
+    return os.path.join(level_dir, "%d_%d.%s" % (col, row, tile_format))
+
+
+def _iter_tiles(w, h):
+    """Iterates over a level's tiles: (col, row, x, y, w, h)"""
+    for row, py in enumerate(xrange(0, h, TILE_SIZE)):
+        for col, px in enumerate(xrange(0, w, TILE_SIZE)):
+            yield (col, row, px, py,
+                   min(TILE_SIZE, w - px), min(TILE_SIZE, h - py))
+
+
+def _render_tile(root, x, y, w, h, mipmap_level, alpha, kwargs):
+    """Renders a rectangle of a mipmap level as 8bpp RGBA"""
+    tx0, ty0 = x // N, y // N
+    tx1, ty1 = (x + w - 1) // N, (y + h - 1) // N
+    arr = numpy.empty(((ty1 - ty0 + 1) * N, (tx1 - tx0 + 1) * N, 4),
+                      'uint8')
+    for ty in xrange(ty0, ty1 + 1):
+        for tx in xrange(tx0, tx1 + 1):
+            dst = arr[(ty-ty0)*N:(ty-ty0+1)*N, (tx-tx0)*N:(tx-tx0+1)*N]
+            try:
+                root.blit_tile_into(dst, alpha, tx, ty,
+                                    mipmap_level=mipmap_level, **kwargs)
+            except Exception:
+                logger.exception("Failed to blit tile %r", (tx, ty))
+                mypaintlib.tile_clear_rgba8(dst)
+    ox, oy = x - tx0 * N, y - ty0 * N
+    return arr[oy:oy+h, ox:ox+w]
+
+
+def _halve(img, alpha):
+    """Scales an 8bpp RGBA image down by half, averaging 2x2 blocks
+
+    >>> img = numpy.zeros((3, 5, 4), 'uint8')
+    >>> img[0, 0] = (255, 0, 0, 255)
+    >>> small = _halve(img, True)
+    >>> small.shape
+    (2, 3, 4)
+    >>> tuple(small[0, 0])
+    (255, 0, 0, 64)
+
+    """
+    h, w = img.shape[0:2]
+    if (h % 2) or (w % 2):
+        img = numpy.pad(img, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    img = img.astype('uint32')
+    blocks = (img[0::2, 0::2] + img[1::2, 0::2]
+              + img[0::2, 1::2] + img[1::2, 1::2])
+    if not alpha:
+        return ((blocks + 2) // 4).astype('uint8')
+    # Weight by alpha, so that transparent pixels don't darken edges.
+    a = img[..., 3:4]
+    rgb = img[..., 0:3] * a
+    rgb_blocks = (rgb[0::2, 0::2] + rgb[1::2, 0::2]
+                  + rgb[0::2, 1::2] + rgb[1::2, 1::2])
+    a_blocks = blocks[..., 3:4]
+    out = numpy.empty(blocks.shape, 'uint8')
+    out[..., 0:3] = rgb_blocks // numpy.maximum(a_blocks, 1)
+    out[..., 3:4] = (a_blocks + 2) // 4
+    return out
+
+
+def _write_tile(path, tile, tile_format, alpha, quality, compression,
+                save_srgb_chunks):
+    """Encodes and writes one tile (in a worker thread)"""
+    path_sys = path.encode(sys.getfilesystemencoding())
+    h, w = tile.shape[0:2]
+    try:
+        if tile_format == "jpg":
+            mypaintlib.save_jpeg_fast_progressive(path_sys, w, h, [tile],
+                                                  quality)
+        else:
+            mypaintlib.save_png_fast_progressive(path_sys, w, h, alpha,
+                                                 [tile], save_srgb_chunks,
+                                                 compression)
+    except (IOError, OSError, RuntimeError) as err:
+        raise FileHandlingError(_("Tile writer failed: %s") % (err,))
+
+
+def _write_dzi_xml(filename, w, h, tile_format):
+    """Writes the .dzi file describing the pyramid"""
+    image = ET.Element("Image")
+    image.attrib["xmlns"] = _DZI_NAMESPACE
+    image.attrib["TileSize"] = str(TILE_SIZE)
+    image.attrib["Overlap"] = "0"
+    image.attrib["Format"] = tile_format
+    size = ET.SubElement(image, "Size")
+    size.attrib["Width"] = str(w)
+    size.attrib["Height"] = str(h)
+    helpers.indent_etree(image)
+    with open(filename, "wb") as fp:
+        fp.write(ET.tostring(image, encoding="UTF-8"))
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
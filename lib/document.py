@@ -35,9 +35,15 @@ import mypaintlib
 import command
 import stroke
 import layer
+import layer.loading
 import brush
 from observable import event
 import lib.pixbuf
+import lib.zipwriter
+import lib.workerpool
+import lib.workingfile
+import lib.deepzoom
+import lib.journal
 from lib.errors import FileHandlingError
 
 
@@ -81,14 +87,16 @@ class Document (object):
 
     ## Initialization and cleanup
 
-    def __init__(self, brushinfo=None, painting_only=False):
+    def __init__(self, brushinfo=None, painting_only=False, journal=False):
         """Initialize
 
         :param brushinfo: the lib.brush.BrushInfo instance to use
         :param painting_only: only use painting layers
+        :param journal: keep a crash recovery journal (see lib.journal)
 
         If painting_only is true, then no tempdir will be created by the
-        document when it is initialized or cleared.
+        document when it is initialized or cleared, and no journal is
+        kept.
         """
         object.__init__(self)
         if not brushinfo:
@@ -99,7 +107,7 @@ class Document (object):
         self.brush = brush.Brush(brushinfo)
         self.brush.brushinfo.observers.append(self.brushsettings_changed_cb)
         self.stroke = None
-        self.command_stack = command.CommandStack()
+        self.command_stack = command.CommandStack(doc=self)
         self._painting_only = painting_only
         self._tempdir = None
 
@@ -109,6 +117,15 @@ class Document (object):
         self._xres = None
         self._yres = None
 
+        # The ORA file last saved or loaded, for reusing unchanged layer
+        # data: (archive_id, file_key), or None. See save_ora().
+        self._ora_archive = None
+
+        # Crash recovery journal, kept in the tempdir
+        self._journal = None
+        if journal and not painting_only:
+            self._journal = lib.journal.RecoveryJournal(self)
+
         # Backgrounds for rendering
         blank_arr = numpy.zeros((N, N, 4), dtype='uint16')
         self._blank_bg_surface = tiledsurface.Background(blank_arr)
@@ -155,6 +172,8 @@ class Document (object):
         if self._painting_only:
             return
         assert self._tempdir is not None
+        if self._journal is not None:
+            self._journal.close()
         tempdir = self._tempdir
         self._tempdir = None
         for root, dirs, files in os.walk(tempdir, topdown=False):
@@ -187,6 +206,33 @@ class Document (object):
         """
         self._cleanup_tempdir()
 
+    ## Snapshotting (for saving elsewhere)
+
+    def save_snapshot(self):
+        """Snapshots everything which would be saved
+
+        :returns: an opaque snapshot, for `new_from_snapshot()`
+
+        Layer data is shared with the snapshot copy-on-write, so making
+        one takes little time even for big documents. See
+        `lib.autosave`.
+        """
+        return DocumentSnapshot(self)
+
+    @classmethod
+    def new_from_snapshot(cls, sshot):
+        """Creates a detached painting-only document from a snapshot
+
+        :param sshot: a snapshot made by `save_snapshot()`
+        :returns: a new document
+
+        The new document shares only read-only tiles with the document
+        which was snapshotted, so it can be saved from another thread.
+        """
+        doc = cls(painting_only=True)
+        sshot.restore_to_doc(doc)
+        return doc
+
     ## Document frame
 
     def get_resolution(self):
@@ -333,6 +379,9 @@ class Document (object):
         self.set_frame_enabled(False)
         self._xres = None
         self._yres = None
+        self._ora_archive = None
+        if self._journal is not None:
+            self._journal.reset_blank(self._tempdir)
         self.canvas_area_modified(*prev_area)
 
     def brushsettings_changed_cb(self, settings):
@@ -393,6 +442,8 @@ class Document (object):
         if not isinstance(cmd, command.Brushwork):
             return
         cmd.update(brushinfo=brushinfo)
+        if self._journal is not None:
+            self._journal.stroke_retraced(brushinfo)
 
     ## Other painting/drawing
 
@@ -493,28 +544,46 @@ class Document (object):
     def undo(self):
         """Undo the most recently done command"""
         self.sync_pending_changes()
+        count = 0
         while 1:
             cmd = self.command_stack.undo()
+            if cmd:
+                count += 1
             if not cmd or not cmd.automatic_undo:
-                return cmd
+                break
+        if self._journal is not None:
+            self._journal.commands_undone(count)
+        return cmd
 
     def redo(self):
         """Redo the most recently undone command"""
         self.sync_pending_changes()
+        count = 0
         while 1:
             cmd = self.command_stack.redo()
+            if cmd:
+                count += 1
             if not cmd or not cmd.automatic_undo:
-                return cmd
+                break
+        if self._journal is not None:
+            self._journal.commands_redone(count)
+        return cmd
 
     def do(self, cmd):
         """Do a command"""
         self.sync_pending_changes()
+        current_path = self.layer_stack.current_path
         self.command_stack.do(cmd)
+        if self._journal is not None:
+            self._journal.command_done(cmd, current_path)
 
     def update_last_command(self, **kwargs):
         """Updates the most recently done command"""
         self.sync_pending_changes()
-        return self.command_stack.update_last_command(**kwargs)
+        cmd = self.command_stack.update_last_command(**kwargs)
+        if cmd is not None and self._journal is not None:
+            self._journal.command_updated(kwargs)
+        return cmd
 
     def get_last_command(self):
         """Gets the the most recently done command"""
@@ -640,6 +709,15 @@ class Document (object):
         self.do(command.LoadLayer(self, s))
         return bbox
 
+    def load_layer_from_pixbuf_file(self, filename, x, y, feedback_cb=None,
+                                    **kwargs):
+        """Loads a new layer from any file GdkPixbuf can open, in strips"""
+        s = tiledsurface.Surface()
+        with open(filename, 'rb') as fp:
+            bbox = s.load_from_pixbuf_stream(fp, x, y, feedback_cb, **kwargs)
+        self.do(command.LoadLayer(self, s))
+        return bbox
+
     def update_layer_from_external_edit_tempfile(self, layer, file_path):
         """Update a layer after external edits to its tempfile"""
         assert hasattr(layer, "load_from_external_edit_tempfile")
@@ -723,6 +801,10 @@ class Document (object):
 
         The filename's extension is used to determine the save format, and a
         ``save_*()`` method is chosen to perform the save.
+
+        Formats which contain PNG data accept a ``png_compression``
+        option, naming one of `lib.pixbufsurface.PNG_COMPRESSION_PROFILES`:
+        "fast", "default", or "best".
         """
         self.sync_pending_changes()
         junk, ext = os.path.splitext(filename)
@@ -781,6 +863,9 @@ class Document (object):
             filename,
             kwargs,
         )
+        journal = self._journal
+        if journal is not None:
+            journal.pause()
         try:
             load_method(filename, **kwargs)
         except GObject.GError as e:
@@ -789,8 +874,32 @@ class Document (object):
         except IOError as e:
             logger.exception("IOError when loading")
             raise FileHandlingError(_('Error while loading: IOError %s') % e)
+        finally:
+            if journal is not None:
+                journal.resume()
+                journal.invalidate()
         self.command_stack.clear()
         self.unsaved_painting_time = 0.0
+        if journal is not None:
+            journal.reset_to_file(filename, **kwargs)
+
+    def recover_from_journal(self, dirname, feedback_cb=None):
+        """Rebuilds the document from a crashed session's journal
+
+        :param unicode dirname: the journal's directory
+        :param callable feedback_cb: called periodically while replaying
+        :raise FileHandlingError: if the journal can't be used
+
+        See `lib.journal.find_recoverable()` for finding journals. The
+        document must keep a journal of its own.
+        """
+        assert self._journal is not None, "Document keeps no journal"
+        self._journal.replay(dirname, feedback_cb=feedback_cb)
+
+    def _save_journal_checkpoint(self, filename):
+        """Internal: writes a checkpoint for the recovery journal"""
+        self.layer_stack.finish_lazy_load()
+        self._save_ora_via_tempfile(filename, working=True, record=False)
 
     def _unsupported(self, filename, *args, **kwargs):
         raise FileHandlingError(
@@ -810,35 +919,69 @@ class Document (object):
         return pixbuf
 
     def save_png(self, filename, alpha=None, multifile=False, **kwargs):
-        """Save to one or more PNG files"""
+        """Save to one or more PNG files
+
+        :returns: A thumbnail pixbuf for single-file saves, else None
+        """
         if multifile:
             self._save_multi_file_png(filename, **kwargs)
         else:
-            self._save_single_file_png(filename, alpha, **kwargs)
+            return self._save_single_file_png(filename, alpha, **kwargs)
 
     def _save_single_file_png(self, filename, alpha, **kwargs):
+        self.layer_stack.finish_lazy_load()
         if alpha is None:
             alpha = not self.layer_stack.background_visible
         doc_bbox = self.get_effective_bbox()
+        thumbnailer = pixbufsurface.ScanlineThumbnailer()
         self.layer_stack.save_as_png(
             filename,
             *doc_bbox,
             alpha=alpha,
             render_background=not alpha,
+            thumbnail=thumbnailer,
             **kwargs
         )
-
-    def _save_multi_file_png(self, filename, alpha=False, **kwargs):
-        """Save to multiple suffixed PNG files"""
+        return thumbnailer.get_pixbuf()
+
+    def _save_multi_file_png(self, filename, alpha=False, threads=None,
+                             feedback_cb=None, **kwargs):
+        """Save to multiple suffixed PNG files
+
+        The layers are exported in parallel by a pool of worker threads
+        (see `lib.workerpool`), each streaming its layer through
+        ``save_as_png()``. Layers with nothing on them are skipped, but
+        the numbering of the files still follows the layer order. The
+        workers never call `feedback_cb`; it's called from this thread
+        while waiting.
+        """
         prefix, ext = os.path.splitext(filename)
         # if we have a number already, strip it
         l = prefix.rsplit('.', 1)
         if l[-1].isdigit():
             prefix = l[0]
-        doc_bbox = self.get_effective_bbox()
+        # The workers mustn't trigger lazy decoding in parallel
+        self.layer_stack.finish_lazy_load()
+        doc_bbox = tuple(self.get_effective_bbox())
+        jobs = []
         for i, l in enumerate(self.layer_stack.deepiter()):
+            if l.get_bbox().empty():
+                continue
             filename = '%s.%03d%s' % (prefix, i+1, ext)
-            l.save_as_png(filename, *doc_bbox, **kwargs)
+            jobs.append((l, filename))
+        if threads is not None:
+            threads = min(int(threads), len(jobs))
+        t0 = time.time()
+        pool = lib.workerpool.WorkerPool(threads, feedback_cb)
+        try:
+            for (l, filename) in jobs:
+                pool.submit(l.save_as_png, filename, *doc_bbox, **kwargs)
+            pool.close()
+        except:
+            pool.abort()
+            raise
+        logger.info("%.3fs exporting %d layers to %r (%d threads)",
+                    time.time() - t0, len(jobs), prefix, pool.threads)
 
     def load_png(self, filename, feedback_cb=None, **kwargs):
         """Load (speedily) from a PNG file"""
@@ -847,48 +990,160 @@ class Document (object):
         self.set_frame(bbox, user_initiated=False)
 
     def load_from_pixbuf_file(self, filename, feedback_cb=None, **kwargs):
-        """Load from a file which GdkPixbuf can open"""
-        pixbuf = lib.pixbuf.load_from_file(filename, feedback_cb)
-        self.load_from_pixbuf(pixbuf)
+        """Load from a file which GdkPixbuf can open
+
+        The image is converted to tiles a strip at a time while it's
+        being decoded (see `load_layer_from_pixbuf_file()`).
+        """
+        self.clear()
+        bbox = self.load_layer_from_pixbuf_file(filename, 0, 0, feedback_cb,
+                                                **kwargs)
+        self.set_frame(bbox, user_initiated=False)
 
     load_jpg = load_from_pixbuf_file
     load_jpeg = load_from_pixbuf_file
 
     @fileutils.via_tempfile
     def save_jpg(self, filename, quality=90, **kwargs):
+        """Save to a JPEG file, streamed a tile row at a time"""
+        self.layer_stack.finish_lazy_load()
         x, y, w, h = self.get_effective_bbox()
         if w == 0 or h == 0:
             x, y, w, h = 0, 0, N, N  # allow to save empty documents
-        pixbuf = self.layer_stack.render_as_pixbuf(x, y, w, h, **kwargs)
-        lib.pixbuf.save(pixbuf, filename, 'jpeg', quality=str(quality))
+        thumbnailer = pixbufsurface.ScanlineThumbnailer()
+        self.layer_stack.save_as_jpeg(filename, x, y, w, h,
+                                      quality=quality,
+                                      thumbnail=thumbnailer,
+                                      **kwargs)
+        return thumbnailer.get_pixbuf()
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
+    def save_dzi(self, filename, tile_format="png", alpha=None, **kwargs):
+        """Export a Deep Zoom tile pyramid (see lib.deepzoom)"""
+        self.layer_stack.finish_lazy_load()
+        if alpha is None:
+            alpha = not self.layer_stack.background_visible
+        lib.deepzoom.save_dzi(
+            self.layer_stack,
+            filename,
+            self.get_effective_bbox(),
+            tile_format=tile_format,
+            alpha=alpha,
+            **kwargs
+        )
+
     def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+        """Saves OpenRaster data to a file
+
+        When overwriting the file which was last loaded or saved, and it
+        hasn't been modified since, the data of unchanged layers is
+        copied raw from the old file instead of being encoded again.
+        """
+        return self._save_ora_archive(filename, options, **kwargs)
+
+    def save_mypaint(self, filename, options=None, **kwargs):
+        """Saves to a working file (see lib.workingfile)
+
+        Working files are like OpenRaster files, but the painting layers
+        are saved as raw tiles. Tiles mapped from the file being
+        overwritten are copied without being decompressed.
+        """
+        return self._save_ora_archive(filename, options, working=True,
+                                      **kwargs)
+
+    def _save_ora_archive(self, filename, options=None, working=False,
+                          **kwargs):
+        """Internal: saves an OpenRaster or working file (see save_ora())"""
+        # Any layers still waiting to be decoded after a lazy load are
+        # read from the file which is about to be replaced.
+        self.layer_stack.finish_lazy_load()
+        previous = None
+        previous_id = None
+        if self._ora_archive is not None:
+            previous_id, file_key = self._ora_archive
+            if file_key is not None and file_key == _get_file_key(filename):
+                try:
+                    previous = zipfile.ZipFile(filename)
+                except (IOError, zipfile.BadZipfile):
+                    logger.exception("Cannot reuse data from %r", filename)
+        thumbnail, archive_id = self._save_ora_via_tempfile(
+            filename, options,
+            previous=previous,
+            previous_id=previous_id,
+            working=working,
+            **kwargs
+        )
+        self._ora_archive = (archive_id, _get_file_key(filename))
+        # Working files hold the exact data, so replays can start there
+        if working and self._journal is not None:
+            self._journal.reset_to_file(filename)
+        return thumbnail
+
+    @fileutils.via_tempfile
+    def _save_ora_via_tempfile(self, filename, options=None,
+                               previous=None, previous_id=None,
+                               working=False, record=True, **kwargs):
+        """Internal: saves OpenRaster data to a file (see save_ora())
+
+        If `record` is false, the layers don't remember the entries
+        written, so later saves can't reuse them. Checkpoints for the
+        recovery journal are saved like this, so that they don't stop
+        layers being copied raw from the user's own file.
+        """
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
         tempdir = tempfile.mkdtemp('mypaint')
         if not isinstance(tempdir, unicode):
             tempdir = tempdir.decode(sys.getfilesystemencoding())
 
-        orazip = zipfile.ZipFile(filename, 'w',
-                                 compression=zipfile.ZIP_STORED)
+        # Layer PNGs are encoded in parallel, and written in order.
+        orazip = lib.zipwriter.OrderedZipWriter(
+            filename,
+            compression=zipfile.ZIP_STORED,
+            feedback_cb=kwargs.get("feedback_cb"),
+            previous=previous,
+            previous_id=previous_id,
+        )
+        if not record:
+            orazip.archive_id = None
+        try:
+            thumbnail = self._save_ora_entries(orazip, tempdir,
+                                               working=working, **kwargs)
+            orazip.close()
+        except:
+            orazip.abort()
+            raise
+        finally:
+            os.rmdir(tempdir)
+            # Must be closed before the tempfile is renamed over it
+            if previous is not None:
+                previous.close()
+            # Likewise any mappings of it, on Windows
+            if working and os.name == "nt":
+                lib.workingfile.release_file(filename)
 
-        # work around a permission bug in the zipfile library:
-        # http://bugs.python.org/issue3394
-        def write_file_str(filename, data):
-            zi = zipfile.ZipInfo(filename)
-            zi.external_attr = 0100644 << 16
-            orazip.writestr(zi, data)
+        logger.info('%.3fs save_ora total', time.time() - t0)
+        return (thumbnail, orazip.archive_id)
 
-        write_file_str('mimetype', 'image/openraster')  # must be the first file
+    def _save_ora_entries(self, orazip, tempdir, working=False, **kwargs):
+        """Internal: write the entries of an ORA file, in order"""
+        if working:
+            mimetype = lib.workingfile.MIMETYPE
+        else:
+            mimetype = 'image/openraster'
+        orazip.writestr('mimetype', mimetype)  # must be first
         image = ET.Element('image')
         effective_bbox = self.get_effective_bbox()
         x0, y0, w0, h0 = effective_bbox
         image.attrib['w'] = str(w0)
         image.attrib['h'] = str(h0)
+        if working:
+            # Working files keep layer data in model coordinates.
+            image.attrib['mypaint_frame_x'] = str(x0)
+            image.attrib['mypaint_frame_y'] = str(y0)
+            if self._frame_enabled:
+                image.attrib['mypaint_frame_enabled'] = "true"
 
         # Update the initially-selected flag on all layers
         layers = self.layer_stack
@@ -902,7 +1157,7 @@ class Document (object):
         root_stack_path = ()
         root_stack_elem = self.layer_stack.save_to_openraster(
             orazip, tempdir, root_stack_path,
-            canvas_bbox, frame_bbox, **kwargs
+            canvas_bbox, frame_bbox, store_tiles=working, **kwargs
         )
         image.append(root_stack_elem)
 
@@ -914,37 +1169,56 @@ class Document (object):
         # OpenRaster version declaration
         image.attrib["version"] = "0.0.4"
 
-        # Thumbnail preview (256x256)
-        thumbnail = layers.render_thumbnail(frame_bbox)
-        tmpfile = join(tempdir, 'tmp.png')
-        lib.pixbuf.save(thumbnail, tmpfile, 'png')
-        orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-        os.remove(tmpfile)
-
-        # Save fully rendered image too
-        tmpfile = os.path.join(tempdir, "mergedimage.png")
-        self.layer_stack.save_as_png(
-            tmpfile, *frame_bbox,
-            alpha=False, background=True,
-            **kwargs
+        # Save fully rendered image too, for other apps, and make the
+        # 256x256 thumbnail preview from the same render pass.
+        # The root stack's render cache isn't thread safe, so these are
+        # encoded here while the layers' PNG data is still being encoded
+        # by the writer's threads.
+        if working:
+            thumbnail = layers.render_thumbnail(frame_bbox)
+        else:
+            t0 = time.time()
+            thumbnailer = pixbufsurface.ScanlineThumbnailer()
+            data = self.layer_stack.encode_as_png(
+                *frame_bbox,
+                alpha=False, background=True,
+                thumbnail=thumbnailer,
+                **kwargs
+            )
+            thumbnail = thumbnailer.get_pixbuf()
+            logger.debug('%.3fs mergedimage and thumbnail encoding',
+                         time.time() - t0)
+            orazip.writestr('mergedimage.png', data)
+        orazip.writestr(
+            'Thumbnails/thumbnail.png',
+            lib.pixbuf.encode(thumbnail, 'png'),
         )
-        orazip.write(tmpfile, 'mergedimage.png')
-        os.remove(tmpfile)
 
         # Prettification
         helpers.indent_etree(image)
         xml = ET.tostring(image, encoding='UTF-8')
 
         # Finalize
-        write_file_str('stack.xml', xml)
-        orazip.close()
-        os.rmdir(tempdir)
-
-        logger.info('%.3fs save_ora total', time.time() - t0)
+        orazip.writestr('stack.xml', xml)
         return thumbnail
 
     def load_ora(self, filename, feedback_cb=None, **kwargs):
         """Loads from an OpenRaster file"""
+        self._load_ora_archive(filename, feedback_cb, **kwargs)
+
+    def load_mypaint(self, filename, feedback_cb=None, **kwargs):
+        """Loads from a working file (see lib.workingfile)
+
+        The file is memory-mapped, and the painting layers' tiles are
+        only decompressed when they're first needed.
+        """
+        source = lib.workingfile.TileSource(filename)
+        self._load_ora_archive(filename, feedback_cb, tile_source=source,
+                               **kwargs)
+
+    def _load_ora_archive(self, filename, feedback_cb=None,
+                          tile_source=None, **kwargs):
+        """Internal: loads an OpenRaster or working file"""
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         tempdir = self._tempdir
@@ -958,11 +1232,21 @@ class Document (object):
         # Resolution: false value, 0 specifically, means unspecified
         image_xres = max(0, int(image_elem.attrib.get('xres', 0)))
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
+        # OpenRaster files are loaded with the frame at the origin, but
+        # working files keep their layer data's model coordinates.
+        frame_x = frame_y = 0
+        if tile_source is not None:
+            frame_x = int(image_elem.attrib.get('mypaint_frame_x', 0))
+            frame_y = int(image_elem.attrib.get('mypaint_frame_y', 0))
+            kwargs["deferred_loader"] = layer.loading.MappedTileLoader(
+                tile_source, orazip,
+            )
 
         # Delegate loading of image data to the layers tree itself
         self.layer_stack.clear()
         self.layer_stack.load_from_openraster(orazip, root_stack_elem,
-                                              tempdir, feedback_cb, x=0, y=0,
+                                              tempdir, feedback_cb,
+                                              x=frame_x, y=frame_y,
                                               **kwargs)
         assert len(self.layer_stack) > 0
 
@@ -976,17 +1260,61 @@ class Document (object):
             self._yres = None
 
         # Set the frame size to that saved in the image.
-        self.update_frame(x=0, y=0, width=image_width, height=image_height,
+        self.update_frame(x=frame_x, y=frame_y,
+                          width=image_width, height=image_height,
                           user_initiated=False)
 
         # Enable frame if the saved image size is something other than the
         # calculated bounding box. Goal: if the user saves an "infinite
         # canvas", it loads as an infinite canvas.
-        bbox_c = helpers.Rect(x=0, y=0, w=image_width, h=image_height)
-        bbox = self.get_bbox()
-        frame_enab = not (bbox_c == bbox or bbox.empty() or bbox_c.empty())
+        if tile_source is not None:
+            enabled = image_elem.attrib.get('mypaint_frame_enabled', "")
+            frame_enab = (enabled.lower() == "true")
+        else:
+            bbox_c = helpers.Rect(x=0, y=0, w=image_width, h=image_height)
+            bbox = self.get_bbox()
+            frame_enab = not (bbox_c == bbox or bbox.empty()
+                              or bbox_c.empty())
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
         orazip.close()
+        # Layers note which entries they were loaded from by filename.
+        self._ora_archive = (orazip.filename, _get_file_key(filename))
 
         logger.info('%.3fs load_ora total', time.time() - t0)
+
+
+class DocumentSnapshot (object):
+    """Snapshot of a document's saveable state
+
+    See `Document.save_snapshot()`. The layers' snapshots are those
+    used for undo, so their tiles are shared copy-on-write.
+    """
+
+    def __init__(self, doc):
+        super(DocumentSnapshot, self).__init__()
+        self.layers_sshot = doc.layer_stack.save_snapshot()
+        self.frame = list(doc._frame)
+        self.frame_enabled = doc._frame_enabled
+        self.xres = doc._xres
+        self.yres = doc._yres
+        self.unsaved_painting_time = doc.unsaved_painting_time
+
+    def restore_to_doc(self, doc):
+        doc.layer_stack.load_snapshot(self.layers_sshot)
+        doc.set_frame(self.frame)
+        doc.set_frame_enabled(self.frame_enabled)
+        doc._xres = self.xres
+        doc._yres = self.yres
+        doc.unsaved_painting_time = self.unsaved_painting_time
+
+
+## Helper functions
+
+def _get_file_key(filename):
+    """Identifies a version of a file by its location, size and mtime"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (os.path.realpath(filename), st.st_size, st.st_mtime)
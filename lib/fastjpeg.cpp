@@ -0,0 +1,431 @@
+// Fast JPEG loading and saving using scanlines
+// Copyright (C) 2015  MyPaint Development Team
+//
+// This program is free software; you can redistribute it and/or modify it
+// under the terms of the GNU General Public License as published by the Free
+// Software Foundation; either version 2 of the License, or (at your option)
+// any later version.
+//
+// This program is distributed in the hope that it will be useful, but WITHOUT
+// ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+// FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+// more details.
+//
+// You should have received a copy of the GNU General Public License along with
+// this program; if not, write to the Free Software Foundation, Inc., 51
+// Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+#include "fastjpeg.hpp"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <setjmp.h>
+
+extern "C" {
+#include "jpeglib.h"
+#include "jerror.h"
+}
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#define NO_IMPORT_ARRAY
+#include <numpy/arrayobject.h>
+
+
+// libjpeg error manager which raises a Python exception, and returns
+// control to the caller's setjmp() point instead of exiting.
+
+typedef struct {
+    struct jpeg_error_mgr pub;
+    jmp_buf setjmp_buffer;
+    PyThreadState *thread_state;  // non-NULL while the GIL is released
+} JPEGErrorState;
+
+
+static void
+jpeg_error_exit_callback (j_common_ptr cinfo)
+{
+    // Errors can happen while the GIL is released for (de)compression.
+    JPEGErrorState *state = (JPEGErrorState *)cinfo->err;
+    if (state->thread_state) {
+        PyEval_RestoreThread(state->thread_state);
+        state->thread_state = NULL;
+    }
+    if (!PyErr_Occurred()) {
+        char msg[JMSG_LENGTH_MAX];
+        (*cinfo->err->format_message)(cinfo, msg);
+        PyErr_Format(PyExc_RuntimeError, "JPEG error: %s", msg);
+    }
+    longjmp(state->setjmp_buffer, 1);
+}
+
+
+PyObject *
+save_jpeg_fast_progressive (char *filename,
+                            int w, int h,
+                            PyObject *data_generator,
+                            int quality)
+{
+    struct jpeg_compress_struct cinfo;
+    JPEGErrorState err_state;
+    PyObject *result = NULL;
+    PyObject *iterator = NULL;
+    PyObject * volatile arr_obj = NULL;
+    JSAMPLE *row = NULL;
+    FILE *fp = NULL;
+    int y = 0;
+
+    iterator = PyObject_GetIter(data_generator);
+    if (!iterator) {
+        return NULL;
+    }
+    row = (JSAMPLE *)malloc(w * 3 * sizeof(JSAMPLE));
+    if (!row) {
+        Py_DECREF(iterator);
+        return PyErr_NoMemory();
+    }
+    fp = fopen(filename, "wb");
+    if (!fp) {
+        PyErr_SetFromErrno(PyExc_IOError);
+        free(row);
+        Py_DECREF(iterator);
+        return NULL;
+    }
+
+    cinfo.err = jpeg_std_error(&err_state.pub);
+    err_state.pub.error_exit = jpeg_error_exit_callback;
+    err_state.thread_state = NULL;
+    jpeg_create_compress(&cinfo);
+    if (setjmp(err_state.setjmp_buffer)) {
+        goto cleanup;
+    }
+
+    jpeg_stdio_dest(&cinfo, fp);
+    cinfo.image_width = w;
+    cinfo.image_height = h;
+    cinfo.input_components = 3;
+    cinfo.in_color_space = JCS_RGB;
+    jpeg_set_defaults(&cinfo);
+    jpeg_set_quality(&cinfo, quality, TRUE);
+    jpeg_start_compress(&cinfo, TRUE);
+
+    while (y < h) {
+        if (arr_obj) {
+            Py_DECREF(arr_obj);
+            arr_obj = NULL;
+        }
+        arr_obj = PyIter_Next(iterator);
+        if (!arr_obj) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "Scanline generator ended early");
+            }
+            goto cleanup;  // exception raised by the generator
+        }
+        PyArrayObject *arr = (PyArrayObject *)arr_obj;
+        assert(PyArray_ISALIGNED(arr));
+        assert(PyArray_NDIM(arr) == 3);
+        assert(PyArray_DIM(arr, 1) == w);
+        assert(PyArray_DIM(arr, 2) == 4); // rgbu
+        assert(PyArray_TYPE(arr) == NPY_UINT8);
+        assert(PyArray_STRIDE(arr, 1) == 4);
+        assert(PyArray_STRIDE(arr, 2) == 1);
+        const int rows = PyArray_DIM(arr, 0);
+        const npy_intp rowstride = PyArray_STRIDE(arr, 0);
+        const JSAMPLE *data = (const JSAMPLE *)PyArray_DATA(arr);
+
+        // The strip stays referenced by arr_obj until the next one.
+        err_state.thread_state = PyEval_SaveThread();
+        for (int r = 0; r < rows && y < h; r++, y++) {
+            const JSAMPLE *src = data + r * rowstride;
+            JSAMPLE *dst = row;
+            for (int x = 0; x < w; x++) {
+                dst[0] = src[0];
+                dst[1] = src[1];
+                dst[2] = src[2];
+                dst += 3;
+                src += 4;
+            }
+            JSAMPROW rowp = row;
+            jpeg_write_scanlines(&cinfo, &rowp, 1);
+        }
+        PyEval_RestoreThread(err_state.thread_state);
+        err_state.thread_state = NULL;
+    }
+
+    jpeg_finish_compress(&cinfo);
+    result = Py_BuildValue("{}");
+
+cleanup:
+    jpeg_destroy_compress(&cinfo);
+    fclose(fp);
+    free(row);
+    if (arr_obj) {
+        Py_DECREF(arr_obj);
+    }
+    Py_DECREF(iterator);
+    return result;
+}
+
+
+// libjpeg data source which reads from a Python file-like object.
+// Needed for JPEGs inside zipfiles, which have no FILE pointer.
+
+static const size_t JPEG_READ_CHUNK_SIZE = 65536;
+
+static const JOCTET JPEG_FAKE_EOI[2] = {0xFF, JPEG_EOI};
+
+typedef struct {
+    struct jpeg_source_mgr pub;
+    PyObject *read_func;
+    PyObject *chunk;  // str owning the bytes libjpeg is reading from
+    JPEGErrorState *err_state;
+} JPEGPythonSource;
+
+
+static void
+jpeg_python_init_source (j_decompress_ptr cinfo)
+{
+}
+
+
+static boolean
+jpeg_python_fill_input_buffer (j_decompress_ptr cinfo)
+{
+    JPEGPythonSource *src = (JPEGPythonSource *)cinfo->src;
+    JPEGErrorState *err_state = src->err_state;
+    // Scanlines are decoded with the GIL released, but read() needs it.
+    PyThreadState *thread_state = err_state->thread_state;
+    if (thread_state) {
+        PyEval_RestoreThread(thread_state);
+        err_state->thread_state = NULL;
+    }
+    Py_XDECREF(src->chunk);
+    src->chunk = PyObject_CallFunction(src->read_func, "n",
+                                       (Py_ssize_t)JPEG_READ_CHUNK_SIZE);
+    if (src->chunk && !PyString_Check(src->chunk)) {
+        PyErr_SetString(PyExc_TypeError, "read() must return a str");
+    }
+    if (PyErr_Occurred()) {
+        Py_XDECREF(src->chunk);
+        src->chunk = NULL;
+        (*cinfo->err->error_exit)((j_common_ptr)cinfo);  // keeps the GIL
+    }
+    if (PyString_GET_SIZE(src->chunk) == 0) {
+        // Truncated file: finish with what we have, like jpeg_stdio_src()
+        WARNMS(cinfo, JWRN_JPEG_EOF);
+        src->pub.next_input_byte = JPEG_FAKE_EOI;
+        src->pub.bytes_in_buffer = sizeof(JPEG_FAKE_EOI);
+    }
+    else {
+        src->pub.next_input_byte = (const JOCTET *)
+            PyString_AS_STRING(src->chunk);
+        src->pub.bytes_in_buffer = PyString_GET_SIZE(src->chunk);
+    }
+    if (thread_state) {
+        err_state->thread_state = PyEval_SaveThread();
+    }
+    return TRUE;
+}
+
+
+static void
+jpeg_python_skip_input_data (j_decompress_ptr cinfo, long num_bytes)
+{
+    struct jpeg_source_mgr *src = cinfo->src;
+    if (num_bytes <= 0) {
+        return;
+    }
+    while (num_bytes > (long)src->bytes_in_buffer) {
+        num_bytes -= (long)src->bytes_in_buffer;
+        (*src->fill_input_buffer)(cinfo);
+    }
+    src->next_input_byte += num_bytes;
+    src->bytes_in_buffer -= num_bytes;
+}
+
+
+static void
+jpeg_python_term_source (j_decompress_ptr cinfo)
+{
+}
+
+
+/** load_jpeg_fast_progressive_c:
+ *
+ * @filename: filename to load, in the system encoding, or NULL
+ * @read_func: if @filename is NULL, a Python read(size) callable
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * returns: a dict describing what was read.
+ *
+ * Read a JPEG progressively as 8bit RGBA, using the same get-buffer
+ * callback protocol as load_png_fast_progressive(). Only the current
+ * strip and one scanline of decoded pixels are held in memory, apart
+ * from libjpeg's own working state. The GIL is released while each
+ * strip is decoded.
+ *
+ * CMYK and YCCK files are rejected with a RuntimeError, because libjpeg
+ * can't convert them to RGB.
+ */
+
+static PyObject *
+load_jpeg_fast_progressive_c (char *filename,
+                              PyObject *read_func,
+                              PyObject *get_buffer_callback)
+{
+    struct jpeg_decompress_struct cinfo;
+    JPEGErrorState err_state;
+    JPEGPythonSource source;
+    PyObject *result = NULL;
+    PyObject * volatile obj = NULL;
+    JSAMPLE * volatile row = NULL;
+    FILE *fp = NULL;
+    JDIMENSION width, height;
+
+    if (filename) {
+        fp = fopen(filename, "rb");
+        if (!fp) {
+            PyErr_SetFromErrno(PyExc_IOError);
+            return NULL;
+        }
+    }
+    source.chunk = NULL;
+
+    cinfo.err = jpeg_std_error(&err_state.pub);
+    err_state.pub.error_exit = jpeg_error_exit_callback;
+    err_state.thread_state = NULL;
+    jpeg_create_decompress(&cinfo);
+    if (setjmp(err_state.setjmp_buffer)) {
+        goto cleanup;
+    }
+
+    if (fp) {
+        jpeg_stdio_src(&cinfo, fp);
+    }
+    else {
+        source.pub.init_source = jpeg_python_init_source;
+        source.pub.fill_input_buffer = jpeg_python_fill_input_buffer;
+        source.pub.skip_input_data = jpeg_python_skip_input_data;
+        source.pub.resync_to_restart = jpeg_resync_to_restart;
+        source.pub.term_source = jpeg_python_term_source;
+        source.pub.next_input_byte = NULL;
+        source.pub.bytes_in_buffer = 0;
+        source.read_func = read_func;
+        source.err_state = &err_state;
+        cinfo.src = &source.pub;
+    }
+
+    jpeg_read_header(&cinfo, TRUE);
+    if (cinfo.jpeg_color_space == JCS_CMYK
+        || cinfo.jpeg_color_space == JCS_YCCK)
+    {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "CMYK JPEG files are not supported");
+        goto cleanup;
+    }
+    cinfo.out_color_space = JCS_RGB;
+
+    // Multi-scan files are mostly decoded here.
+    err_state.thread_state = PyEval_SaveThread();
+    jpeg_start_decompress(&cinfo);
+    PyEval_RestoreThread(err_state.thread_state);
+    err_state.thread_state = NULL;
+
+    width = cinfo.output_width;
+    height = cinfo.output_height;
+    row = (JSAMPLE *)malloc(width * 3 * sizeof(JSAMPLE));
+    if (!row) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+
+    while (cinfo.output_scanline < height) {
+        // Invoke the callback to get a strip of memory to populate,
+        // as for load_png_fast_progressive().
+        obj = PyObject_CallFunction(get_buffer_callback, "ii", width, height);
+        if (!obj) {
+            PyErr_Format(PyExc_RuntimeError, "Get-buffer callback failed");
+            goto cleanup;
+        }
+        PyArrayObject *pyarr = (PyArrayObject *)obj;
+#ifdef HEAVY_DEBUG
+        assert(PyArray_NDIM(pyarr) == 3);
+        assert(PyArray_DIM(pyarr, 1) == width);
+        assert(PyArray_DIM(pyarr, 2) == 4);
+        assert(PyArray_TYPE(pyarr) == NPY_UINT8);
+        assert(PyArray_ISBEHAVED(pyarr));
+        assert(PyArray_STRIDE(pyarr, 1) == 4*sizeof(uint8_t));
+        assert(PyArray_STRIDE(pyarr, 2) ==   sizeof(uint8_t));
+#endif
+        const JDIMENSION rows = PyArray_DIM(pyarr, 0);
+        const JDIMENSION rows_left = height - cinfo.output_scanline;
+        if (rows > rows_left) {
+            PyErr_Format(PyExc_RuntimeError,
+                         "Attempt to read %d rows from the JPEG, "
+                         "but only %d are left",
+                         rows, rows_left);
+            goto cleanup;
+        }
+        const npy_intp rowstride = PyArray_STRIDE(pyarr, 0);
+        JSAMPLE *data = (JSAMPLE *)PyArray_DATA(pyarr);
+
+        // The strip stays referenced by obj until it's released below.
+        err_state.thread_state = PyEval_SaveThread();
+        for (JDIMENSION r = 0; r < rows; r++) {
+            JSAMPROW rowp = row;
+            jpeg_read_scanlines(&cinfo, &rowp, 1);
+            const JSAMPLE *src = row;
+            JSAMPLE *dst = data + r * rowstride;
+            for (JDIMENSION x = 0; x < width; x++) {
+                dst[0] = src[0];
+                dst[1] = src[1];
+                dst[2] = src[2];
+                dst[3] = 0xff;
+                dst += 4;
+                src += 3;
+            }
+        }
+        PyEval_RestoreThread(err_state.thread_state);
+        err_state.thread_state = NULL;
+        Py_DECREF(obj);
+        obj = NULL;
+    }
+
+    jpeg_finish_decompress(&cinfo);
+    result = Py_BuildValue("{s:i,s:i}", "width", width, "height", height);
+
+cleanup:
+    jpeg_destroy_decompress(&cinfo);
+    if (fp) {
+        fclose(fp);
+    }
+    free(row);
+    if (obj) {
+        Py_DECREF(obj);
+    }
+    Py_XDECREF(source.chunk);
+    return result;
+}
+
+
+PyObject *
+load_jpeg_fast_progressive (char *filename,
+                            PyObject *get_buffer_callback)
+{
+    return load_jpeg_fast_progressive_c(filename, NULL, get_buffer_callback);
+}
+
+
+PyObject *
+load_jpeg_fast_progressive_from_file (PyObject *file_obj,
+                                      PyObject *get_buffer_callback)
+{
+    PyObject *read_func = PyObject_GetAttrString(file_obj, "read");
+    if (!read_func) {
+        return NULL;
+    }
+    PyObject *result = load_jpeg_fast_progressive_c(NULL, read_func,
+                                                    get_buffer_callback);
+    Py_DECREF(read_func);
+    return result;
+}
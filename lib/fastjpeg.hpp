@@ -0,0 +1,51 @@
+// Fast JPEG loading and saving using scanlines
+// Copyright (C) 2015  MyPaint Development Team
+//
+// This program is free software; you can redistribute it and/or modify it
+// under the terms of the GNU General Public License as published by the Free
+// Software Foundation; either version 2 of the License, or (at your option)
+// any later version.
+//
+// This program is distributed in the hope that it will be useful, but WITHOUT
+// ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+// FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+// more details.
+//
+// You should have received a copy of the GNU General Public License along with
+// this program; if not, write to the Free Software Foundation, Inc., 51
+// Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#ifndef FASTJPEG_HPP
+#define FASTJPEG_HPP
+
+#include <Python.h>
+
+
+// Save a JPEG file progressively, obtaining strips to write using a
+// Python generator. The strips are the same 8-bit RGBU NumPy arrays as
+// for save_png_fast_progressive(), so only one strip is held in memory
+// at a time. The GIL is released while each strip is compressed.
+
+PyObject *
+save_jpeg_fast_progressive (char *filename,
+                            int w, int h,
+                            PyObject *data_generator,
+                            int quality);
+
+// Load a JPEG file progressively, a strip at a time, using the same
+// get-buffer callback protocol as load_png_fast_progressive(). Unlike
+// GdkPixbuf, this never makes a full-size copy of the decoded image.
+// Returns a dict with the image's "width" and "height".
+
+PyObject *
+load_jpeg_fast_progressive (char *filename,
+                            PyObject *get_buffer_callback);
+
+// Like load_jpeg_fast_progressive(), but reads from a Python file-like
+// object. The GIL is released while decoding, except for reads.
+
+PyObject *
+load_jpeg_fast_progressive_from_file (PyObject *file_obj,
+                                      PyObject *get_buffer_callback);
+
+#endif //FASTJPEG_HPP
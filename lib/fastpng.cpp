@@ -23,17 +23,37 @@
 #include "png.h"
 
 #include "lcms2.h"
+#include <zlib.h>
 #include <math.h>
+#include <stdlib.h>
+#include <string.h>
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #define NO_IMPORT_ARRAY
 #include <numpy/arrayobject.h>
 
 
+// Output state for the PNG writer. Used as libpng's error pointer, and
+// as its I/O pointer when encoding into memory.
+
+typedef struct {
+    PyThreadState *thread_state;  // non-NULL while the GIL is released
+    png_bytep data;               // in-memory output, or NULL
+    png_size_t size;
+    png_size_t capacity;
+} PNGWriteState;
+
+
 static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // Errors can happen while the GIL is released for compression.
+    PNGWriteState *state = (PNGWriteState *)png_get_error_ptr(png_save_ptr);
+    if (state && state->thread_state) {
+        PyEval_RestoreThread(state->thread_state);
+        state->thread_state = NULL;
+    }
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -48,6 +68,35 @@ png_write_error_callback (png_structp png_save_ptr,
 }
 
 
+static void
+png_write_memory_callback (png_structp png_save_ptr,
+                           png_bytep data,
+                           png_size_t length)
+{
+    PNGWriteState *state = (PNGWriteState *)png_get_io_ptr(png_save_ptr);
+    if (state->size + length > state->capacity) {
+        png_size_t capacity = state->capacity ? state->capacity : 65536;
+        while (capacity < state->size + length) {
+            capacity *= 2;
+        }
+        png_bytep data_new = (png_bytep)realloc(state->data, capacity);
+        if (!data_new) {
+            png_error(png_save_ptr, "out of memory");
+        }
+        state->data = data_new;
+        state->capacity = capacity;
+    }
+    memcpy(state->data + state->size, data, length);
+    state->size += length;
+}
+
+
+static void
+png_flush_memory_callback (png_structp png_save_ptr)
+{
+}
+
+
 typedef int (*GetScanlinesFunction) (int width,
                                      png_bytep *rows_out,
                                      int *rowstride_out,
@@ -124,10 +173,17 @@ python_scanline_next (int width,
 }
 
 
+// Writes to `filename`, or into `state`'s buffer if `filename` is NULL.
+// The GIL is released while each strip is filtered and compressed, so
+// several images can be encoded at once from different Python threads.
+
 static bool
-save_png_fast_progressive_c (char *filename, int w, int h,
+save_png_fast_progressive_c (char *filename,
+                             PNGWriteState *state,
+                             int w, int h,
                              bool has_alpha,
                              bool save_srgb_chunks,
+                             int compression,
                              GetScanlinesFunction next_scanline_func,
                              void *func_state)
 
@@ -142,15 +198,17 @@ save_png_fast_progressive_c (char *filename, int w, int h,
 
     bpc = 8;
 
-    fp = fopen(filename, "wb");
-    if (!fp) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s", filename);
-        goto cleanup;
+    if (filename) {
+        fp = fopen(filename, "wb");
+        if (!fp) {
+            PyErr_SetFromErrno(PyExc_IOError);
+            //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s", filename);
+            goto cleanup;
+        }
     }
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
-                                       (png_voidp)NULL,
+                                       (png_voidp)state,
                                        png_write_error_callback,
                                        NULL);
     if (!png_ptr) {
@@ -168,7 +226,14 @@ save_png_fast_progressive_c (char *filename, int w, int h,
         goto cleanup;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_write_fn(png_ptr, (png_voidp)state,
+                         png_write_memory_callback,
+                         png_flush_memory_callback);
+    }
 
     png_set_IHDR (png_ptr, info_ptr,
                   w, h, bpc,
@@ -187,13 +252,32 @@ save_png_fast_progressive_c (char *filename, int w, int h,
     // default (all filters enabled):                 1350ms, 3.4MB
     //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
     //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
-    png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
+    //png_set_filter(png_ptr, 0, PNG_FILTER_SUB);   // 760ms, 3.4MB
 
     //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
     //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
-    png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
+    //png_set_compression_level(png_ptr, 2); // 1.08s, 9.4MB
     //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
 
+    switch (compression) {
+    case FASTPNG_COMPRESSION_FAST:
+        // Run-length matching is much quicker than full deflate
+        // searches, and does well on "sub"-filtered flat areas.
+        png_set_filter(png_ptr, 0, PNG_FILTER_SUB);
+        png_set_compression_level(png_ptr, 1);
+        png_set_compression_strategy(png_ptr, Z_RLE);
+        break;
+    case FASTPNG_COMPRESSION_BEST:
+        png_set_filter(png_ptr, 0, PNG_ALL_FILTERS);
+        png_set_compression_level(png_ptr, Z_BEST_COMPRESSION);
+        break;
+    case FASTPNG_COMPRESSION_DEFAULT:
+    default:
+        png_set_filter(png_ptr, 0, PNG_FILTER_SUB);
+        png_set_compression_level(png_ptr, 2);
+        break;
+    }
+
     png_write_info(png_ptr, info_ptr);
 
     if (!has_alpha) {
@@ -205,15 +289,22 @@ save_png_fast_progressive_c (char *filename, int w, int h,
         png_bytep data = NULL;
         int rowstride = -1;
         const int rows = next_scanline_func(w, &data, &rowstride, func_state);
+        if (rows < 0) {
+            goto cleanup;  // exception raised by the generator
+        }
         assert(rows > 0);
         assert(rowstride > 0);
         assert(data);
         y += rows;
         png_bytep p = (png_bytep)data;
+        // The strip stays referenced by func_state until the next call.
+        state->thread_state = PyEval_SaveThread();
         for (int row=0; row<rows; row++) {
             png_write_row(png_ptr, p);
             p += rowstride;
         }
+        PyEval_RestoreThread(state->thread_state);
+        state->thread_state = NULL;
     }
     assert(y == h); // wrote same number of rows as trequested height
     assert(next_scanline_func(w, NULL, NULL, func_state) == 0); // iterator should be exhausted
@@ -236,16 +327,20 @@ save_png_fast_progressive (char *filename,
                            int w, int h,
                            bool has_alpha,
                            PyObject *data_generator,
-                           bool save_srgb_chunks)
+                           bool save_srgb_chunks,
+                           int compression)
 {
     PyObject * result = NULL;
     PythonScanlineGenerator state;
+    PNGWriteState write_state = {NULL, NULL, 0, 0};
     if (!python_scanline_init(&state, data_generator)) {
         return result;
     }
-    const bool success = save_png_fast_progressive_c(filename, w, h,
+    const bool success = save_png_fast_progressive_c(filename, &write_state,
+                                                     w, h,
                                                      has_alpha,
                                                      save_srgb_chunks,
+                                                     compression,
                                                      python_scanline_next,
                                                      (void *)&state);
     if (success) {
@@ -256,10 +351,55 @@ save_png_fast_progressive (char *filename,
 }
 
 
+PyObject *
+encode_png_fast_progressive (int w, int h,
+                             bool has_alpha,
+                             PyObject *data_generator,
+                             bool save_srgb_chunks,
+                             int compression)
+{
+    PyObject * result = NULL;
+    PythonScanlineGenerator state;
+    PNGWriteState write_state = {NULL, NULL, 0, 0};
+    if (!python_scanline_init(&state, data_generator)) {
+        return result;
+    }
+    const bool success = save_png_fast_progressive_c(NULL, &write_state,
+                                                     w, h,
+                                                     has_alpha,
+                                                     save_srgb_chunks,
+                                                     compression,
+                                                     python_scanline_next,
+                                                     (void *)&state);
+    if (success) {
+        result = PyString_FromStringAndSize((const char *)write_state.data,
+                                            write_state.size);
+    }
+    free(write_state.data);
+    python_scanline_finalize(&state);
+    return result;
+}
+
+
+// Input state for the PNG reader. Used as libpng's error pointer, and
+// as its I/O pointer when reading from a Python file-like object.
+
+typedef struct {
+    PyThreadState *thread_state;  // non-NULL while the GIL is released
+    PyObject *read_func;          // the file-like object's read(), or NULL
+} PNGReadState;
+
+
 static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+    // Errors can happen while the GIL is released for decompression.
+    PNGReadState *state = (PNGReadState *)png_get_error_ptr(png_read_ptr);
+    if (state && state->thread_state) {
+        PyEval_RestoreThread(state->thread_state);
+        state->thread_state = NULL;
+    }
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -276,6 +416,52 @@ png_read_error_callback (png_structp png_read_ptr,
 }
 
 
+static void
+png_read_python_callback (png_structp png_read_ptr,
+                          png_bytep data,
+                          png_size_t length)
+{
+    PNGReadState *state = (PNGReadState *)png_get_io_ptr(png_read_ptr);
+    // Rows are decoded with the GIL released, but read() needs it.
+    PyThreadState *thread_state = state->thread_state;
+    if (thread_state) {
+        PyEval_RestoreThread(thread_state);
+        state->thread_state = NULL;
+    }
+    png_size_t done = 0;
+    while (done < length) {
+        PyObject *chunk = PyObject_CallFunction(state->read_func, "n",
+                                                (Py_ssize_t)(length - done));
+        if (!chunk) {
+            break;
+        }
+        if (!PyString_Check(chunk)) {
+            PyErr_SetString(PyExc_TypeError, "read() must return a str");
+            Py_DECREF(chunk);
+            break;
+        }
+        png_size_t n = PyString_GET_SIZE(chunk);
+        if (n == 0) {
+            PyErr_SetString(PyExc_IOError, "Unexpected end of PNG data");
+            Py_DECREF(chunk);
+            break;
+        }
+        if (n > length - done) {
+            n = length - done;
+        }
+        memcpy(data + done, PyString_AS_STRING(chunk), n);
+        done += n;
+        Py_DECREF(chunk);
+    }
+    if (done < length) {
+        png_error(png_read_ptr, "Read Error");  // keeps the GIL
+    }
+    if (thread_state) {
+        state->thread_state = PyEval_SaveThread();
+    }
+}
+
+
 static const double PNG_gAMA_scale = 100000;
 static const double PNG_cHRM_scale = 100000;
 
@@ -288,9 +474,10 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
+/** load_png_fast_progressive_c:
  *
- * @filename: filename to load, in the system encoding
+ * @filename: filename to load, in the system encoding, or NULL
+ * @read_func: if @filename is NULL, a Python read(size) callable
  * @get_buffer_callback: a Python callable returning writeable arrays
  * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
  * returns: a dict of flags describing what was read.
@@ -304,12 +491,16 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
  * again until the full image has been processed. The buffer will be written
  * with 8-bit RGBA data
  *
+ * The GIL is released while each strip is decompressed and converted, so
+ * several images can be decoded at once from different Python threads.
+ *
  */
 
-PyObject *
-load_png_fast_progressive (char *filename,
-                           PyObject *get_buffer_callback,
-                           bool convert_to_srgb)
+static PyObject *
+load_png_fast_progressive_c (char *filename,
+                             PyObject *read_func,
+                             PyObject *get_buffer_callback,
+                             bool convert_to_srgb)
 {
     // Note: we are not using the method that libpng calls "Reading PNG
     // files progressively". That method would involve feeding the data
@@ -320,6 +511,7 @@ load_png_fast_progressive (char *filename,
     png_infop info_ptr = NULL;
     PyObject *result = NULL;
     FILE *fp = NULL;
+    PNGReadState read_state = {NULL, read_func};
     uint32_t width, height;
     uint32_t rows_left;
     png_byte color_type;
@@ -366,13 +558,16 @@ load_png_fast_progressive (char *filename,
 
     cmsSetLogErrorHandler(log_lcms2_error);
 
-    fp = fopen(filename, "rb");
-    if (!fp) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        goto cleanup;
+    if (filename) {
+        fp = fopen(filename, "rb");
+        if (!fp) {
+            PyErr_SetFromErrno(PyExc_IOError);
+            goto cleanup;
+        }
     }
 
-    png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
+    png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING,
+                                      (png_voidp)&read_state,
                                       png_read_error_callback, NULL);
     if (!png_ptr) {
         PyErr_SetString(PyExc_MemoryError, "png_create_write_struct() failed");
@@ -389,7 +584,13 @@ load_png_fast_progressive (char *filename,
         goto cleanup;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_read_fn(png_ptr, (png_voidp)&read_state,
+                        png_read_python_callback);
+    }
 
     png_read_info(png_ptr, info_ptr);
 
@@ -687,6 +888,8 @@ load_png_fast_progressive (char *filename,
         }
 
         // Populate the strip of memory with pixels decoded from the PNG stream
+        // The strip stays referenced by obj until it's released below.
+        read_state.thread_state = PyEval_SaveThread();
         png_read_rows(png_ptr, row_pointers, NULL, rows);
         rows_left -= rows;
 
@@ -716,6 +919,8 @@ load_png_fast_progressive (char *filename,
             }
             free(input_buffer);
         }
+        PyEval_RestoreThread(read_state.thread_state);
+        read_state.thread_state = NULL;
         free(row_pointers);
         Py_DECREF(obj);
     } //while (rows_left)
@@ -750,3 +955,31 @@ cleanup:
 
     return result;
 }
+
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback,
+                           bool convert_to_srgb)
+{
+    return load_png_fast_progressive_c(filename, NULL,
+                                       get_buffer_callback,
+                                       convert_to_srgb);
+}
+
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file_obj,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb)
+{
+    PyObject *read_func = PyObject_GetAttrString(file_obj, "read");
+    if (!read_func) {
+        return NULL;
+    }
+    PyObject *result = load_png_fast_progressive_c(NULL, read_func,
+                                                   get_buffer_callback,
+                                                   convert_to_srgb);
+    Py_DECREF(read_func);
+    return result;
+}
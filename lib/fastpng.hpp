@@ -21,6 +21,15 @@
 #include <Python.h>
 
 
+// Compression profiles for the PNG writers: speed versus file size.
+
+enum FastPNGCompression {
+    FASTPNG_COMPRESSION_FAST = 0,     // zlib level 1, RLE, "sub" filter
+    FASTPNG_COMPRESSION_DEFAULT = 1,  // zlib level 2, "sub" filter
+    FASTPNG_COMPRESSION_BEST = 2      // zlib level 9, adaptive filtering
+};
+
+
 // Save a PNG file progressively, obtaining strips to write using a
 // Python generator.
 
@@ -29,7 +38,20 @@ save_png_fast_progressive (char *filename,
                            int w, int h,
                            bool has_alpha,
                            PyObject *data_generator,
-                           bool save_srgb_chunks);
+                           bool save_srgb_chunks,
+                           int compression=FASTPNG_COMPRESSION_DEFAULT);
+
+
+// Like save_png_fast_progressive(), but returns the encoded PNG as a
+// string instead of writing a file. The GIL is released during
+// compression, so several images can be encoded in parallel threads.
+
+PyObject *
+encode_png_fast_progressive (int w, int h,
+                             bool has_alpha,
+                             PyObject *data_generator,
+                             bool save_srgb_chunks,
+                             int compression=FASTPNG_COMPRESSION_DEFAULT);
 
 
 // Load a file progressively as 8-bit RGBA, obtaining memory in NumPy
@@ -40,4 +62,14 @@ load_png_fast_progressive (char *filename,
                            PyObject *get_buffer_callback,
                            bool convert_to_srgb);
 
+
+// Like load_png_fast_progressive(), but reading the PNG data from a
+// Python file-like object, such as a member of a zipfile. The GIL is
+// released during decompression, except while reading.
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file_obj,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb);
+
 #endif //FASTPNG_HPP
@@ -175,13 +175,10 @@ def freedesktop_thumbnail(filename, pixbuf=None):
 
     directory = os.path.join(base_directory, 'normal')
     tb_filename_normal = os.path.join(directory, file_hash) + '.png'
-
-    if not os.path.exists(directory):
-        os.makedirs(directory, 0700)
+    _makedirs_if_missing(directory, 0700)
     directory = os.path.join(base_directory, 'large')
     tb_filename_large = os.path.join(directory, file_hash) + '.png'
-    if not os.path.exists(directory):
-        os.makedirs(directory, 0700)
+    _makedirs_if_missing(directory, 0700)
 
     file_mtime = str(int(os.stat(filename).st_mtime))
 
@@ -237,6 +234,17 @@ def freedesktop_thumbnail(filename, pixbuf=None):
     return pixbuf
 
 
+def _makedirs_if_missing(directory, mode):
+    """Creates a directory, tolerating other threads doing the same"""
+    if os.path.isdir(directory):
+        return
+    try:
+        os.makedirs(directory, mode)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
 def get_pixbuf(filename):
     """Returns a thumbnail pixbuf from a file.
     """
@@ -0,0 +1,735 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Crash recovery journal
+
+Saving a big document takes seconds, so it can't be done after every
+stroke. Instead, a document's work is journaled to its tempdir as it
+happens, cheaply enough to keep up with painting.
+
+The journal is an append-only file of small records, which hold plain
+data only: numbers, strings, and tuples, lists and dicts of them. The
+first record describes the base state, which is one of:
+
+* a blank document,
+* a file which the document was loaded from or saved to, or
+* a checkpoint written into the tempdir in the working-file format.
+
+The records after it describe the commands done since then. Brushwork
+commands record their `lib.stroke.Stroke` data: the brush settings, the
+brush state, and the event array. Other commands record the parameters
+needed to construct them again. There are also records for undos,
+redos, and in-place updates of the last command. Each record takes a
+few KiB at most, written sequentially.
+
+After a crash, replaying the journal onto the base state rebuilds the
+document. Journals are only read from private document tempdirs which
+belong to the current user.
+
+Some things can't be journaled cheaply. Examples are commands whose
+`get_journal_params()` returns None, undos reaching back past the base
+state, and background changes. For these, the journal writes a fresh
+checkpoint instead and starts over. It also does this when it grows
+past `CHECKPOINT_SIZE`, which bounds the time taken to replay it.
+
+"""
+
+## Imports
+
+import os
+import sys
+import stat
+import struct
+import zlib
+import time
+import shutil
+import tempfile
+import weakref
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+from gettext import gettext as _
+
+import lib.brush
+import lib.command
+import lib.workingfile
+from lib.errors import FileHandlingError
+
+
+## Module constants
+
+#: Name of the directory holding the journal, within the doc tempdir
+JOURNAL_DIRNAME = u"recovery"
+
+#: Name of the journal file itself
+JOURNAL_FILENAME = u"journal.log"
+
+#: Journal size in bytes which triggers a fresh checkpoint
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+
+#: zlib compression level for records
+COMPRESSION_LEVEL = 1
+
+_MAGIC = "MYPJRNL2"
+
+# Record header: kind, payload length, payload crc32
+_RECORD_HEADER = struct.Struct("<4sIi")
+
+# Length prefix for the JSON and byte strings within a payload
+_LENGTH = struct.Struct("<I")
+
+# Record kinds
+_BASE = "BASE"
+_DO = "DO  "
+_UNDO = "UNDO"
+_REDO = "REDO"
+_UPDATE = "UPDT"
+_RETRACE = "RTRC"
+
+# Options for loading a base file which affect the loaded data
+_LOAD_OPTIONS = ("convert_to_srgb",)
+
+# Kinds of base state
+_BASE_BLANK = "blank"
+_BASE_FILE = "file"
+_BASE_CHECKPOINT = "checkpoint"
+
+
+## Class defs
+
+class RecoveryJournal (object):
+    """Journals a document's commands to its tempdir
+
+    A document with a journal calls the ``command_*()`` methods as its
+    command stack changes, and the ``reset_*()`` methods when it's
+    cleared, loaded or saved. Records are flushed as they're written,
+    so the journal survives the application crashing.
+    """
+
+    def __init__(self, doc):
+        """Initialize, for a document (see lib.document.Document)"""
+        super(RecoveryJournal, self).__init__()
+        self._doc = weakref.proxy(doc)
+        self._tempdir = None
+        self._dir = None
+        self._fp = None
+        self._size = 0
+        self._base = None
+        self._paused = 0
+        self._checkpoint_serial = 0
+        self._checkpoint_file = None
+        self._last_brush_settings = None
+        # Commands since the base state, which undo/redo can be replayed on
+        self._undoable = 0
+        self._redoable = 0
+        layers = doc.layer_stack
+        layers.background_changed += self._invalidate_cb
+        layers.background_visible_changed += self._invalidate_cb
+
+    @property
+    def dirname(self):
+        """Directory holding the journal, or None"""
+        return self._dir
+
+    ## Base states
+
+    def reset_blank(self, tempdir):
+        """Restart the journal for a newly cleared document
+
+        :param unicode tempdir: the document's new tempdir, or None
+        """
+        self._start(tempdir, dict(kind=_BASE_BLANK))
+
+    def reset_to_file(self, filename, **kwargs):
+        """Restart the journal after loading from or saving to a file
+
+        :param unicode filename: the file
+        :param \*\*kwargs: options the file was loaded with
+        """
+        filename = os.path.abspath(filename)
+        options = dict((k, v) for (k, v) in kwargs.iteritems()
+                       if k in _LOAD_OPTIONS)
+        self._start(self._tempdir, dict(
+            kind=_BASE_FILE,
+            filename=filename,
+            file_key=_get_file_key(filename),
+            options=options,
+        ))
+
+    def invalidate(self):
+        """Note that the document has changed in an unjournaled way
+
+        The next change to the document writes a checkpoint instead of
+        a record.
+        """
+        self._base = None
+
+    def _invalidate_cb(self, *args):
+        self.invalidate()
+
+    def pause(self):
+        """Stop journaling commands until `resume()` is called
+
+        Calls can be nested. Resetting the base state still works while
+        paused.
+        """
+        self._paused += 1
+
+    def resume(self):
+        """Resume journaling commands after `pause()`"""
+        assert self._paused > 0
+        self._paused -= 1
+
+    def close(self):
+        """Stop journaling, and close the journal file"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._tempdir = None
+        self._dir = None
+        self._base = None
+
+    def _start(self, tempdir, base):
+        self.close()
+        if tempdir is None:
+            return
+        self._tempdir = tempdir
+        self._dir = os.path.join(tempdir, JOURNAL_DIRNAME)
+        if not os.path.isdir(self._dir):
+            os.mkdir(self._dir)
+        # Nothing is written until there's something to journal
+        self._base = base
+        self._undoable = 0
+        self._redoable = 0
+
+    ## Command stack changes
+
+    def command_done(self, cmd, current_path):
+        """Journal a command which was just done
+
+        :param lib.command.Command cmd: the command
+        :param tuple current_path: current layer path before it was done
+        """
+        if not self._journaling:
+            return
+        params = cmd.get_journal_params()
+        if params is None or self._checkpoint_due:
+            self.checkpoint()
+            return
+        name = cmd.__class__.__name__
+        if _get_command_class(name) is not cmd.__class__:
+            self.checkpoint()
+            return
+        record = dict(
+            command=name,
+            current_path=current_path,
+            params=params,
+        )
+        if not self._write_record(_DO, record):
+            self.checkpoint()
+            return
+        self._undoable += 1
+        self._redoable = 0
+
+    def commands_undone(self, count):
+        """Journal an undo, which popped `count` commands"""
+        if not self._journaling or count == 0:
+            return
+        if count > self._undoable or self._checkpoint_due:
+            self.checkpoint()
+            return
+        self._write_record(_UNDO, None)
+        self._undoable -= count
+        self._redoable += count
+
+    def commands_redone(self, count):
+        """Journal a redo, which pushed `count` commands"""
+        if not self._journaling or count == 0:
+            return
+        if count > self._redoable or self._checkpoint_due:
+            self.checkpoint()
+            return
+        self._write_record(_REDO, None)
+        self._undoable += count
+        self._redoable -= count
+
+    def command_updated(self, kwargs):
+        """Journal an update of the last command (``update(**kwargs)``)"""
+        if not self._journaling:
+            return
+        if self._undoable == 0 or self._checkpoint_due:
+            self.checkpoint()
+            return
+        if not self._write_record(_UPDATE, kwargs):
+            self.checkpoint()
+
+    def stroke_retraced(self, brushinfo):
+        """Journal a retrace of the last brushwork with a new brush"""
+        if not self._journaling:
+            return
+        if self._undoable == 0 or self._checkpoint_due:
+            self.checkpoint()
+            return
+        self._write_record(_RETRACE, dict(
+            brush_settings=brushinfo.save_to_string(),
+        ))
+
+    @property
+    def _journaling(self):
+        return self._dir is not None and not self._paused
+
+    @property
+    def _checkpoint_due(self):
+        return self._base is None or self._size > CHECKPOINT_SIZE
+
+    ## Writing
+
+    def checkpoint(self):
+        """Write a checkpoint, and restart the journal from it"""
+        if not self._journaling:
+            return
+        t0 = time.time()
+        self._checkpoint_serial += 1
+        name = u"checkpoint-%d%s" % (self._checkpoint_serial,
+                                     lib.workingfile.FILE_EXTENSION)
+        self._doc._save_journal_checkpoint(os.path.join(self._dir, name))
+        old_file = self._checkpoint_file
+        self._checkpoint_file = name
+        layers = self._doc.layer_stack
+        self._base = dict(
+            kind=_BASE_CHECKPOINT,
+            filename=name,
+            current_path=layers.current_path,
+            unsaved_painting_time=self._doc.unsaved_painting_time,
+        )
+        self._undoable = 0
+        self._redoable = 0
+        # The new journal replaces the old one in one step.
+        self._open(os.path.join(self._dir, JOURNAL_FILENAME + u".new"))
+        new_path = self._fp.name
+        self._fp.close()
+        self._fp = None
+        journal_path = os.path.join(self._dir, JOURNAL_FILENAME)
+        try:
+            os.rename(new_path, journal_path)
+        except OSError:
+            os.remove(journal_path)  # normal under Windows
+            os.rename(new_path, journal_path)
+        self._fp = open(journal_path, "ab")
+        if old_file is not None:
+            _remove_file(os.path.join(self._dir, old_file))
+        logger.info("%.3fs writing recovery checkpoint %r",
+                    time.time() - t0, name)
+
+    def _open(self, path):
+        """Start a new journal file, writing the base record"""
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = open(path, "wb")
+        self._fp.write(_MAGIC)
+        self._size = len(_MAGIC)
+        self._last_brush_settings = None
+        base = dict(self._base)
+        base["pid"] = os.getpid()
+        base["time"] = time.time()
+        self._write(_BASE, base)
+
+    def _write_record(self, kind, payload):
+        """Append a record, unless its payload isn't plain data"""
+        if self._fp is None:
+            self._open(os.path.join(self._dir, JOURNAL_FILENAME))
+        try:
+            self._write(kind, payload)
+        except (TypeError, ValueError):
+            logger.debug("Cannot journal %r record %r", kind, payload)
+            return False
+        return True
+
+    def _write(self, kind, payload):
+        """Append a record, and flush it to the OS"""
+        t0 = time.time()
+        if isinstance(payload, dict):
+            payload = self._dedup_brush_settings(payload)
+        data = _encode_payload(payload)
+        data = zlib.compress(data, COMPRESSION_LEVEL)
+        header = _RECORD_HEADER.pack(kind, len(data), zlib.crc32(data))
+        self._fp.write(header + data)
+        self._fp.flush()
+        self._size += len(header) + len(data)
+        logger.debug("%.3fs journaling %r (%d bytes)",
+                     time.time() - t0, kind, len(data))
+
+    def _dedup_brush_settings(self, payload):
+        """Don't repeat the brush settings while they don't change"""
+        for d in (payload, payload.get("params")):
+            if not isinstance(d, dict) or "brush_settings" not in d:
+                continue
+            settings = d["brush_settings"]
+            if settings == self._last_brush_settings:
+                d = dict(d)
+                d["brush_settings"] = None
+            self._last_brush_settings = settings
+            if "params" in payload:
+                payload = dict(payload, params=d)
+            else:
+                payload = d
+        return payload
+
+    ## Replaying
+
+    def replay(self, dirname, feedback_cb=None):
+        """Rebuild the document from another journal
+
+        :param unicode dirname: the journal's directory
+        :param callable feedback_cb: called after each record
+        :returns: the number of records replayed
+        :raises lib.errors.FileHandlingError: if the base is unusable
+
+        Replay stops at the first record which is incomplete, or which
+        can't be applied. Afterwards this journal is restarted from a
+        checkpoint of the recovered document.
+        """
+        doc = self._doc
+        records = read_journal(os.path.join(dirname, JOURNAL_FILENAME))
+        try:
+            kind, base = next(records)
+        except StopIteration:
+            raise FileHandlingError(_("The recovery journal is empty"))
+        t0 = time.time()
+        count = 0
+        self.pause()
+        try:
+            _load_base(doc, dirname, base)
+            for kind, payload in records:
+                try:
+                    _replay_record(doc, kind, payload)
+                except Exception:
+                    logger.exception("Failed to replay %r record", kind)
+                    break
+                count += 1
+                if feedback_cb:
+                    feedback_cb()
+        finally:
+            self.resume()
+        logger.info("%.3fs replaying %d journal records from %r",
+                    time.time() - t0, count, dirname)
+        self._base = None
+        self.checkpoint()
+        return count
+
+
+## Reading journals
+
+def read_journal(path):
+    """Iterates over the records of a journal file: (kind, payload)
+
+    Reading stops quietly at a truncated or damaged record, which is
+    usually the last one written before a crash.
+
+    >>> d = tempfile.mkdtemp()
+    >>> path = os.path.join(d, "test.log")
+    >>> fp = open(path, "wb")
+    >>> fp.write(_MAGIC)
+    >>> for kind, payload in [(_BASE, {"kind": _BASE_BLANK}), (_UNDO, None)]:
+    ...     data = zlib.compress(_encode_payload(payload))
+    ...     header = _RECORD_HEADER.pack(kind, len(data), zlib.crc32(data))
+    ...     fp.write(header + data)
+    >>> fp.write("trunc")
+    >>> fp.close()
+    >>> [k for (k, p) in read_journal(path)]
+    ['BASE', 'UNDO']
+    >>> shutil.rmtree(d)
+
+    """
+    last_brush_settings = None
+    with open(path, "rb") as fp:
+        if fp.read(len(_MAGIC)) != _MAGIC:
+            raise FileHandlingError(_("Not a recovery journal: %r") % path)
+        while True:
+            header = fp.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            kind, length, crc = _RECORD_HEADER.unpack(header)
+            data = fp.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                logger.warning("Journal %r ends with a damaged record", path)
+                return
+            try:
+                payload = _decode_payload(zlib.decompress(data))
+            except (ValueError, TypeError, KeyError, IndexError,
+                    struct.error, zlib.error):
+                logger.warning("Journal %r has an unreadable record", path)
+                return
+            # Restore brush settings which weren't repeated
+            if isinstance(payload, dict):
+                for d in (payload, payload.get("params")):
+                    if not isinstance(d, dict) or "brush_settings" not in d:
+                        continue
+                    if d["brush_settings"] is None:
+                        d["brush_settings"] = last_brush_settings
+                    last_brush_settings = d["brush_settings"]
+            yield (kind, payload)
+
+
+def find_recoverable(stub_name, tempdir=None):
+    """Finds journals left behind by crashed sessions
+
+    :param unicode stub_name: suffix of the documents' tempdir names
+    :param unicode tempdir: where to look (default: the system tempdir)
+    :returns: the journals' directories, most recent first
+    :rtype: list
+
+    Only document tempdirs are searched, and only those which belong to
+    the current user and can't be written to by anyone else. Journals
+    written by processes which are still running are skipped.
+    """
+    if tempdir is None:
+        tempdir = tempfile.gettempdir()
+        if not isinstance(tempdir, unicode):
+            tempdir = tempdir.decode(sys.getfilesystemencoding())
+    found = []
+    try:
+        names = os.listdir(tempdir)
+    except OSError:
+        return []
+    for name in names:
+        if not name.endswith(stub_name):
+            continue
+        if not _is_private_dir(os.path.join(tempdir, name)):
+            continue
+        dirname = os.path.join(tempdir, name, JOURNAL_DIRNAME)
+        path = os.path.join(dirname, JOURNAL_FILENAME)
+        if not os.path.isfile(path):
+            continue
+        try:
+            kind, base = next(read_journal(path))
+        except Exception:
+            continue
+        if kind != _BASE or _pid_is_running(base.get("pid")):
+            continue
+        found.append((os.path.getmtime(path), dirname))
+    found.sort(reverse=True)
+    return [dirname for (mtime, dirname) in found]
+
+
+def discard(dirname):
+    """Removes a crashed session's journal, and its document tempdir"""
+    tempdir = os.path.dirname(dirname)
+    if not _is_private_dir(tempdir):
+        logger.warning("Not removing %r: it isn't a private dir", tempdir)
+        return
+    if os.name == "nt":
+        for name in os.listdir(dirname):
+            lib.workingfile.release_file(os.path.join(dirname, name))
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+
+## Helper functions
+
+def _load_base(doc, dirname, base):
+    """Loads the base state recorded at the start of a journal"""
+    kind = base["kind"]
+    if kind == _BASE_BLANK:
+        doc.clear()
+    elif kind == _BASE_FILE:
+        filename = base["filename"]
+        if _get_file_key(filename) != base["file_key"]:
+            raise FileHandlingError(
+                _("The file %r has changed since the journal was written")
+                % filename,
+            )
+        doc.load(filename, **base["options"])
+    elif kind == _BASE_CHECKPOINT:
+        doc.load(os.path.join(dirname, base["filename"]))
+        _set_current_path(doc, base["current_path"])
+        doc.unsaved_painting_time = base["unsaved_painting_time"]
+    else:
+        raise FileHandlingError(_("Unknown journal base %r") % kind)
+
+
+def _replay_record(doc, kind, payload):
+    """Applies one journal record to a document"""
+    if kind == _DO:
+        cls = _get_command_class(payload["command"])
+        if cls is None:
+            raise ValueError("Unknown command %r" % (payload["command"],))
+        _set_current_path(doc, payload["current_path"])
+        cmd = cls.new_from_journal(doc, payload["params"])
+        doc.do(cmd)
+    elif kind == _UNDO:
+        doc.undo()
+    elif kind == _REDO:
+        doc.redo()
+    elif kind == _UPDATE:
+        doc.update_last_command(**payload)
+    elif kind == _RETRACE:
+        brushinfo = lib.brush.BrushInfo(payload["brush_settings"])
+        doc.redo_last_stroke_with_different_brush(brushinfo)
+    else:
+        raise ValueError("Unknown journal record %r" % (kind,))
+
+
+def _get_command_class(name):
+    """The journaled command class with a given name, or None"""
+    cls = getattr(lib.command, name, None)
+    if isinstance(cls, type) and issubclass(cls, lib.command.Command):
+        return cls
+    return None
+
+
+def _encode_payload(payload):
+    """Encodes a record's payload as plain data
+
+    :param payload: numbers, strings, and tuples, lists or dicts of them
+    :rtype: str
+    :raises TypeError: if the payload holds anything else
+
+    The structure is written as JSON. Byte strings, like stroke data,
+    are appended after it as they are.
+
+    >>> p = {"a": (1, 2.5, u"b"), "c": [None, True, "d"]}
+    >>> _decode_payload(_encode_payload(p)) == p
+    True
+    """
+    blobs = []
+    text = json.dumps(_to_json(payload, blobs), separators=(",", ":"))
+    parts = [_LENGTH.pack(len(text)), text]
+    for blob in blobs:
+        parts.append(_LENGTH.pack(len(blob)))
+        parts.append(blob)
+    return "".join(parts)
+
+
+def _decode_payload(data):
+    """Decodes a payload encoded by `_encode_payload()`"""
+    offset = _LENGTH.size
+    (length,) = _LENGTH.unpack_from(data, 0)
+    text = data[offset:offset+length]
+    offset += length
+    blobs = []
+    while offset < len(data):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        blob = data[offset:offset+length]
+        if len(blob) < length:
+            raise ValueError("Truncated payload")
+        blobs.append(blob)
+        offset += length
+    return _from_json(json.loads(text), blobs)
+
+
+def _to_json(obj, blobs):
+    """Converts plain data to JSON types, with tagged objects
+
+    Lists are JSON arrays. Everything else which JSON can't represent
+    exactly is a single-key JSON object: tuples, dicts, and byte strings
+    (which become references into `blobs`).
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float, unicode)):
+        return obj
+    elif isinstance(obj, str):
+        blobs.append(obj)
+        return {"s": len(blobs) - 1}
+    elif isinstance(obj, list):
+        return [_to_json(v, blobs) for v in obj]
+    elif isinstance(obj, tuple):
+        return {"t": [_to_json(v, blobs) for v in obj]}
+    elif isinstance(obj, dict):
+        return {"d": [[_to_json(k, blobs), _to_json(v, blobs)]
+                      for (k, v) in obj.iteritems()]}
+    raise TypeError("Cannot journal %r" % (obj,))
+
+
+def _from_json(obj, blobs):
+    """Converts the output of `_to_json()` back"""
+    if isinstance(obj, list):
+        return [_from_json(v, blobs) for v in obj]
+    elif not isinstance(obj, dict):
+        return obj
+    elif "s" in obj:
+        return blobs[obj["s"]]
+    elif "t" in obj:
+        return tuple(_from_json(v, blobs) for v in obj["t"])
+    elif "d" in obj:
+        return dict((_from_json(k, blobs), _from_json(v, blobs))
+                    for (k, v) in obj["d"])
+    raise ValueError("Unknown journal data %r" % (obj,))
+
+
+def _is_private_dir(path):
+    """Whether a dir is only the current user's, so its files are too
+
+    Journals are read, and removed, only from private dirs, so other
+    users can't plant or delete them.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if os.name == "nt":
+        return True  # the tempdir is per-user
+    return st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def _set_current_path(doc, path):
+    layers = doc.layer_stack
+    if path and layers.deepget(path) is not None:
+        layers.current_path = path
+
+
+def _get_file_key(filename):
+    """Identifies a version of a file by its size and mtime"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+def _remove_file(path):
+    if os.name == "nt":
+        lib.workingfile.release_file(path)
+    try:
+        os.remove(path)
+    except OSError as err:
+        logger.warning("Cannot remove %r: %r", path, err)
+
+
+def _pid_is_running(pid):
+    """Whether a process with the given ID is running (best guess)"""
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == 1  # EPERM: exists, but isn't ours
+    return True
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
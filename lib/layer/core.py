@@ -106,6 +106,8 @@ class LayerBase (object):
         self._root_ref = None  # or a weakref to the root
         #: True if the layer was marked as selected when loaded.
         self.initially_selected = False
+        #: Incremented whenever the layer's content changes.
+        self._content_generation = 0
 
     @classmethod
     def new_from_openraster(cls, orazip, elem, tempdir, feedback_cb,
@@ -340,8 +342,9 @@ class LayerBase (object):
         tree structure, the root's `layer_content_changed()` event
         method will be invoked with this layer and the supplied
         arguments. This reflects a region of pixels in the document
-        changing.
+        changing. The layer's content generation is advanced too.
         """
+        self._content_generation += 1
         root = self.root
         if root is not None:
             root.layer_content_changed(self, *args)
@@ -594,6 +597,25 @@ class LayerBase (object):
         """
         pass
 
+    def add_tile_ops(self, ops, dst_has_alpha, tx, ty, mipmap_level=0,
+                     layers=None, previewing=None, **kwargs):
+        """Appends the ops for compositing a tile's data to a list
+
+        :param ops: list of ``(src, mode, opacity)`` tuples to extend
+        :type ops: list
+
+        The other parameters are as for `composite_tile()`. The ops are
+        for `lib.mypaintlib.tile_combine_ops()`: each ``src`` is a
+        15-bit RGBA tile array, or a nested list of ops for an isolated
+        group; ``mode`` is a CombineMode constant, and ``opacity`` is a
+        float. Applying the appended ops in order to a
+        tile must have the same effect as calling `composite_tile()` on
+        it.
+
+        The base implementation does nothing.
+        """
+        pass
+
     def render_as_pixbuf(self, *rect, **kwargs):
         """Renders this layer as a pixbuf
 
@@ -671,7 +693,8 @@ class LayerBase (object):
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the layer's data into an open OpenRaster ZipFile
 
-        :param orazip: a `zipfile.ZipFile` open for write
+        :param orazip: the OpenRaster file being written
+        :type orazip: lib.zipwriter.OrderedZipWriter
         :param tmpdir: path to a temp dir, removed after the save
         :param path: Unique path of the layer, for encoding in filenames
         :type path: tuple of ints
@@ -696,6 +719,9 @@ class LayerBase (object):
 
         More than one file may be written to the zipfile. The etree
         element returned should describe everything that was written.
+        Expensive encoding such as PNG compression should be handed to
+        the writer's `writestr_deferred()` so that it can happen in
+        parallel with the rest of the save.
 
         Paths must be unique sequences of ints, but are not necessarily
         valid RootLayerStack paths. It's faked for the normally
@@ -33,6 +33,8 @@ import lib.strokemap
 import lib.helpers as helpers
 import lib.fileutils
 import lib.pixbuf
+import lib.workingfile
+from lib.errors import FileHandlingError
 from consts import *
 import core
 import lib.layer.error
@@ -90,6 +92,11 @@ class SurfaceBackedLayer (core.LayerBase):
         else:
             self._surface = surface
 
+        # Entries in the last ORA file saved or loaded which hold this
+        # layer's data: {role: (archive_id, generation, signature,
+        # storepath, origin)}. See _copy_unchanged_ora_entry().
+        self._ora_entries = {}
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -118,10 +125,13 @@ class SurfaceBackedLayer (core.LayerBase):
     ## Loading
 
     def load_from_openraster(self, orazip, elem, tempdir, feedback_cb,
-                             x=0, y=0, extract_and_keep=False, **kwargs):
+                             x=0, y=0, extract_and_keep=False,
+                             deferred_loader=None, **kwargs):
         """Loads layer flags and bitmap/surface data from a .ora zipfile
 
         :param extract_and_keep: Set to true to extract and keep a copy
+        :param deferred_loader: Hand decoding the data to this, if
+          possible. See `lib.layer.loading`.
 
         The normal behaviour is to load the data file directly from `orazip`
         without using a temporary file.  If `extract_and_keep` is set, an
@@ -167,35 +177,101 @@ class SurfaceBackedLayer (core.LayerBase):
             orazip.extract(src, path=tempdir)
             tmp_filename = os.path.join(tempdir, src)
             self.load_surface_from_pixbuf_file(tmp_filename, x, y, feedback_cb)
+        elif deferred_loader and deferred_loader.defer(self, src, x, y):
+            logger.debug("Deferred decoding %r", src)
         else:
-            pixbuf = lib.pixbuf.load_from_zipfile(
-                datazip=orazip,
-                filename=src,
-                feedback_cb=feedback_cb,
-            )
-            self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
+            self._load_surface_from_ora_entry(orazip, src, x, y, feedback_cb)
         t1 = time.time()
         logger.debug("Loaded %r successfully", self.__class__.__name__)
         logger.debug("Spent %.3fs loading and converting %r", t1 - t0, src)
 
+    def _load_surface_from_ora_entry(self, orazip, src, x, y,
+                                     feedback_cb=None):
+        """Internal: loads the surface from a PNG in an open .ora zipfile
+
+        Only the surface is affected: any strokemap is left alone.
+        """
+        surface = self._decode_ora_entry(orazip, src, x, y, feedback_cb)
+        self._load_surface_from_decoded_ora_entry(surface, orazip.filename,
+                                                  src, x, y)
+
+    @staticmethod
+    def _decode_ora_entry(orazip, src, x, y, feedback_cb=None):
+        """Internal: decodes a PNG in an open .ora zipfile to a new surface
+
+        The PNG is decoded straight into tiles, a strip at a time. Like
+        GdkPixbuf, this applies no colour management to the data. PNGs
+        which the fast loader can't handle, such as interlaced ones, are
+        loaded via GdkPixbuf instead.
+
+        This can be called from worker threads, as long as each thread
+        uses its own `orazip`, and `feedback_cb` is None.
+        """
+        try:
+            fp = orazip.open(src)
+        except KeyError:
+            # Bad zip files from old GIMP ORA plugins: see lib.pixbuf
+            fp = orazip.open(src.encode("utf-8"))
+        surface = tiledsurface.Surface()
+        try:
+            surface.load_from_png_stream(fp, x, y, feedback_cb,
+                                         convert_to_srgb=False)
+            return surface
+        except FileHandlingError as ex:
+            logger.warning("Fast PNG loader failed for %r (%s), "
+                           "retrying with GdkPixbuf", src, ex)
+        finally:
+            fp.close()
+        pixbuf = lib.pixbuf.load_from_zipfile(
+            datazip=orazip,
+            filename=src,
+            feedback_cb=feedback_cb,
+        )
+        surface = tiledsurface.Surface()
+        surface.load_from_numpy(helpers.gdkpixbuf2numpy(pixbuf), x, y)
+        return surface
+
+    def _load_surface_from_decoded_ora_entry(self, surface, archive_id,
+                                             src, x, y):
+        """Internal: loads the surface from a decoded .ora entry"""
+        self._surface.load_from_surface(surface)
+        self._record_ora_entry(archive_id, "layer", None, src, (x, y))
+
+    def _load_surface_from_mapped_tiles(self, tiles, archive_id, src):
+        """Internal: loads the surface from a working file's tile store
+
+        See `lib.workingfile`. The tiles are decompressed on demand.
+        """
+        self._surface.load_tiles(tiles)
+        role = "layer" + lib.workingfile.TILES_SUFFIX
+        self._record_ora_entry(archive_id, role, None, src, (0, 0))
+
     def load_surface_from_pixbuf_file(self, filename, x=0, y=0,
                                       feedback_cb=None):
-        """Loads the layer's surface from any file which GdkPixbuf can open"""
+        """Loads the layer's surface from any file which GdkPixbuf can open
+
+        The image is converted to tiles a strip at a time while it's
+        being decoded, so big images don't need a second full-size copy
+        in memory. See `lib.tiledsurface.Surface.load_from_pixbuf_stream()`.
+        """
+        surface = tiledsurface.Surface()
         fp = open(filename, 'rb')
         try:
-            pixbuf = lib.pixbuf.load_from_stream(fp, feedback_cb)
+            bbox = surface.load_from_pixbuf_stream(fp, x, y, feedback_cb)
         except Exception as err:
             if self.FALLBACK_CONTENT is None:
                 raise lib.layer.error.LoadingFailed(
                     "Failed to load %r: %r" % (filename, str(err)),
                 )
             logger.info("Using fallback content for %r", filename)
-            pixbuf = lib.pixbuf.load_from_stream(
-                StringIO(self.FALLBACK_CONTENT),
+            surface = tiledsurface.Surface()
+            bbox = surface.load_from_pixbuf_stream(
+                StringIO(self.FALLBACK_CONTENT), x, y,
             )
         finally:
             fp.close()
-        return self.load_surface_from_pixbuf(pixbuf, x, y)
+        self.load_from_surface(surface)
+        return bbox
 
     def load_surface_from_pixbuf(self, pixbuf, x=0, y=0):
         """Loads the layer's surface from a GdkPixbuf"""
@@ -291,6 +367,25 @@ class SurfaceBackedLayer (core.LayerBase):
             opacity=opacity, mode=mode
         )
 
+    def add_tile_ops(self, ops, dst_has_alpha, tx, ty, mipmap_level=0,
+                     layers=None, previewing=None, solo=None, **kwargs):
+        """Appends compositing ops for one tile, like composite_tile()"""
+        mode = self.mode
+        opacity = self.opacity
+        if layers is not None:
+            if self not in layers:
+                return
+        elif not self.visible:
+            return
+        if self is previewing:  # not solo though - we show the effect of that
+            mode = DEFAULT_MODE
+            opacity = 1.0
+        self._surface.add_tile_ops(
+            ops, dst_has_alpha, tx, ty,
+            mipmap_level=mipmap_level,
+            opacity=opacity, mode=mode
+        )
+
     def render_as_pixbuf(self, *rect, **kwargs):
         """Renders this layer as a pixbuf"""
         return self._surface.render_as_pixbuf(*rect, **kwargs)
@@ -342,20 +437,29 @@ class SurfaceBackedLayer (core.LayerBase):
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
                           frame_bbox, rect, **kwargs):
         """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        # PNG data is encoded in memory by one of the writer's threads,
+        # so the feedback callback is left to the writer.
+        kwargs.pop("feedback_cb", None)
+        if kwargs.pop("store_tiles", False):
+            return self._save_tiles_to_ora(orazip, prefix, path, frame_bbox)
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1-t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        rect = tuple(rect)
+        signature = (rect, sorted(kwargs.items()))
+        data_origin = self._copy_unchanged_ora_entry(
+            orazip, prefix, signature, storepath,
+        )
+        if data_origin is None:
+            orazip.writestr_deferred(
+                storepath,
+                self._encode_rect_as_png,
+                pngname, rect, kwargs,
+            )
+            data_origin = rect[0:2]
+            self._record_ora_entry(orazip.archive_id, prefix, signature,
+                                   storepath, data_origin)
         # Return details
-        data_bbox = tuple(rect)
-        data_x, data_y = data_bbox[0:2]
+        data_x, data_y = data_origin
         frame_x, frame_y = frame_bbox[0:2]
         elem = self._get_stackxml_element(
             "layer",
@@ -365,6 +469,101 @@ class SurfaceBackedLayer (core.LayerBase):
         elem.attrib["src"] = storepath
         return elem
 
+    def _save_tiles_to_ora(self, orazip, prefix, path, frame_bbox):
+        """Internal: saves all of the surface's tiles to a working file
+
+        The tiles are stored as they are, in a tile store (see
+        `lib.workingfile`) whose origin is that of the model.
+        """
+        tilesname = self._make_refname(prefix, path,
+                                       lib.workingfile.TILES_SUFFIX)
+        storepath = "data/%s" % (tilesname,)
+        role = prefix + lib.workingfile.TILES_SUFFIX
+        reused = self._copy_unchanged_ora_entry(
+            orazip, role, None, storepath,
+        )
+        if reused is None:
+            # Snapshotting makes the tiles read-only, so painting can
+            # go on while they're being encoded.
+            tiles = self._surface.save_snapshot().tiledict
+            orazip.writestr_deferred(
+                storepath,
+                lib.workingfile.encode_tiles,
+                tiles,
+            )
+            self._record_ora_entry(orazip.archive_id, role, None,
+                                   storepath, (0, 0))
+        frame_x, frame_y = frame_bbox[0:2]
+        elem = self._get_stackxml_element("layer", x=-frame_x, y=-frame_y)
+        elem.attrib["src"] = storepath
+        return elem
+
+    def _encode_rect_as_png(self, pngname, rect, kwargs):
+        """Internal: encodes a rectangle of the surface as PNG data
+
+        This is called from the ORA writer's worker threads.
+        """
+        t0 = time.time()
+        data = self._surface.encode_as_png(*rect, **kwargs)
+        t1 = time.time()
+        logger.debug('%.3fs surface encoding %r', t1-t0, pngname)
+        return data
+
+    def _record_ora_entry(self, archive_id, role, signature, storepath,
+                          origin):
+        """Internal: note that an ORA entry holds the current content
+
+        :param archive_id: identifies the archive (see OrderedZipWriter),
+          or None if its entries aren't to be remembered
+        :param str role: which of the layer's entries this is
+        :param signature: parameters the entry's data depends on,
+          or None if it matches the content for any parameters
+        :param str storepath: name of the entry in the archive
+        :param tuple origin: model (x, y) of the data's top left corner
+
+        """
+        if archive_id is None:
+            return
+        self._ora_entries[role] = (
+            archive_id,
+            self._content_generation,
+            signature,
+            storepath,
+            tuple(origin),
+        )
+
+    def _copy_unchanged_ora_entry(self, orazip, role, signature, storepath):
+        """Internal: reuse an entry from the archive being overwritten
+
+        :param lib.zipwriter.OrderedZipWriter orazip: archive being saved
+        :param str role: which of the layer's entries this is
+        :param signature: parameters the entry's data depends on
+        :param str storepath: name to store the entry under
+        :returns: origin of the copied data, or None if nothing was copied
+        :rtype: tuple
+
+        If the layer's content hasn't changed since it was last loaded
+        from or saved to the archive which `orazip` is replacing, the
+        old entry is copied raw instead of being encoded again.
+
+        """
+        record = self._ora_entries.get(role)
+        if record is None or orazip.previous_id is None:
+            return None
+        archive_id, generation, old_signature, old_path, origin = record
+        if archive_id != orazip.previous_id:
+            return None
+        if generation != self._content_generation:
+            return None
+        if old_signature is not None and old_signature != signature:
+            return None
+        if not orazip.copy_from_previous(old_path, storepath):
+            return None
+        logger.debug("Reusing unchanged %r as %r", old_path, storepath)
+        self._record_ora_entry(orazip.archive_id, role, old_signature,
+                               storepath, origin)
+        return origin
+
     ## Painting symmetry axis
 
     def set_symmetry_state(self, active, center_x):
@@ -773,31 +972,43 @@ class BackgroundLayer (SurfaceBackedLayer):
         """Sets the surface from a tiledsurface.Background"""
         assert isinstance(surface, tiledsurface.Background)
         self._surface = surface
+        self._content_generation += 1
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
-        # Save as a regular layer for other apps.
-        # Background surfaces repeat, so just the bit filling the frame.
-        elem = self._save_rect_to_ora(
-            orazip, tmpdir, "background", path,
-            frame_bbox, frame_bbox, **kwargs
-        )
+        if kwargs.pop("store_tiles", False):
+            # Working files need only the pattern, loaded below.
+            elem = self._get_stackxml_element("layer", x=0, y=0)
+        else:
+            # Save as a regular layer for other apps.
+            # Background surfaces repeat, so just the bit filling the frame.
+            elem = self._save_rect_to_ora(
+                orazip, tmpdir, "background", path,
+                frame_bbox, frame_bbox, **kwargs
+            )
 
         # Also save as single pattern (with corrected origin)
         x0, y0 = frame_bbox[0:2]
         x, y, w, h = self.get_bbox()
         rect = (x+x0, y+y0, w, h)
 
+        kwargs.pop("feedback_cb", None)
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(tmppath, *rect, **kwargs)
-        t1 = time.time()
         storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+        signature = (rect, sorted(kwargs.items()))
+        reused = self._copy_unchanged_ora_entry(
+            orazip, "background_tile", signature, storename,
+        )
+        if reused is None:
+            orazip.writestr_deferred(
+                storename,
+                self._encode_rect_as_png,
+                pngname, rect, kwargs,
+            )
+            self._record_ora_entry(orazip.archive_id, "background_tile",
+                                   signature, storename, rect[0:2])
         elem.attrib['background_tile'] = storename
+        elem.attrib.setdefault("src", storename)
         return elem
 
 
@@ -921,13 +1132,17 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
     stroke map is a stack of `strokemap.StrokeShape` objects in painting
     order, allowing strokes and their associated brush and color
     information to be picked from the canvas.
+
+    Strokemaps loaded from files are kept as unparsed data until they
+    are first used. If they are never used, the data is written back
+    as it is when the layer is saved.
     """
 
     ## Class constants
 
     IS_PAINTABLE = True
     IS_FILLABLE = True
-    ALLOWED_SUFFIXES = [".png"]
+    ALLOWED_SUFFIXES = [".png", lib.workingfile.TILES_SUFFIX]
 
     #TRANSLATORS: Default name for new normal, paintable layers
     DEFAULT_NAME = _(u"Layer")
@@ -937,10 +1152,26 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
     def __init__(self, **kwargs):
         super(PaintingLayer, self).__init__(**kwargs)
         self._external_edit = None
-        #: Stroke map.
-        #: List of strokemap.StrokeShape instances (not stroke.Stroke),
-        #: ordered by depth.
-        self.strokes = []
+        self._strokes = []
+        # Strokemap data still to be parsed: (data, x, y), or None
+        self._strokemap_pending = None
+
+    @property
+    def strokes(self):
+        """Stroke map
+
+        A list of strokemap.StrokeShape instances (not stroke.Stroke),
+        ordered by depth. Any strokemap data loaded from a file is
+        parsed the first time this is accessed.
+        """
+        if self._strokemap_pending is not None:
+            self._load_pending_strokemap()
+        return self._strokes
+
+    @strokes.setter
+    def strokes(self, strokes):
+        self._strokemap_pending = None
+        self._strokes = strokes
 
     def clear(self):
         """Clear both the surface and the strokemap"""
@@ -967,14 +1198,20 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         attrs = elem.attrib
         x += int(attrs.get('x', 0))
         y += int(attrs.get('y', 0))
-        strokemap_name = attrs.get('mypaint_strokemap_v2', None)
+        strokemap_name = attrs.get(lib.strokemap.STROKEMAP_ATTR, None)
+        if strokemap_name is None:
+            strokemap_name = attrs.get(lib.strokemap.OLD_STROKEMAP_ATTR,
+                                       None)
         if strokemap_name is not None:
             t2 = time.time()
-            sio = StringIO(orazip.read(strokemap_name))
-            self.load_strokemap_from_file(sio, x, y)
-            sio.close()
+            data = orazip.read(strokemap_name)
+            self._load_strokemap_from_string(data, x, y)
+            # Old-format strokemaps are rewritten in the new format.
+            if lib.strokemap.is_indexed_strokemap(data):
+                self._record_ora_entry(orazip.filename, "strokemap", (x, y),
+                                       strokemap_name, (x, y))
             t3 = time.time()
-            logger.debug('%.3fs loading strokemap %r',
+            logger.debug('%.3fs reading strokemap %r',
                          t3 - t2, strokemap_name)
 
     ## Flood fill
@@ -1038,33 +1275,49 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         self._surface.end_atomic()
         return split
 
-    def render_stroke(self, stroke):
+    def render_stroke(self, stroke, abrupt_start=False):
         """Render a whole captured stroke to the canvas
 
         :param stroke: The stroke to render
         :type stroke: lib.stroke.Stroke
+        :param bool abrupt_start: Reset the brush & dwell before starting
         """
-        stroke.render(self._surface)
+        stroke.render(self._surface, abrupt_start=abrupt_start)
+
+    def start_recording_delta(self):
+        """Starts recording painting, for undo purposes
 
-    def add_stroke_shape(self, stroke, before):
-        """Adds a rendered stroke's shape to the strokemap
+        Call `stop_recording_delta()` once the stroke has been painted.
+        Only the tiles which get painted on are recorded.
+        """
+        self._surface.start_tracking_changes()
+
+    def stop_recording_delta(self, stroke, revert=False):
+        """Stops recording, and adds the stroke's shape to the strokemap
 
         :param stroke: the stroke sequence which has been rendered
         :type stroke: lib.stroke.Stroke
-        :param before: layer snapshot taken before the stroke started
-        :type before: lib.layer.PaintingLayerSnapshot
+        :param bool revert: roll the layer back instead
+        :returns: the changes, or None if they were reverted
+        :rtype: PaintingLayerDelta
 
         The StrokeMap is a stack of lib.strokemap.StrokeShape objects which
         encapsulate the shape of a rendered stroke, and the brush settings
         which were used to render it.  The shape of the rendered stroke is
-        determined by visually diffing snapshots taken before the stroke
-        started and now.
+        determined by visually diffing the recorded tiles from before the
+        stroke started and now.
         """
+        before, after = self._surface.stop_tracking_changes()
+        delta = PaintingLayerDelta(before, after)
+        if revert:
+            delta.restore_before(self)
+            return None
         shape = lib.strokemap.StrokeShape()
-        after_sshot = self._surface.save_snapshot()
-        shape.init_from_snapshots(before.surface_sshot, after_sshot)
+        shape.init_from_snapshots(before, after)
         shape.brush_string = stroke.brush_settings
         self.strokes.append(shape)
+        delta.shape = shape
+        return delta
 
     ## Snapshots
 
@@ -1095,33 +1348,42 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
     ## Strokemap
 
     def load_strokemap_from_file(self, f, translate_x, translate_y):
+        """Loads the strokemap from a file, in either format
+
+        The data is read straight away, but it's only parsed when the
+        strokemap is first used. See `lib.strokemap.decode_strokemap()`.
+        """
+        self._load_strokemap_from_string(f.read(), translate_x, translate_y)
+
+    def _load_strokemap_from_string(self, data, translate_x, translate_y):
+        """Internal: loads the strokemap from strokemap data, lazily"""
         assert not self.strokes
-        brushes = []
+        self._strokemap_pending = (data, translate_x, translate_y)
+
+    def _load_pending_strokemap(self):
+        """Internal: parses the strokemap data loaded from a file"""
+        data, translate_x, translate_y = self._strokemap_pending
+        self._strokemap_pending = None
+        t0 = time.time()
         N = tiledsurface.N
         x = int(translate_x//N) * N
         y = int(translate_y//N) * N
         dx = translate_x % N
         dy = translate_y % N
-        while True:
-            t = f.read(1)
-            if t == 'b':
-                length, = struct.unpack('>I', f.read(4))
-                tmp = f.read(length)
-                brushes.append(zlib.decompress(tmp))
-            elif t == 's':
-                brush_id, length = struct.unpack('>II', f.read(2*4))
-                stroke = lib.strokemap.StrokeShape()
-                tmp = f.read(length)
-                stroke.init_from_string(tmp, x, y)
-                stroke.brush_string = brushes[brush_id]
-                # Translate non-aligned strokes
-                if (dx, dy) != (0, 0):
-                    stroke.translate(dx, dy)
-                self.strokes.append(stroke)
-            elif t == '}':
-                break
-            else:
-                assert False, 'invalid strokemap'
+        try:
+            strokes = lib.strokemap.decode_strokemap(data, x, y)
+        except (ValueError, struct.error, zlib.error), e:
+            logger.error("Strokemap not loaded: %r", e)
+            return
+        # Translate non-aligned strokes. The strokes are needed now, so
+        # this isn't left to the idle processor.
+        if (dx, dy) != (0, 0):
+            for stroke in strokes:
+                stroke.translate(dx, dy)
+                stroke.tasks.finish_all()
+        self._strokes = strokes
+        logger.debug("%.3fs parsing strokemap of %r (%d strokes)",
+                     time.time() - t0, self, len(strokes))
 
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
@@ -1137,33 +1399,6 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
 
     ## Saving
 
-    @staticmethod
-    def _write_file_str(z, filename, data):
-        """Helper: write data to a zipfile with the right permissions"""
-        # Work around a permission bug in the zipfile library:
-        # http://bugs.python.org/issue3394
-        zi = zipfile.ZipInfo(filename)
-        zi.external_attr = 0100644 << 16
-        z.writestr(zi, data)
-
-    def _save_strokemap_to_file(self, f, translate_x, translate_y):
-        brush2id = {}
-        for stroke in self.strokes:
-            s = stroke.brush_string
-            # save brush (if not already known)
-            if s not in brush2id:
-                brush2id[s] = len(brush2id)
-                s = zlib.compress(s)
-                f.write('b')
-                f.write(struct.pack('>I', len(s)))
-                f.write(s)
-            # save stroke
-            s = stroke.save_to_string(translate_x, translate_y)
-            f.write('s')
-            f.write(struct.pack('>II', brush2id[stroke.brush_string], len(s)))
-            f.write(s)
-        f.write('}')
-
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
         """Save the strokemap too, in addition to the base implementation"""
@@ -1173,20 +1408,39 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
             orazip, tmpdir, path,
             canvas_bbox, frame_bbox, **kwargs
         )
-        # Store stroke shape data too
-        x, y, w, h = self.get_bbox()
-        sio = StringIO()
-        t0 = time.time()
-        self._save_strokemap_to_file(sio, -x, -y)
-        t1 = time.time()
-        data = sio.getvalue()
-        sio.close()
+        # Store stroke shape data too, relative to the PNG's origin
+        x = frame_bbox[0] + int(elem.attrib["x"])
+        y = frame_bbox[1] + int(elem.attrib["y"])
         datname = self._make_refname("layer", path, "strokemap.dat")
-        logger.debug("%.3fs strokemap saving %r", t1-t0, datname)
         storepath = "data/%s" % (datname,)
-        self._write_file_str(orazip, storepath, data)
+        reused = self._copy_unchanged_ora_entry(
+            orazip, "strokemap", (x, y), storepath,
+        )
+        pending = self._strokemap_pending
+        if (reused is None and pending is not None
+                and pending[1:] == (x, y)
+                and lib.strokemap.is_indexed_strokemap(pending[0])):
+            # Never parsed, and it still fits: written back as it is
+            orazip.writestr(storepath, pending[0])
+            reused = storepath
+            self._record_ora_entry(orazip.archive_id, "strokemap", (x, y),
+                                   storepath, (x, y))
+        if reused is None:
+            # Pending shape calculations are finished here, and the
+            # encoding is done by the writer's threads.
+            t0 = time.time()
+            shapes = [(s.brush_string, s.get_tiles()) for s in self.strokes]
+            t1 = time.time()
+            logger.debug("%.3fs strokemap preparation %r", t1-t0, datname)
+            orazip.writestr_deferred(
+                storepath,
+                lib.strokemap.encode_strokemap,
+                shapes, -x, -y,
+            )
+            self._record_ora_entry(orazip.archive_id, "strokemap", (x, y),
+                                   storepath, (x, y))
         # Return details
-        elem.attrib['mypaint_strokemap_v2'] = storepath
+        elem.attrib[lib.strokemap.STROKEMAP_ATTR] = storepath
         return elem
 
     ## Type-specific stuff
@@ -1236,11 +1490,61 @@ class PaintingLayerSnapshot (SurfaceBackedLayerSnapshot):
 
     def __init__(self, layer):
         super(PaintingLayerSnapshot, self).__init__(layer)
-        self.strokes = layer.strokes[:]
+        # Unparsed strokemaps stay that way
+        self.strokes = layer._strokes[:]
+        self.strokemap_pending = layer._strokemap_pending
 
     def restore_to_layer(self, layer):
         super(PaintingLayerSnapshot, self).restore_to_layer(layer)
         layer.strokes = self.strokes[:]
+        layer._strokemap_pending = self.strokemap_pending
+
+
+class PaintingLayerDelta (object):
+    """Changes made by one stroke on a painting layer, for undo
+
+    Unlike a snapshot, this holds only the tiles the stroke changed,
+    as they were before and after it, and the shape it added to the
+    strokemap. Undo and redo patch just those into the layer, so their
+    cost depends on the size of the stroke, not the size of the layer.
+    Deltas must be restored in stack order, like commands.
+    """
+
+    def __init__(self, surface_before, surface_after, shape=None):
+        super(PaintingLayerDelta, self).__init__()
+        self.surface_before = surface_before
+        self.surface_after = surface_after
+        self.shape = shape
+
+    def _get_positions(self):
+        positions = set(self.surface_before.tiledict)
+        positions.update(self.surface_after.tiledict)
+        return positions
+
+    def restore_before(self, layer):
+        """Puts back the layer's state from before the stroke"""
+        layer._surface.load_partial_snapshot(
+            self.surface_before,
+            self._get_positions(),
+        )
+        strokes = layer.strokes
+        for i in reversed(xrange(len(strokes))):
+            if strokes[i] is self.shape:
+                del strokes[i]
+                break
+
+    def restore_after(self, layer):
+        """Puts back the layer's state from after the stroke"""
+        layer._surface.load_partial_snapshot(
+            self.surface_after,
+            self._get_positions(),
+        )
+        shape = self.shape
+        if shape is None:
+            return
+        strokes = layer.strokes
+        if not (strokes and strokes[-1] is shape):
+            strokes.append(shape)
 
 
 class PaintingLayerMove (object):
@@ -16,6 +16,8 @@ import gi
 from gi.repository import GdkPixbuf
 
 import re
+import functools
+import time
 import numpy
 import logging
 logger = logging.getLogger(__name__)
@@ -36,6 +38,7 @@ import lib.cache
 from consts import *
 import core
 import data
+import loading
 import lib.layer.error
 
 
@@ -350,9 +353,12 @@ class LayerStack (core.LayerBase):
         """Unconditionally copy one tile's data into an array"""
         N = tiledsurface.N
         tmp = numpy.zeros((N, N, 4), dtype='uint16')
+        ops = []
         for layer in reversed(self._layers):
-            layer.composite_tile(tmp, True, tx, ty, mipmap_level,
-                                 layers=None, **kwargs)
+            layer.add_tile_ops(ops, True, tx, ty, mipmap_level,
+                               layers=None, **kwargs)
+        if ops:
+            lib.mypaintlib.tile_combine_ops(ops, tmp, True)
         if dst.dtype == 'uint16':
             lib.mypaintlib.tile_copy_rgba16_into_rgba16(tmp, dst)
         elif dst.dtype == 'uint8':
@@ -366,8 +372,28 @@ class LayerStack (core.LayerBase):
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        layers=None, previewing=None, solo=None, **kwargs):
-        """Composite a tile's data into an array, respecting flags/layers list"""
+        """Composite a tile's data into an array, respecting flags/layers list
 
+        The whole subtree is flattened into a list of ops with
+        `add_tile_ops()`, which is then composited in a single call to
+        `lib.mypaintlib.tile_combine_ops()`.
+        """
+        ops = []
+        self.add_tile_ops(ops, dst_has_alpha, tx, ty, mipmap_level,
+                          layers=layers, previewing=previewing, solo=solo,
+                          **kwargs)
+        if ops:
+            lib.mypaintlib.tile_combine_ops(ops, dst, dst_has_alpha)
+
+    def add_tile_ops(self, ops, dst_has_alpha, tx, ty, mipmap_level=0,
+                     layers=None, previewing=None, solo=None, **kwargs):
+        """Appends compositing ops for one tile, like composite_tile()
+
+        Pass-through groups just append their children's ops. Isolated
+        groups append a single op whose source is the nested list of
+        their children's ops: these are composited over a transparent
+        temporary tile natively.
+        """
         mode = self.mode
         opacity = self.opacity
         if layers is not None:
@@ -387,29 +413,25 @@ class LayerStack (core.LayerBase):
         if isolate and solo and self is not solo:
             isolate = False
         if isolate:
-            N = tiledsurface.N
-            tmp = numpy.zeros((N, N, 4), dtype='uint16')
+            group_ops = []
             for layer in reversed(self._layers):
                 p = (self is previewing) and layer or previewing
                 s = (self is solo) and layer or solo
-                layer.composite_tile(tmp, True, tx, ty, mipmap_level,
-                                     layers=layers, previewing=p, solo=s,
-                                     **kwargs)
+                layer.add_tile_ops(group_ops, True, tx, ty, mipmap_level,
+                                   layers=layers, previewing=p, solo=s,
+                                   **kwargs)
             if previewing or solo:
                 mode = DEFAULT_MODE
                 opacity = 1.0
-            lib.mypaintlib.tile_combine(
-                mode, tmp,
-                dst, dst_has_alpha,
-                opacity,
-            )
+            if group_ops or mode in MODES_EFFECTIVE_AT_ZERO_ALPHA:
+                ops.append((group_ops, mode, opacity))
         else:
             for layer in reversed(self._layers):
                 p = (self is previewing) and layer or previewing
                 s = (self is solo) and layer or solo
-                layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level,
-                                     layers=layers, previewing=p, solo=s,
-                                     **kwargs)
+                layer.add_tile_ops(ops, dst_has_alpha, tx, ty, mipmap_level,
+                                   layers=layers, previewing=p, solo=s,
+                                   **kwargs)
 
     def render_as_pixbuf(self, *args, **kwargs):
         return lib.pixbufsurface.render_as_pixbuf(self, *args, **kwargs)
@@ -448,6 +470,16 @@ class LayerStack (core.LayerBase):
             kwargs['alpha'] = True
         lib.pixbufsurface.save_as_png(self, filename, *rect, **kwargs)
 
+    def encode_as_png(self, *rect, **kwargs):
+        """Encode as PNG data, in memory"""
+        if 'alpha' not in kwargs:
+            kwargs['alpha'] = True
+        return lib.pixbufsurface.encode_as_png(self, *rect, **kwargs)
+
+    def save_as_jpeg(self, filename, *rect, **kwargs):
+        """Save to a named JPEG file, flattened"""
+        lib.pixbufsurface.save_as_jpeg(self, filename, *rect, **kwargs)
+
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the stack's data into an open OpenRaster ZipFile"""
@@ -585,6 +617,16 @@ class RootLayerStack (LayerStack):
     in the Layers panel.
     """
 
+    ## Class constants
+
+    #: Size in tiles of the cache for normal renders. High quality zoom
+    #: shows up to 4x the tiles of normal zoom, plus the coarser ones
+    #: they're filtered from: about 2600 for a 1920x1080 view.
+    RENDER_CACHE_CAPACITY = 4096
+
+    #: Size in tiles of the cache for solo, preview, and overlay renders
+    RENDER_MODE_CACHE_CAPACITY = 512
+
     ## Initialization
 
     def __init__(self, doc, **kwargs):
@@ -595,7 +637,13 @@ class RootLayerStack (LayerStack):
         """
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
-        self._render_cache = lib.cache.LRUCache()
+        self._render_cache = lib.cache.LRUCache(
+            capacity=self.RENDER_CACHE_CAPACITY,
+        )
+        self._render_mode_cache = lib.cache.LRUCache(
+            capacity=self.RENDER_MODE_CACHE_CAPACITY,
+        )
+        self._render_mode_changing = False
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -609,17 +657,91 @@ class RootLayerStack (LayerStack):
         self._current_layer_previewing = False
         # Current layer
         self._current_path = ()
+        # Lazy loading: see load_from_openraster()
+        self._lazy_loader = None
+        self._lazy_placeholder = None
+        self._lazy_stale_bbox = helpers.Rect()
         # Self-observation
-        self.layer_content_changed += self._clear_render_cache
+        self.layer_content_changed += self._invalidate_render_cache
         self.layer_properties_changed += self._clear_render_cache
         self.layer_deleted += self._clear_render_cache
         self.layer_inserted += self._clear_render_cache
+        self.layer_content_changed += self._lazy_content_changed
+        self.layer_properties_changed += self._drop_lazy_placeholder
+        self.layer_deleted += self._drop_lazy_placeholder
+        self.layer_inserted += self._drop_lazy_placeholder
 
     def _clear_render_cache(self, *_ignored):
+        if self._render_mode_changing:
+            return
         self._render_cache.clear()
+        self._render_mode_cache.clear()
+
+    def _invalidate_render_cache(self, layer, x, y, w, h):
+        """Drops the cached tiles covering an area whose content changed
+
+        Tiles elsewhere stay cached, at every mipmap level, so painting
+        doesn't make the display composite the whole view again. An
+        empty area means that everything changed.
+        """
+        if self._render_mode_changing:
+            return
+        if w <= 0 or h <= 0:
+            self._clear_render_cache()
+            return
+        N = tiledsurface.N
+
+        def _is_stale(key):
+            tx, ty, mipmap_level = key[0], key[1], key[3]
+            size = N << mipmap_level
+            return (tx*size < x+w and x < (tx+1)*size and
+                    ty*size < y+h and y < (ty+1)*size)
+
+        self._render_cache.discard_matching(_is_stale)
+        self._render_mode_cache.discard_matching(_is_stale)
+
+    def _render_mode_changed(self):
+        """Requests a full redraw after a change of rendering mode
+
+        The render caches are keyed on the rendering mode, so toggling
+        solo or preview doesn't need to clear them.
+        """
+        self._render_mode_changing = True
+        try:
+            self.layer_content_changed(self, 0, 0, 0, 0)
+        finally:
+            self._render_mode_changing = False
+
+    def _get_render_cache(self, key, layers=None, overlay=None,
+                          previewing=None, solo=None, **_ignored):
+        """Gets the render cache and full cache key for a rendering mode
+
+        :param tuple key: Basic key: tile position, mipmap level etc.
+        :returns: a cache, and a key to use with it
+        :rtype: tuple
+
+        Normal renders of the whole stack use the main render cache.
+        Renders of a subset of the layers, or with an overlay, or in
+        solo or preview mode use a smaller separate cache, with the
+        mode added to the key, so that flicking between modes is fast
+        and doesn't evict the main cache's tiles. The layers themselves
+        go into the key, which keeps them alive while they're cached:
+        their ids can't be reused by short-lived overlays.
+
+        Keys start with the tile position, the alpha flag, and the
+        mipmap level: see `_invalidate_render_cache()`.
+        """
+        if layers is None and overlay is None and not (previewing or solo):
+            return (self._render_cache, key)
+        if layers is not None:
+            layers = frozenset(layers)
+        mode = (layers, overlay, previewing, solo)
+        return (self._render_mode_cache, key + mode)
 
     def clear(self):
         """Clear the layer and set the default background"""
+        if self._lazy_loader is not None:
+            self._lazy_loader.cancel()
         super(RootLayerStack, self).clear()
         self.set_background(self._default_background)
         self.current_path = ()
@@ -726,7 +848,7 @@ class RootLayerStack (LayerStack):
             yield layer
 
     def render_into(self, surface, tiles, mipmap_level, overlay=None,
-                    opaque_base_tile=None):
+                    opaque_base_tile=None, filter_weight=0.0):
         """Tiled rendering: used for display only
 
         :param surface: target rgba8 surface
@@ -738,6 +860,7 @@ class RootLayerStack (LayerStack):
         :param overlay: overlay layer to render (stroke highlighting)
         :type overlay: SurfaceBackedLayer
         :param array opaque_base_tile: optional fallback base tile
+        :param float filter_weight: prefilter towards mipmap_level+1 (0..1)
 
         Rendering for the display may write non-opaque tiles
         to the target surface.
@@ -759,6 +882,12 @@ class RootLayerStack (LayerStack):
         assuming it really does contain opaque RGBA data.
 
         * IN FLUX: the opaque base may change to a surface or a layer
+
+        A nonzero `filter_weight` blends each tile with the corresponding
+        part of the next coarser mipmap level, in the manner of trilinear
+        filtering. The display uses this for high quality zoom at
+        fractional scales. The filtered tiles are cached.
+        See `_composite_filtered_tile()`.
         """
         # Decide a rendering mode
         render_background = self._get_render_background()
@@ -773,10 +902,19 @@ class RootLayerStack (LayerStack):
             previewing = self.current
         if self._current_layer_solo:
             solo = self.current
+        composite = self.composite_tile
+        if filter_weight > 0 and mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL:
+            composite = functools.partial(
+                self._composite_filtered_tile,
+                filter_weight=filter_weight,
+            )
+        if self._lazy_loader is not None:
+            tiles = list(tiles)
+            self._lazy_loader.note_visible_tiles(tiles, mipmap_level)
         # Blit loop. Could this be done in C++?
         for tx, ty in tiles:
             with surface.tile_request(tx, ty, readonly=False) as dst:
-                self.composite_tile(
+                composite(
                     dst, dst_has_alpha, tx, ty,
                     mipmap_level,
                     layers=layers,
@@ -785,8 +923,77 @@ class RootLayerStack (LayerStack):
                     previewing=previewing,
                     solo=solo,
                     opaque_base_tile=opaque_base_tile,
+                    display=True,
                 )
 
+    #: Number of distinct filter weights used by _composite_filtered_tile()
+    FILTER_WEIGHT_STEPS = 16
+
+    def _composite_filtered_tile(self, dst, dst_has_alpha, tx, ty,
+                                 mipmap_level, filter_weight,
+                                 layers=None, render_background=None,
+                                 overlay=None, opaque_base_tile=None,
+                                 display=False, **kwargs):
+        """Composite a tile blended with the next coarser mipmap level
+
+        :param dst: Target 8bpp tile array
+        :param float filter_weight: Weight of the coarser level (0..1)
+
+        Other parameters are as for `composite_tile()`. The tile at
+        `mipmap_level` is blended with the corresponding quarter of the
+        tile at ``mipmap_level+1``, upscaled bilinearly. Since each
+        mipmap level is a 2x2 box filtered version of the one below,
+        this amounts to a blur whose strength follows the fractional
+        part of the display's ideal mipmap level.
+
+        The blended tiles are cached like normal ones, with the weight
+        quantized to `FILTER_WEIGHT_STEPS` steps, so redraws and panning
+        cost the same as without filtering. The finer level's tiles
+        aren't cached separately. The coarser level's tiles are, so
+        each is composited once for the 2x2 block of tiles it covers.
+        """
+        N = tiledsurface.N
+        steps = self.FILTER_WEIGHT_STEPS
+        weight = int(round(filter_weight * steps))
+        weight = max(0, min(weight, steps))
+        if render_background is None:
+            render_background = self._get_render_background()
+        if weight == 0:
+            self.composite_tile(
+                dst, dst_has_alpha, tx, ty, mipmap_level,
+                layers=layers, render_background=render_background,
+                overlay=overlay, opaque_base_tile=opaque_base_tile,
+                display=display, **kwargs
+            )
+            return
+        cache, cache_key = self._get_render_cache(
+            (tx, ty, dst_has_alpha, mipmap_level,
+             render_background, id(opaque_base_tile), weight),
+            layers=layers, overlay=overlay, **kwargs
+        )
+        cached = cache.get(cache_key)
+        if cached is not None:
+            dst[:] = cached
+            return
+        placeholder_used = self._composite_tile_rgba8(
+            dst, dst_has_alpha, tx, ty, mipmap_level,
+            layers, render_background, overlay, opaque_base_tile,
+            display, **kwargs
+        )
+        coarse = numpy.empty((N, N, 4), dtype='uint8')
+        placeholder_used |= self._composite_tile_rgba8(
+            coarse, dst_has_alpha, tx//2, ty//2, mipmap_level+1,
+            layers, render_background, overlay, opaque_base_tile,
+            display, cached=True, **kwargs
+        )
+        lib.mypaintlib.tile_blend_upscaled_rgba8(
+            coarse, (tx % 2) * (N/2), (ty % 2) * (N/2),
+            float(weight) / steps, dst,
+        )
+        # The cache is shared with non-display renders
+        if not placeholder_used:
+            cache[cache_key] = dst.copy()
+
     def render_thumbnail(self, bbox, **options):
         """Renders a 256x256 thumbnail of the stack
 
@@ -824,7 +1031,7 @@ class RootLayerStack (LayerStack):
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        layers=None, render_background=None, overlay=None,
-                       opaque_base_tile=None,
+                       opaque_base_tile=None, display=False,
                        **kwargs):
         """Composite a tile's data, respecting flags/layers list
 
@@ -834,6 +1041,7 @@ class RootLayerStack (LayerStack):
         :param bool render_background: Render the internal bg layer
         :param BaseLayer overlay: Overlay layer
         :param array opaque_base_tile: Fallback base tile
+        :param bool display: Rendering for the display only
 
         The root layer has flags which ensure it is always visible, so the
         result is generally indistinguishable from `blit_tile_into()`.
@@ -846,9 +1054,15 @@ class RootLayerStack (LayerStack):
         The base tile is used under the results of rendering, with the
         results drawn over it with simple alpha compositing.
 
+        Only display renders may show the lazy load placeholder (see
+        `_add_stack_tile_ops()`). Everything else, such as saving or
+        sampling, gets the layers' real pixels.
+
         As a further extension to the base API, `dst` may be an 8bpp
-        array. A temporary 15-bit scaled int array is used for
-        compositing in this case, and the output is converted to 8bpp.
+        array. In this case, the layers are asked for their compositing
+        ops using `add_tile_ops()`, and the whole stack is composited
+        and converted to 8bpp in a single native call. The 8bpp results
+        are cached.
         """
         if render_background is None:
             render_background = self._get_render_background()
@@ -860,64 +1074,168 @@ class RootLayerStack (LayerStack):
 
         N = tiledsurface.N
 
-        cache_key = None
-        cache_hit = False
         if dst.dtype == 'uint8':
-            dst_8bit = dst
-            dst = None
-            using_cache = (
-                layers is None
-                and overlay is None
-                and not (kwargs.get("solo") or kwargs.get("previewing"))
+            self._composite_tile_rgba8(
+                dst, dst_has_alpha, tx, ty, mipmap_level,
+                layers, render_background, overlay, opaque_base_tile,
+                display, cached=True, **kwargs
             )
-            if using_cache:
-                cache_key = (tx, ty, dst_has_alpha, mipmap_level,
-                             render_background, id(opaque_base_tile))
-                dst = self._render_cache.get(cache_key)
-            if dst is None:
-                dst = numpy.empty((N, N, 4), dtype='uint16')
-            else:
-                cache_hit = True
+            return
+
+        dst_over_opaque_base = None
+        if dst_has_alpha and opaque_base_tile is not None:
+            dst_over_opaque_base = dst
+            lib.mypaintlib.tile_copy_rgba16_into_rgba16(
+                opaque_base_tile,
+                dst_over_opaque_base,
+            )
+            dst = numpy.empty((N, N, 4), dtype='uint16')
+
+        background_surface.blit_tile_into(dst, dst_has_alpha, tx, ty,
+                                          mipmap_level)
+        ops = []
+        self._add_stack_tile_ops(ops, dst_has_alpha, tx, ty,
+                                 mipmap_level, layers, render_background,
+                                 overlay, display=display, **kwargs)
+        if ops:
+            lib.mypaintlib.tile_combine_ops(ops, dst, dst_has_alpha)
+
+        if dst_over_opaque_base is not None:
+            lib.mypaintlib.tile_combine(
+                lib.mypaintlib.CombineNormal,
+                dst, dst_over_opaque_base,
+                False, 1.0,
+            )
+
+    def _composite_tile_rgba8(self, dst, dst_has_alpha, tx, ty,
+                              mipmap_level, layers, render_background,
+                              overlay, opaque_base_tile, display,
+                              cached=False, **kwargs):
+        """Internal: composites the stack into an 8bpp tile
+
+        :param bool cached: use the render cache
+        :returns: whether the lazy load placeholder was used
+        :rtype: bool
+
+        See `composite_tile()`. The whole stack is composited and
+        converted to 8bpp in a single native call.
+        """
+        if cached:
+            cache, cache_key = self._get_render_cache(
+                (tx, ty, dst_has_alpha, mipmap_level,
+                 render_background, id(opaque_base_tile)),
+                layers=layers, overlay=overlay, **kwargs
+            )
+            cached_dst = cache.get(cache_key)
+            if cached_dst is not None:
+                dst[:] = cached_dst
+                return False
+        if render_background:
+            background_surface = self._background_layer._surface
         else:
-            dst_8bit = None
-
-        if not cache_hit:
-            dst_over_opaque_base = None
-            if dst_has_alpha and opaque_base_tile is not None:
-                dst_over_opaque_base = dst
-                lib.mypaintlib.tile_copy_rgba16_into_rgba16(
-                    opaque_base_tile,
-                    dst_over_opaque_base,
-                )
-                dst = numpy.empty((N, N, 4), dtype='uint16')
-
-            background_surface.blit_tile_into(dst, dst_has_alpha, tx, ty,
-                                              mipmap_level)
-            for layer in reversed(self):
-                layer.composite_tile(dst, dst_has_alpha, tx, ty,
-                                     mipmap_level, layers=layers, **kwargs)
-            if overlay:
-                overlay.composite_tile(dst, dst_has_alpha, tx, ty,
-                                       mipmap_level, layers=set([overlay]),
-                                       **kwargs)
-
-            if dst_over_opaque_base is not None:
-                dst_has_alpha = False
-                lib.mypaintlib.tile_combine(
-                    lib.mypaintlib.CombineNormal,
-                    dst, dst_over_opaque_base,
-                    dst_has_alpha, 1.0,
-                )
-                dst = dst_over_opaque_base
+            background_surface = self._blank_bg_surface
+        if layers is not None:
+            # Stacks add to the set when solo'd or previewed.
+            # Don't let that leak into the next tile's cache key.
+            layers = set(layers)
+        ops = []
+        placeholder_used = self._add_stack_tile_ops(
+            ops, dst_has_alpha, tx, ty,
+            mipmap_level, layers, render_background,
+            overlay, display=display, **kwargs
+        )
+        bg = background_surface.get_tile_array(tx, ty, mipmap_level)
+        lib.mypaintlib.tile_composite_rgba8(
+            ops, bg, opaque_base_tile,
+            dst, dst_has_alpha,
+        )
+        # The cache is shared with non-display renders
+        if cached and not placeholder_used:
+            cache[cache_key] = dst.copy()
+        return placeholder_used
 
-            if cache_key is not None:
-                self._render_cache[cache_key] = dst
+    def _add_stack_tile_ops(self, ops, dst_has_alpha, tx, ty, mipmap_level,
+                            layers, render_background, overlay,
+                            display=False, **kwargs):
+        """Internal: adds the ops for compositing the whole stack
 
-        if dst_8bit is not None:
-            if dst_has_alpha:
-                lib.mypaintlib.tile_convert_rgba16_to_rgba8(dst, dst_8bit)
-            else:
-                lib.mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
+        :returns: whether the lazy load placeholder was used
+        :rtype: bool
+
+        While a lazy load is in progress, tiles covered by layers which
+        haven't been decoded yet are taken from the placeholder, which
+        stands in for every layer. It can only be used for normal
+        display renders of the whole stack, over the background. Its
+        pixels are only an approximation, so saving and sampling never
+        use it.
+        """
+        placeholder = self._lazy_placeholder
+        use_placeholder = (
+            display
+            and placeholder is not None
+            and layers is None and overlay is None
+            and render_background
+            and not (kwargs.get("previewing") or kwargs.get("solo"))
+            and self._lazy_loader.tile_is_pending(tx, ty, mipmap_level)
+        )
+        if use_placeholder:
+            size = tiledsurface.N << mipmap_level
+            tile_rect = helpers.Rect(tx*size, ty*size, size, size)
+            use_placeholder = not tile_rect.overlaps(self._lazy_stale_bbox)
+        if use_placeholder:
+            placeholder.add_tile_ops(ops, dst_has_alpha, tx, ty,
+                                     mipmap_level)
+            return True
+        for layer in reversed(self):
+            layer.add_tile_ops(ops, dst_has_alpha, tx, ty,
+                               mipmap_level, layers=layers, **kwargs)
+        if overlay:
+            overlay.add_tile_ops(ops, dst_has_alpha, tx, ty,
+                                 mipmap_level, layers=set([overlay]),
+                                 **kwargs)
+        return False
+
+    ## Lazy loading
+
+    def _lazy_content_changed(self, layer, *args):
+        """Marks where the placeholder is out of date after an edit"""
+        if self._lazy_placeholder is None:
+            return
+        if self._render_mode_changing or self._lazy_loader.decoding:
+            return
+        x, y, w, h = args
+        if w <= 0 or h <= 0:
+            self._drop_lazy_placeholder()
+            return
+        self._lazy_stale_bbox.expandToIncludeRect(helpers.Rect(x, y, w, h))
+
+    def _drop_lazy_placeholder(self, *_ignored):
+        """Stops using the placeholder after a structural change"""
+        if self._lazy_placeholder is None:
+            return
+        if self._render_mode_changing:
+            return
+        logger.debug("Lazy load placeholder dropped")
+        self._lazy_placeholder = None
+
+    def _lazy_load_finished(self, loader):
+        """Called by the lazy loader once it's done, or cancelled"""
+        if loader is not self._lazy_loader:
+            return
+        logger.debug("Lazy load finished")
+        self._lazy_loader = None
+        self._lazy_placeholder = None
+        self._lazy_stale_bbox = helpers.Rect()
+
+    @property
+    def lazy_load_pending(self):
+        """True if some layers are still to be decoded after a load"""
+        return self._lazy_loader is not None
+
+    def finish_lazy_load(self):
+        """Decodes any layers whose loading was deferred, right now"""
+        if self._lazy_loader is not None:
+            self._lazy_loader.finish_all()
 
     ## Symmetry axis
 
@@ -1141,7 +1459,7 @@ class RootLayerStack (LayerStack):
         self._current_layer_solo = value
         if value != old_value:
             self.current_layer_solo_changed()
-            self.layer_content_changed(self, 0, 0, 0, 0)
+            self._render_mode_changed()
 
     @event
     def current_layer_solo_changed(self):
@@ -1167,7 +1485,7 @@ class RootLayerStack (LayerStack):
         self._current_layer_previewing = value
         if value != old_value:
             self.current_layer_previewing_changed()
-            self.layer_content_changed(self, 0, 0, 0, 0)
+            self._render_mode_changed()
 
     @event
     def current_layer_previewing_changed(self):
@@ -2237,9 +2555,11 @@ class RootLayerStack (LayerStack):
     ## Loading
 
     def load_from_openraster(self, orazip, elem, tempdir, feedback_cb,
-                             x=0, y=0, **kwargs):
+                             x=0, y=0, lazy=False, **kwargs):
         """Load the root layer stack from an open .ora file
 
+        :param bool lazy: Defer decoding the data layers (see below)
+
         >>> root = RootLayerStack(None)
         >>> import zipfile
         >>> import tempfile
@@ -2262,12 +2582,51 @@ class RootLayerStack (LayerStack):
         >>> shutil.rmtree(tmpdir)
         >>> assert not os.path.exists(tmpdir)
 
+        The data layers' PNGs are normally decoded in parallel, and the
+        load finishes once they're all loaded. If `lazy` is true, the
+        layer tree is built, but the data layers are decoded in the
+        background, or when they're first needed. Until then, the saved
+        ``mergedimage.png`` is rendered in their place. See
+        `lib.layer.loading`. Neither happens if the caller passes its
+        own ``deferred_loader``.
+
         """
+        lazy_loader = None
+        pooled_loader = None
+        if kwargs.get("deferred_loader") is not None:
+            pass  # the caller's own, e.g. for working files
+        elif lazy:
+            lazy_loader = loading.LazyLayerLoader(self, orazip.filename)
+            kwargs["deferred_loader"] = lazy_loader
+        else:
+            pooled_loader = loading.PooledLayerLoader(
+                orazip.filename,
+                feedback_cb=feedback_cb,
+            )
+            kwargs["deferred_loader"] = pooled_loader
         self._no_background = True
-        super(RootLayerStack, self) \
-            .load_from_openraster(orazip, elem, tempdir, feedback_cb,
-                                  x=x, y=y, **kwargs)
-        del self._no_background
+        try:
+            super(RootLayerStack, self) \
+                .load_from_openraster(orazip, elem, tempdir, feedback_cb,
+                                      x=x, y=y, **kwargs)
+            if pooled_loader is not None:
+                pooled_loader.finish()
+        except:
+            if pooled_loader is not None:
+                pooled_loader.close()
+            if lazy_loader is not None:
+                lazy_loader.cancel()
+            raise
+        finally:
+            del self._no_background
+        if lazy_loader is not None:
+            if lazy_loader.finished:
+                lazy_loader.cancel()
+            else:
+                self._lazy_loader = lazy_loader
+                self._lazy_placeholder = self._load_lazy_placeholder(
+                    orazip, feedback_cb,
+                )
         # Select a suitable working layer from the user-accesible ones.
         # Try for the uppermost layer marked as initially selected,
         # fall back to the uppermost immediate child of the root stack.
@@ -2299,6 +2658,25 @@ class RootLayerStack (LayerStack):
         logger.debug("Selecting %r after load", selected_path)
         self.set_current_path(selected_path)
 
+    @staticmethod
+    def _load_lazy_placeholder(orazip, feedback_cb):
+        """Loads mergedimage.png as a surface, for use as a placeholder"""
+        t0 = time.time()
+        surface = tiledsurface.Surface()
+        try:
+            fp = orazip.open("mergedimage.png")
+            try:
+                surface.load_from_png_stream(fp, 0, 0, feedback_cb,
+                                             convert_to_srgb=False)
+            finally:
+                fp.close()
+        except Exception:
+            logger.warning("No usable mergedimage.png: layers will be "
+                           "decoded as they're displayed")
+            return None
+        logger.debug("%.3fs loading placeholder", time.time() - t0)
+        return surface
+
     def load_child_layer_from_openraster(self, orazip, elem, tempdir,
                                          feedback_cb, x=0, y=0, **kwargs):
         """Loads and appends a single child layer from an open .ora file"""
@@ -2345,6 +2723,16 @@ class RootLayerStack (LayerStack):
 
         return stack_elem
 
+    ## Snapshotting
+
+    def save_snapshot(self):
+        """Snapshots the whole tree, including the background
+
+        The snapshot shares its tiles with the live layers copy-on-write,
+        so it's cheap to make. See `RootLayerStackSnapshot`.
+        """
+        return RootLayerStackSnapshot(self)
+
     ## Notification mechanisms
 
     @event
@@ -2394,6 +2782,37 @@ class RootLayerStack (LayerStack):
         pass
 
 
+class RootLayerStackSnapshot (LayerStackSnapshot):
+    """Snapshot of a root layer stack's state
+
+    In addition to the layers, this records the background and the
+    current layer. Background surfaces are replaced rather than being
+    modified, so the snapshot just keeps a reference.
+
+    When restored, the layers are adopted properly by the root stack,
+    so the snapshot can be used to build a detached copy of a document
+    in a new root stack. See `lib.document.Document.save_snapshot()`.
+    """
+
+    def __init__(self, layer):
+        super(RootLayerStackSnapshot, self).__init__(layer)
+        self.background_surface = layer._background_layer._surface
+        self.background_visible = layer.background_visible
+        self.current_path = layer.current_path
+
+    def restore_to_layer(self, layer):
+        layer.clear()
+        core.LayerBaseSnapshot.restore_to_layer(self, layer)
+        for layer_class, snap in zip(self.layer_classes,
+                                     self.layer_snaps):
+            child = layer_class()
+            child.load_snapshot(snap)
+            layer.append(child)
+        layer.set_background(self.background_surface)
+        layer.background_visible = self.background_visible
+        layer.current_path = self.current_path
+
+
 ## Layer path tuple functions
 
 def path_startswith(path, prefix):
@@ -0,0 +1,507 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Deferred decoding of layer data from OpenRaster files
+
+Decoding every layer's PNG is what makes opening a large OpenRaster
+file slow. Data layers can hand the decoding of their PNGs to a
+deferred loader, which has a method ``defer(layer, src, x, y)`` that
+returns true if it takes on the job. See
+`lib.layer.data.SurfaceBackedLayer.load_from_openraster()`.
+
+When a document is loaded normally, a `PooledLayerLoader` decodes the
+layers' PNGs in parallel worker threads, and loads the results into
+the layers in stack order before the load finishes.
+
+When a document is opened lazily, the layer tree is built
+from ``stack.xml`` straight away, but the data layers' surfaces are
+left empty, with a pending load. The saved ``mergedimage.png`` is shown
+in their place. Layer data is then decoded in the background by a pool
+of worker threads, with the current layer and layers under the visible
+part of the canvas going first. The native PNG decoder releases the
+GIL, so this doesn't hold up the UI. Only installing each decoded
+layer's tiles happens on the main thread, from the GLib main loop.
+
+Anything which needs the real tiles of a pending layer, such as painting
+on it, finishes decoding that layer first: see
+`lib.tiledsurface.MyPaintSurface.set_pending_load()`.
+
+Working files (see `lib.workingfile`) use a `MappedTileLoader` instead.
+Their layers' tiles are decompressed one at a time as they're needed,
+so there's nothing to do in the background.
+
+"""
+
+## Imports
+
+import zipfile
+import struct
+import functools
+import time
+import collections
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GObject
+
+import lib.helpers as helpers
+import lib.tiledsurface as tiledsurface
+import lib.workingfile as workingfile
+from lib.workerpool import WorkerPool
+import data
+
+
+## Module constants
+
+_PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+
+## Class defs
+
+class LazyLayerLoader (object):
+    """Decodes the data layers of a loaded document in the background
+
+    One of these is created by `RootLayerStack.load_from_openraster()`
+    when it's called with ``lazy=True``. It keeps its own handles on the
+    OpenRaster file open until every deferred layer has been decoded.
+
+    All methods must be called from the main thread.
+
+    """
+
+    def __init__(self, root, filename, threads=None):
+        """Initialize, opening the file for reading
+
+        :param RootLayerStack root: the root stack being loaded
+        :param unicode filename: the OpenRaster file being loaded
+        :param int threads: number of decoder threads (default: see
+          `lib.workerpool.get_default_threads()`)
+
+        The decoder threads are only started once the main loop runs.
+        """
+        super(LazyLayerLoader, self).__init__()
+        self._root = root
+        self._filename = filename
+        self._zip = zipfile.ZipFile(filename)
+        self._decoder = _ZipDecoder(filename)
+        self._threads = threads
+        self._pool = None
+        self._pending = []  # [(layer, bbox, src, x, y)], in load order
+        self._in_flight = {}  # {id(layer): result}
+        self._visible_rect = None
+        self._idle_id = None
+        #: True while a decoded layer is being loaded into its surface
+        self.decoding = False
+
+    @property
+    def finished(self):
+        """True once every deferred layer has been decoded"""
+        return not self._pending
+
+    ## Deferring layers
+
+    def defer(self, layer, src, x, y):
+        """Defers decoding a data layer's PNG
+
+        :param SurfaceBackedLayer layer: layer to load later
+        :param str src: name of the layer's PNG in the OpenRaster file
+        :param int x: model X coordinate of the PNG's top left corner
+        :param int y: model Y coordinate of the PNG's top left corner
+        :returns: whether decoding was deferred
+        :rtype: bool
+
+        The layer's bounding box is estimated from the PNG's header,
+        without decoding the image data. If that can't be done, the
+        layer should be decoded normally.
+
+        """
+        size = self._read_png_size(src)
+        if size is None:
+            return False
+        w, h = size
+        if w <= 0 or h <= 0:
+            return False
+        N = tiledsurface.N
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x + w - 1) // N, (y + h - 1) // N
+        bbox = helpers.Rect(
+            tx0 * N, ty0 * N,
+            (tx1 - tx0 + 1) * N, (ty1 - ty0 + 1) * N,
+        )
+        load_func = functools.partial(self._load_now, layer)
+        layer._surface.set_pending_load(load_func, bbox)
+        layer._record_ora_entry(self._filename, "layer", None, src, (x, y))
+        self._pending.append((layer, bbox, src, x, y))
+        if self._idle_id is None:
+            self._idle_id = GObject.idle_add(
+                self._idle_cb,
+                priority=GObject.PRIORITY_LOW,
+            )
+        return True
+
+    def _read_png_size(self, src):
+        """Reads the dimensions from a PNG member's IHDR chunk"""
+        try:
+            fp = self._zip.open(src)
+            try:
+                header = fp.read(24)
+            finally:
+                fp.close()
+        except (KeyError, IOError, zipfile.BadZipfile):
+            return None
+        if len(header) != 24 or not header.startswith(_PNG_SIGNATURE):
+            return None
+        if header[12:16] != "IHDR":
+            return None
+        return struct.unpack(">II", header[16:24])
+
+    ## Prioritization hints
+
+    def note_visible_tiles(self, tiles, mipmap_level):
+        """Notes which tiles are being rendered for display
+
+        :param iterable tiles: (tx, ty) tile coordinates
+        :param int mipmap_level: the mipmap level of `tiles`
+
+        Layers under the most recently displayed tiles are decoded
+        before others.
+
+        """
+        if not self._pending:
+            return
+        size = tiledsurface.N << mipmap_level
+        rect = None
+        for tx, ty in tiles:
+            tile_rect = helpers.Rect(tx*size, ty*size, size, size)
+            if rect is None:
+                rect = tile_rect
+            else:
+                rect.expandToIncludeRect(tile_rect)
+        if rect is not None:
+            self._visible_rect = rect
+
+    def tile_is_pending(self, tx, ty, mipmap_level):
+        """True if any layer covering a tile is still to be decoded"""
+        if not self._pending:
+            return False
+        size = tiledsurface.N << mipmap_level
+        tile_rect = helpers.Rect(tx*size, ty*size, size, size)
+        for entry in self._pending:
+            if entry[1].overlaps(tile_rect):
+                return True
+        return False
+
+    ## Decoding in the background
+
+    def _next_entry(self):
+        """Picks the pending layer to decode next, if any's left"""
+        current = self._root.current
+        visible = self._visible_rect
+        first = None
+        fallback = None
+        for entry in self._pending:
+            layer, bbox = entry[0:2]
+            if id(layer) in self._in_flight:
+                continue
+            if layer is current:
+                return entry
+            if fallback is None:
+                fallback = entry
+            if first is None and visible is not None:
+                if bbox.overlaps(visible):
+                    first = entry
+        return first or fallback
+
+    def _idle_cb(self):
+        self._idle_id = None
+        self._start_decoding()
+        return False
+
+    def _start_decoding(self):
+        """Keeps the worker threads busy with the next pending layers"""
+        if not self._pending:
+            return
+        if self._pool is None:
+            self._pool = WorkerPool(self._threads)
+        while len(self._in_flight) < self._pool.threads:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            layer, bbox, src, x, y = entry
+            self._in_flight[id(layer)] = self._pool.apply_async(
+                self._decode, layer, src, x, y,
+            )
+
+    def _decode(self, layer, src, x, y):
+        """Decodes a layer's PNG to a new surface (in a worker thread)
+
+        :returns: the decoded surface, or None if decoding failed
+
+        The result is also posted back to the main loop, which loads it
+        into the layer.
+        """
+        try:
+            surface = self._decoder.decode(src, x, y)
+        except Exception:
+            if id(layer) in self._in_flight:
+                logger.exception("Failed to decode %r", src)
+            surface = None
+        GObject.idle_add(self._decoded_idle_cb, layer, surface)
+        return surface
+
+    def _decoded_idle_cb(self, layer, surface):
+        """Loads a layer decoded by a worker (main thread)"""
+        if self._in_flight.pop(id(layer), None) is None:
+            return False  # already loaded on demand, or cancelled
+        entry = self._get_entry(layer)
+        layer._surface.set_pending_load(None, None)
+        self._install(entry, surface)
+        self._start_decoding()
+        return False
+
+    ## Loading
+
+    def _get_entry(self, layer):
+        for entry in self._pending:
+            if entry[0] is layer:
+                return entry
+        raise ValueError("%r isn't pending" % (layer,))
+
+    def _load_now(self, layer):
+        """Loads one deferred layer straight away (called via its surface)
+
+        If a worker is already decoding the layer, this waits for it.
+        """
+        entry = self._get_entry(layer)
+        result = self._in_flight.pop(id(layer), None)
+        if result is not None:
+            surface = self._pool.wait(result)
+        else:
+            layer, bbox, src, x, y = entry
+            try:
+                surface = self._decoder.decode(src, x, y)
+            except Exception:
+                logger.exception("Failed to decode %r", src)
+                surface = None
+        self._install(entry, surface)
+
+    def _install(self, entry, surface):
+        """Loads a decoded surface into its layer, and notifies"""
+        layer, bbox, src, x, y = entry
+        self._pending = [e for e in self._pending if e[0] is not layer]
+        self.decoding = True
+        try:
+            if surface is None:
+                logger.warning("Leaving %r empty", src)
+            else:
+                layer._load_surface_from_decoded_ora_entry(
+                    surface, self._filename, src, x, y,
+                )
+        except Exception:
+            logger.exception("Failed to load %r, leaving it empty", src)
+        finally:
+            # Pixels shown from the placeholder need redrawing too.
+            self._root.layer_content_changed(layer, *bbox)
+            self.decoding = False
+        if not self._pending:
+            self._finish()
+
+    def finish_all(self):
+        """Decodes every remaining deferred layer now"""
+        for entry in list(self._pending):
+            self._start_decoding()
+            entry[0]._surface.finish_pending_load()
+
+    def cancel(self):
+        """Abandons all deferred layers, leaving them empty"""
+        pending = self._pending
+        self._pending = []
+        self._in_flight.clear()
+        for entry in pending:
+            entry[0]._surface.set_pending_load(None, None)
+        self._finish()
+
+    def _finish(self):
+        if self._idle_id is not None:
+            GObject.source_remove(self._idle_id)
+            self._idle_id = None
+        if self._pool is not None:
+            self._pool.abort()
+            self._pool = None
+        self._decoder.close()
+        self._zip.close()
+        self._root._lazy_load_finished(self)
+
+
+class PooledLayerLoader (object):
+    """Decodes the data layers of a document being loaded in parallel
+
+    Used by `RootLayerStack.load_from_openraster()` for normal loads.
+    Reading the PNGs out of the file and decoding them happens in a
+    pool of worker threads, each with its own handle on the file. The
+    decoded surfaces are loaded into their layers in the thread which
+    owns the loader, in the order the layers were deferred, which is
+    stack order.
+
+    """
+
+    def __init__(self, filename, threads=None, feedback_cb=None):
+        """Initialize, with a pool of decoder threads
+
+        :param unicode filename: the OpenRaster file being loaded
+        :param int threads: number of decoder threads (default: see
+          `lib.workerpool.get_default_threads()`)
+        :param callable feedback_cb: called periodically while waiting
+
+        """
+        super(PooledLayerLoader, self).__init__()
+        self._filename = filename
+        self._pool = WorkerPool(threads, feedback_cb)
+        self._pending = collections.deque()
+        self._decoder = _ZipDecoder(filename)
+
+    ## Deferring layers
+
+    def defer(self, layer, src, x, y):
+        """Queues a data layer's PNG for decoding
+
+        :param SurfaceBackedLayer layer: layer to load
+        :param str src: name of the layer's PNG in the OpenRaster file
+        :param int x: model X coordinate of the PNG's top left corner
+        :param int y: model Y coordinate of the PNG's top left corner
+        :returns: whether decoding was deferred
+        :rtype: bool
+
+        If there's only one thread, nothing is deferred, and the layer
+        should be decoded normally.
+
+        """
+        if self._pool.threads == 1:
+            return False
+        result = self._pool.apply_async(self._decoder.decode, src, x, y)
+        self._pending.append((layer, src, x, y, result))
+        self._flush(block=False)
+        # Bound the amount of decoded data held in memory at once
+        while len(self._pending) > self._pool.max_pending:
+            self._load_one()
+        return True
+
+    ## Finishing up
+
+    def finish(self):
+        """Loads every remaining layer, waiting for decoders as needed
+
+        Any exception raised while decoding a layer is re-raised here,
+        or by an earlier call to `defer()`.
+        """
+        try:
+            self._flush(block=True)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops decoding, and releases all resources"""
+        self._pending.clear()
+        self._pool.abort()
+        self._decoder.close()
+
+    ## Internals
+
+    def _flush(self, block):
+        """Load decoded layers in order, optionally waiting for all"""
+        while self._pending:
+            result = self._pending[0][-1]
+            if not block and not result.ready():
+                return
+            self._load_one()
+
+    def _load_one(self):
+        """Load the oldest pending layer, waiting for it if needed"""
+        layer, src, x, y, result = self._pending[0]
+        surface = self._pool.wait(result)
+        self._pending.popleft()
+        layer._load_surface_from_decoded_ora_entry(surface, self._filename,
+                                                   src, x, y)
+
+
+class _ZipDecoder (object):
+    """Decodes layer PNGs from an OpenRaster file, in any thread
+
+    ZipFile objects can't be shared between threads, so each thread
+    gets its own handle on the file.
+
+    """
+
+    def __init__(self, filename):
+        super(_ZipDecoder, self).__init__()
+        self._filename = filename
+        self._local = threading.local()
+        self._zips = []
+        self._zips_lock = threading.Lock()
+
+    def decode(self, src, x, y):
+        """Decodes a PNG to a new surface"""
+        orazip = getattr(self._local, "orazip", None)
+        if orazip is None:
+            orazip = zipfile.ZipFile(self._filename)
+            self._local.orazip = orazip
+            with self._zips_lock:
+                self._zips.append(orazip)
+        t0 = time.time()
+        surface = data.SurfaceBackedLayer._decode_ora_entry(orazip, src,
+                                                            x, y)
+        logger.debug("%.3fs decoding %r", time.time() - t0, src)
+        return surface
+
+    def close(self):
+        """Closes every thread's handle on the file"""
+        with self._zips_lock:
+            for orazip in self._zips:
+                orazip.close()
+            self._zips = []
+
+
+class MappedTileLoader (object):
+    """Loads the data layers of a working file as memory-mapped tiles
+
+    Used by `lib.document.Document` when loading working files. Only
+    tile stores are handled: anything else is decoded normally.
+
+    """
+
+    def __init__(self, source, orazip):
+        """Initialize
+
+        :param lib.workingfile.TileSource source: the mapped file
+        :param zipfile.ZipFile orazip: the same file, opened as a ZIP
+
+        """
+        super(MappedTileLoader, self).__init__()
+        self._source = source
+        self._zip = orazip
+
+    def defer(self, layer, src, x, y):
+        """Loads a data layer's tile store, if it has one
+
+        :param SurfaceBackedLayer layer: layer to load
+        :param str src: name of the layer's data in the working file
+        :param int x: ignored: tile stores use model coordinates
+        :param int y: ignored: tile stores use model coordinates
+        :returns: whether the layer was loaded
+        :rtype: bool
+
+        """
+        if not src.endswith(workingfile.TILES_SUFFIX):
+            return False
+        t0 = time.time()
+        tiles = self._source.load_tiles(self._zip.getinfo(src))
+        layer._load_surface_from_mapped_tiles(tiles, self._zip.filename, src)
+        logger.debug("%.3fs mapping %d tiles from %r",
+                     time.time() - t0, len(tiles), src)
+        return True
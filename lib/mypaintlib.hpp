@@ -23,5 +23,6 @@
 #include "colorchanger_crossed_bowl.hpp"
 #include "gdkpixbuf2numpy.hpp"
 #include "fastpng.hpp"
+#include "fastjpeg.hpp"
 #include "fill.hpp"
 #include "eventhack.hpp"
@@ -75,6 +75,29 @@ def save(pixbuf, filename, type='png', **kwargs):
         return result
 
 
+def encode(pixbuf, type='png', **kwargs):
+    """Encode a pixbuf in memory, returning the file data
+
+    :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to encode
+    :param str type: type to encode as: 'jpeg'/'png'/...
+    :param \*\*kwargs: passed through to GdkPixbuf
+    :rtype: str
+
+    >>> p = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,True,8,64,64)
+    >>> encode(p, "png").startswith("\x89PNG")
+    True
+
+    """
+    chunks = []
+    writer = lambda buf, size, data: chunks.append(str(buf)) or True
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        save_to_callbackv = pixbuf.save_to_callback
+    save_to_callbackv(writer, None, type, kwargs.keys(), kwargs.values())
+    return "".join(chunks)
+
+
 def load_from_file(filename, feedback_cb=None):
     """Load a pixbuf from a named file
 
@@ -118,6 +141,69 @@ def load_from_stream(fp, feedback_cb=None):
     return loader.get_pixbuf()
 
 
+def load_from_stream_in_strips(fp, strip_cb, feedback_cb=None):
+    """Load a pixbuf from a file-like object, a strip at a time
+
+    :param fp: file-like object opened for reading
+    :param callable strip_cb: called as ``strip_cb(pixbuf, y, h)``
+    :param callable feedback_cb: invoked to provide feedback to the user
+    :rtype: GdkPixbuf.Pixbuf
+    :returns: the loaded pixbuf
+
+    As soon as a strip of full-width rows has been decoded, it's passed
+    to `strip_cb` so that the caller can convert it to something else
+    while the rest of the file is still being read. The strip is rows
+    ``y`` to ``y+h-1`` of the partially loaded pixbuf.
+
+    Strips normally arrive in order, top to bottom, each once. Loaders
+    for progressive or interlaced formats update rows more than once,
+    however. If that happens, streaming stops and all rows are passed
+    again once the load is complete, so `strip_cb` must be prepared to
+    see rows it's already had.
+
+    >>> fp = open("pixmaps/mypaint_logo.png")
+    >>> rows = []
+    >>> def strip_cb(pixbuf, y, h):
+    ...     rows.extend(xrange(y, y+h))
+    >>> pixbuf = load_from_stream_in_strips(fp, strip_cb)
+    >>> rows[-pixbuf.get_height():] == range(pixbuf.get_height())
+    True
+
+    """
+    loader = GdkPixbuf.PixbufLoader()
+    state = {"done": 0, "streaming": True}
+
+    def area_updated_cb(loader, x, y, w, h):
+        if not state["streaming"]:
+            return
+        pixbuf = loader.get_pixbuf()
+        done = state["done"]
+        if x != 0 or w != pixbuf.get_width() or y != done:
+            # Partial rows, or another pass over rows already done
+            state["streaming"] = False
+            return
+        strip_cb(pixbuf, y, h)
+        state["done"] = y + h
+
+    loader.connect("area-updated", area_updated_cb)
+    while True:
+        if feedback_cb is not None:
+            feedback_cb()
+        buf = fp.read(LOAD_CHUNK_SIZE)
+        if buf == '':
+            break
+        loader.write(buf)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    height = pixbuf.get_height()
+    if not state["streaming"]:
+        logger.debug("Rows were updated out of order: reloading all")
+        state["done"] = 0
+    if state["done"] < height:
+        strip_cb(pixbuf, state["done"], height - state["done"])
+    return pixbuf
+
+
 def load_from_zipfile(datazip, filename, feedback_cb=None):
     """Extract and return a pixbuf from a zipfile entry
 
@@ -117,6 +117,141 @@ class Surface (object):
 # throttle excesssive calls to the save/render feedback_cb
 TILES_PER_CALLBACK = 256
 
+#: PNG compression profiles, for the `png_compression` option of
+#: `save_as_png()`: "fast" trades file size for encoding speed, for
+#: autosaves and intermediate files, and "best" is for final exports.
+PNG_COMPRESSION_PROFILES = {
+    "fast": mypaintlib.FASTPNG_COMPRESSION_FAST,
+    "default": mypaintlib.FASTPNG_COMPRESSION_DEFAULT,
+    "best": mypaintlib.FASTPNG_COMPRESSION_BEST,
+}
+
+
+#: Size of the thumbnails made by `ScanlineThumbnailer` (box, px)
+THUMBNAIL_SIZE = 256
+
+
+class ScanlineThumbnailer (object):
+    """Builds a thumbnail from the strips streamed to an image writer
+
+    Pass one of these as the ``thumbnail`` option of `save_as_png()`,
+    `encode_as_png()`, or `save_as_jpeg()`, and it sees every strip of
+    pixels as it goes to the encoder. That makes the thumbnail almost
+    free: nothing has to be rendered a second time to make it.
+
+    The strips are shrunk by a power of two as they arrive, by averaging
+    each block of pixels, just like a mipmap level of the image would
+    be. The reduced image is scaled to its final size once complete.
+
+    >>> thumbnailer = ScanlineThumbnailer()
+    >>> thumbnailer.start(1000, 600, alpha=False)
+    >>> thumbnailer.reduced_size
+    (500, 300)
+    >>> strip = numpy.zeros((N, 1000, 4), 'uint8')
+    >>> for i in xrange(600 // N):
+    ...     thumbnailer.add_strip(strip)
+    >>> thumbnailer.get_pixbuf() is None   # incomplete
+    True
+
+    """
+
+    def __init__(self, size=THUMBNAIL_SIZE):
+        """Initialize, ready to be started
+
+        :param int size: Max width and height of the thumbnail
+        """
+        super(ScanlineThumbnailer, self).__init__()
+        self.size = size
+        self._w = self._h = 0
+        self._alpha = False
+        self._factor = 1
+        self._y = 0
+        self._acc = None
+        self._col_starts = None
+
+    @property
+    def reduced_size(self):
+        """Size of the shrunk image, before the final scaling"""
+        f = self._factor
+        return ((self._w + f - 1) // f, (self._h + f - 1) // f)
+
+    def start(self, w, h, alpha):
+        """Prepares for a new image's strips
+
+        :param int w: Width of the image
+        :param int h: Height of the image
+        :param bool alpha: Whether the strips are RGBA (not RGBU)
+
+        The shrink factor is chosen in the same way as the mipmap level
+        used by `lib.layer.RootLayerStack.render_thumbnail()`.
+        """
+        factor = 1
+        level = 0
+        while (level < mypaintlib.MAX_MIPMAP_LEVEL and
+               max(w, h) // factor >= 2 * THUMBNAIL_SIZE):
+            level += 1
+            factor *= 2
+        self._w, self._h = w, h
+        self._alpha = alpha
+        self._factor = factor
+        self._y = 0
+        rw, rh = self.reduced_size
+        self._acc = numpy.zeros((rh, rw, 4), 'uint32')
+        self._col_starts = numpy.arange(0, w, factor)
+
+    def add_strip(self, strip):
+        """Adds the next strip of pixels
+
+        :param numpy.ndarray strip: uint8 rows, shape (rows, w, 4)
+
+        RGBA strips must not be premultiplied, as for the PNG writer.
+        """
+        rows = strip.shape[0]
+        if rows == 0:
+            return
+        f = self._factor
+        px = strip.astype('uint32')
+        if self._alpha:
+            px[..., :3] *= px[..., 3:4]
+        cols = numpy.add.reduceat(px, self._col_starts, axis=1)
+        ys = numpy.arange(self._y, self._y + rows)
+        row_starts = numpy.flatnonzero((ys % f == 0) | (ys == self._y))
+        sums = numpy.add.reduceat(cols, row_starts, axis=0)
+        self._acc[ys[row_starts] // f] += sums
+        self._y += rows
+
+    def get_pixbuf(self):
+        """Returns the finished thumbnail
+
+        :returns: the thumbnail, or None if not all strips were added
+        :rtype: GdkPixbuf.Pixbuf
+        """
+        if self._acc is None or self._y < self._h:
+            return None
+        f = self._factor
+        w, h = self._w, self._h
+        rw, rh = self.reduced_size
+        # Pixels in each block: blocks at the right and bottom edges
+        # may be partial.
+        bw = numpy.minimum(f, w - numpy.arange(rw) * f)
+        bh = numpy.minimum(f, h - numpy.arange(rh) * f)
+        counts = (bh[:, numpy.newaxis] * bw[numpy.newaxis, :]).astype(float)
+        acc = self._acc.astype(float)
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                      rw, rh)
+        dst = helpers.gdkpixbuf2numpy(pixbuf)
+        if self._alpha:
+            alpha = acc[..., 3]
+            weight = numpy.where(alpha > 0, alpha, 1.0)
+            rgb = acc[..., :3] / weight[..., numpy.newaxis]
+            dst[..., :3] = numpy.clip(rgb + 0.5, 0, 255)
+            dst[..., 3] = numpy.clip(alpha / counts + 0.5, 0, 255)
+        else:
+            rgb = acc[..., :3] / counts[..., numpy.newaxis]
+            dst[..., :3] = numpy.clip(rgb + 0.5, 0, 255)
+            dst[..., 3] = 255
+        return helpers.scale_proportionally(pixbuf, self.size, self.size)
+
 
 def render_as_pixbuf(surface, *rect, **kwargs):
     """Renders a surface within a given rectangle as a GdkPixbuf
@@ -159,6 +294,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
     :param callable feedback_cb: Called every TILES_PER_CALLBACK tiles.
     :param bool single_tile_pattern: True if surface is a one tile only.
     :param bool save_srgb_chunks: Set to False to not save sRGB flags.
+    :param str png_compression: Key in PNG_COMPRESSION_PROFILES.
+    :param ScanlineThumbnailer thumbnail: Fed the strips as they're saved.
     :param tuple \*\*kwargs: Passed to blit_tile_into (minus the above)
 
     The `alpha` parameter is passed to the surface's `blit_tile_into()`
@@ -173,11 +310,103 @@ def save_as_png(surface, filename, *rect, **kwargs):
     Raises `lib.errors.FileHandlingError` with a descriptive string if
     something went wrong.
 
+    """
+    w, h, alpha, scanlines, save_srgb_chunks, compression = \
+        _get_scanlines(surface, rect, kwargs)
+    filename_sys = filename.encode(sys.getfilesystemencoding())
+    # FIXME: should not do that, should use open(unicode_object)
+    try:
+        mypaintlib.save_png_fast_progressive(
+            filename_sys,
+            w, h,
+            alpha,
+            scanlines,
+            save_srgb_chunks,
+            compression,
+        )
+    except (IOError, OSError, RuntimeError) as err:
+        raise FileHandlingError(_("PNG writer failed: %s") % (err,))
+
+
+def encode_as_png(surface, *rect, **kwargs):
+    """Encodes a surface in PNG format, in memory
+
+    :param lib.pixbufsurface.Surface surface: Surface to encode
+    :param tuple \*rect: Rectangle (x, y, w, h) to encode
+    :param \*\*kwargs: As for `save_as_png()`
+    :returns: the PNG file's data
+    :rtype: str
+
+    This works like `save_as_png()`, but returns the data instead of
+    writing a file. Compression happens without the GIL held, so
+    several surfaces can be encoded at once from worker threads.
+
+    """
+    w, h, alpha, scanlines, save_srgb_chunks, compression = \
+        _get_scanlines(surface, rect, kwargs)
+    try:
+        return mypaintlib.encode_png_fast_progressive(
+            w, h,
+            alpha,
+            scanlines,
+            save_srgb_chunks,
+            compression,
+        )
+    except (MemoryError, RuntimeError) as err:
+        raise FileHandlingError(_("PNG writer failed: %s") % (err,))
+
+
+def save_as_jpeg(surface, filename, *rect, **kwargs):
+    """Saves a surface to a file in JPEG format, flattened
+
+    :param lib.pixbufsurface.Surface surface: Surface to save
+    :param str filename: The file to write
+    :param tuple \*rect: Rectangle (x, y, w, h) to save
+    :param int quality: JPEG quality, 0 to 100 (default: 90)
+    :param \*\*kwargs: As for `save_as_png()`, except for `alpha`
+
+    Like `save_as_png()`, the surface is rendered one tile row at a
+    time and streamed to the encoder, so no image of the full size is
+    ever made.
+
+    """
+    quality = int(kwargs.pop("quality", 90))
+    kwargs["alpha"] = False
+    w, h, alpha, scanlines, save_srgb_chunks, compression = \
+        _get_scanlines(surface, rect, kwargs)
+    filename_sys = filename.encode(sys.getfilesystemencoding())
+    try:
+        mypaintlib.save_jpeg_fast_progressive(
+            filename_sys,
+            w, h,
+            scanlines,
+            max(0, min(100, quality)),
+        )
+    except (IOError, OSError, RuntimeError) as err:
+        raise FileHandlingError(_("JPEG writer failed: %s") % (err,))
+
+
+def _get_scanlines(surface, rect, kwargs):
+    """Internal: set up rendering of a surface for the PNG/JPEG writers
+
+    :returns: (w, h, alpha, scanline_generator, save_srgb_chunks,
+      compression)
+
+    The options documented for `save_as_png()` are popped from
+    `kwargs`, and everything else left there is passed on to the
+    surface's `blit_tile_into()`.
+
     """
     alpha = kwargs.pop('alpha', False)
     feedback_cb = kwargs.pop('feedback_cb', None)
     single_tile_pattern = kwargs.pop("single_tile_pattern", False)
     save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
+    profile = kwargs.pop("png_compression", None) or "default"
+    thumbnail = kwargs.pop("thumbnail", None)
+    try:
+        compression = PNG_COMPRESSION_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown PNG compression profile %r" % (profile,))
     if not rect:
         rect = surface.get_bbox()
     x, y, w, h = rect
@@ -199,6 +428,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
     first_row = render_ty
     last_row = render_ty+render_th-1
 
+    if thumbnail is not None:
+        thumbnail.start(w, h, alpha)
+
     def render_tile_scanlines():
         feedback_counter = 0
         for ty in range(render_ty, render_ty+render_th):
@@ -230,17 +462,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
                 res = res[:y+h-ty*N, :, :]
             if ty == first_row:
                 res = res[y-render_ty*N:, :, :]
+            if thumbnail is not None:
+                thumbnail.add_strip(res)
             yield res
 
-    filename_sys = filename.encode(sys.getfilesystemencoding())
-    # FIXME: should not do that, should use open(unicode_object)
-    try:
-        mypaintlib.save_png_fast_progressive(
-            filename_sys,
-            w, h,
-            alpha,
-            render_tile_scanlines(),
-            save_srgb_chunks,
-        )
-    except (IOError, OSError, RuntimeError) as err:
-        raise FileHandlingError(_("PNG writer failed: %s") % (err,))
+    return (w, h, alpha, render_tile_scanlines(), save_srgb_chunks,
+            compression)
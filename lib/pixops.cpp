@@ -16,6 +16,7 @@
 #include <mypaint-tiled-surface.h>
 
 #include <glib.h>
+#include <vector>
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #define NO_IMPORT_ARRAY
@@ -67,6 +68,110 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y) {
 }
 
 
+static inline void
+tile_blend_upscaled_rgba8_c(const uint8_t *src, const int src_strides,
+                            const int src_x, const int src_y,
+                            const uint32_t src_weight,
+                            uint8_t *dst, const int dst_strides)
+{
+  // Weights are out of 256 for the blend, and out of 16 for the bilinear
+  // samples. Colors are premultiplied while they're mixed, so the sums
+  // stay well within 32 bits: at most 255*255*16*256 for each part.
+  static const uint32_t sample_weights[4] = {9, 3, 3, 1};
+  const uint32_t dst_weight = 256 - src_weight;
+  const int last = MYPAINT_TILE_SIZE - 1;
+
+  for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
+    // Each upscaled pixel's centre lies a quarter of a source pixel from
+    // the nearest source pixel's centre, towards the next one out.
+    const int sy = src_y + y/2;
+    const int sy_far = CLAMP((y % 2) ? sy+1 : sy-1, 0, last);
+    const uint8_t *row_near = (uint8_t *)((char *)src + sy*src_strides);
+    const uint8_t *row_far = (uint8_t *)((char *)src + sy_far*src_strides);
+    uint8_t *dst_p = (uint8_t *)((char *)dst + y*dst_strides);
+    for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
+      const int sx = src_x + x/2;
+      const int sx_far = CLAMP((x % 2) ? sx+1 : sx-1, 0, last);
+      const uint8_t *samples[4] = {
+        row_near + 4*sx, row_near + 4*sx_far,
+        row_far + 4*sx, row_far + 4*sx_far,
+      };
+      uint32_t src_a = 0;
+      uint32_t src_c[3] = {0, 0, 0};
+      for (int i=0; i<4; i++) {
+        src_a += samples[i][3] * sample_weights[i];
+      }
+      if (src_a == 255*16 && dst_p[3] == 255) {
+        // Opaque, the usual case for the display: no need to divide
+        for (int i=0; i<4; i++) {
+          src_c[0] += samples[i][0] * sample_weights[i];
+          src_c[1] += samples[i][1] * sample_weights[i];
+          src_c[2] += samples[i][2] * sample_weights[i];
+        }
+        for (int c=0; c<3; c++) {
+          const uint32_t v = (dst_p[c] * 16 * dst_weight
+                              + src_c[c] * src_weight);
+          dst_p[c] = (v + 16*256/2) / (16*256);
+        }
+        dst_p += 4;
+        continue;
+      }
+      for (int i=0; i<4; i++) {
+        const uint32_t a = samples[i][3] * sample_weights[i];
+        src_c[0] += samples[i][0] * a;
+        src_c[1] += samples[i][1] * a;
+        src_c[2] += samples[i][2] * a;
+      }
+      const uint32_t dst_a = dst_p[3] * 16 * dst_weight;
+      const uint32_t a = dst_a + src_a * src_weight;
+      for (int c=0; c<3; c++) {
+        const uint32_t v = dst_p[c] * dst_a + src_c[c] * src_weight;
+        dst_p[c] = (a != 0) ? ((v + a/2) / a) : 0;
+      }
+      dst_p[3] = (a + 16*256/2) / (16*256);
+      dst_p += 4;
+    }
+  }
+}
+
+void tile_blend_upscaled_rgba8(PyObject *src, int src_x, int src_y,
+                               double weight, PyObject *dst) {
+
+  PyArrayObject* src_arr = ((PyArrayObject*)src);
+  PyArrayObject* dst_arr = ((PyArrayObject*)dst);
+
+#ifdef HEAVY_DEBUG
+  assert(PyArray_Check(src));
+  assert(PyArray_DIM(src_arr, 0) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(src_arr, 1) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(src_arr, 2) == 4);
+  assert(PyArray_TYPE(src_arr) == NPY_UINT8);
+  assert(PyArray_ISBEHAVED(src_arr));
+  assert(PyArray_STRIDE(src_arr, 1) == 4*sizeof(uint8_t));
+  assert(PyArray_STRIDE(src_arr, 2) == sizeof(uint8_t));
+
+  assert(PyArray_Check(dst));
+  assert(PyArray_DIM(dst_arr, 0) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(dst_arr, 1) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(dst_arr, 2) == 4);
+  assert(PyArray_TYPE(dst_arr) == NPY_UINT8);
+  assert(PyArray_ISBEHAVED(dst_arr));
+  assert(PyArray_STRIDE(dst_arr, 1) == 4*sizeof(uint8_t));
+  assert(PyArray_STRIDE(dst_arr, 2) == sizeof(uint8_t));
+
+  assert(src_x >= 0 && src_x <= MYPAINT_TILE_SIZE/2);
+  assert(src_y >= 0 && src_y <= MYPAINT_TILE_SIZE/2);
+#endif
+
+  const uint32_t src_weight = (uint32_t)(CLAMP(weight, 0.0, 1.0)*256 + 0.5);
+  tile_blend_upscaled_rgba8_c((uint8_t*)PyArray_DATA(src_arr),
+                              PyArray_STRIDES(src_arr)[0],
+                              src_x, src_y, src_weight,
+                              (uint8_t*)PyArray_DATA(dst_arr),
+                              PyArray_STRIDES(dst_arr)[0]);
+}
+
+
 void tile_copy_rgba16_into_rgba16_c(const uint16_t *src, uint16_t *dst) {
   memcpy(dst, src, MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4*sizeof(uint16_t));
 }
@@ -741,3 +846,300 @@ tile_combine (enum CombineMode mode,
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
 }
 
+
+
+
+/* Op lists: compositing many tiles in a single call */
+
+
+static const int tile_rgba16_size = MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4;
+static const int tile_rgba16_stride = MYPAINT_TILE_SIZE*4*sizeof(fix15_short_t);
+
+// Isolated groups can't reasonably nest deeper than this
+static const int max_op_group_depth = 64;
+
+
+// One parsed compositing operation from a Python ops list. Nested groups
+// are flattened into a begin/end pair around the group's own ops.
+
+enum TileCombineOpType {
+    TileCombineOpTile,        // combine src into the current tile
+    TileCombineOpGroupBegin,  // start compositing into a transparent temp
+    TileCombineOpGroupEnd     // combine the temp into the tile below it
+};
+
+struct TileCombineOp {
+    enum TileCombineOpType type;
+    const fix15_short_t *src;
+    enum CombineMode mode;
+    float opacity;
+};
+
+
+// Tests whether an object is a contiguous 15-bit RGBA tile array
+
+static bool
+is_rgba16_tile (PyObject *obj)
+{
+    if (! PyArray_Check(obj)) {
+        return false;
+    }
+    PyArrayObject *arr = (PyArrayObject *)obj;
+    return (PyArray_NDIM(arr) == 3
+            && PyArray_DIM(arr, 0) == MYPAINT_TILE_SIZE
+            && PyArray_DIM(arr, 1) == MYPAINT_TILE_SIZE
+            && PyArray_DIM(arr, 2) == 4
+            && PyArray_TYPE(arr) == NPY_UINT16
+            && PyArray_ISCARRAY(arr));
+}
+
+
+// Parses a sequence of (src, mode, opacity) into a vector of ops, where src
+// is a tile array or a nested sequence of the same form. Source arrays are
+// added to `refs` with a new reference, so that they stay alive while the
+// GIL is released. Returns false with an exception set on errors.
+
+static bool
+parse_tile_combine_ops (PyObject *ops_obj,
+                        std::vector<TileCombineOp> &ops,
+                        std::vector<PyObject *> &refs,
+                        int depth)
+{
+    if (depth > max_op_group_depth) {
+        PyErr_SetString(PyExc_ValueError, "ops nested too deeply");
+        return false;
+    }
+    PyObject *seq = PySequence_Fast(ops_obj, "ops must be a sequence");
+    if (! seq) {
+        return false;
+    }
+    const Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    ops.reserve(ops.size() + n);
+    bool ok = true;
+    for (Py_ssize_t i = 0; ok && i < n; ++i) {
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+        PyObject *src_obj = NULL;
+        int mode = CombineNormal;
+        float opacity = 1.0;
+        if (! PyArg_ParseTuple(item, "Oif", &src_obj, &mode, &opacity)) {
+            ok = false;
+            break;
+        }
+        if (mode < 0 || mode >= NumCombineModes) {
+            PyErr_Format(PyExc_ValueError, "unknown combine mode %d", mode);
+            ok = false;
+            break;
+        }
+        TileCombineOp op;
+        op.src = NULL;
+        op.mode = (enum CombineMode)mode;
+        op.opacity = opacity;
+        if (is_rgba16_tile(src_obj)) {
+            op.type = TileCombineOpTile;
+            op.src = (const fix15_short_t *)
+                     PyArray_DATA((PyArrayObject *)src_obj);
+            Py_INCREF(src_obj);
+            refs.push_back(src_obj);
+            ops.push_back(op);
+        }
+        else if (! PyArray_Check(src_obj) && PySequence_Check(src_obj)) {
+            op.type = TileCombineOpGroupBegin;
+            ops.push_back(op);
+            ok = parse_tile_combine_ops(src_obj, ops, refs, depth+1);
+            op.type = TileCombineOpGroupEnd;
+            ops.push_back(op);
+        }
+        else {
+            PyErr_SetString(PyExc_TypeError,
+                            "op source must be a uint16 RGBA tile array "
+                            "or a nested sequence of ops");
+            ok = false;
+        }
+    }
+    Py_DECREF(seq);
+    return ok;
+}
+
+
+static void
+release_tile_combine_refs (std::vector<PyObject *> &refs)
+{
+    for (size_t i = 0; i < refs.size(); ++i) {
+        Py_DECREF(refs[i]);
+    }
+    refs.clear();
+}
+
+
+// Runs parsed ops over a tile. Doesn't touch any Python objects, so it can
+// run with the GIL released. Groups composite into a transparent temporary
+// tile with alpha, which is then combined into the tile below.
+
+static void
+tile_combine_ops_c (const std::vector<TileCombineOp> &ops,
+                    fix15_short_t *dst_p,
+                    const bool dst_has_alpha)
+{
+    // Reserved up front: growing this would move the buffers in use.
+    std::vector<std::vector<fix15_short_t> > temps;
+    temps.reserve(max_op_group_depth + 1);
+    std::vector<fix15_short_t *> targets;
+    fix15_short_t *target = dst_p;
+    bool target_has_alpha = dst_has_alpha;
+    for (size_t i = 0; i < ops.size(); ++i) {
+        const TileCombineOp &op = ops[i];
+        const TileDataCombineOp *combine_op = combine_mode_info[op.mode];
+        switch (op.type) {
+        case TileCombineOpTile:
+            combine_op->combine_data(op.src, target, target_has_alpha,
+                                     op.opacity);
+            break;
+        case TileCombineOpGroupBegin:
+            targets.push_back(target);
+            if (temps.size() < targets.size()) {
+                temps.push_back(std::vector<fix15_short_t>(tile_rgba16_size));
+            }
+            target = &(temps[targets.size()-1][0]);
+            memset(target, 0, tile_rgba16_size*sizeof(fix15_short_t));
+            target_has_alpha = true;
+            break;
+        case TileCombineOpGroupEnd:
+            {
+                const fix15_short_t *group_p = target;
+                target = targets.back();
+                targets.pop_back();
+                target_has_alpha = targets.empty() ? dst_has_alpha : true;
+                combine_op->combine_data(group_p, target, target_has_alpha,
+                                         op.opacity);
+            }
+            break;
+        }
+    }
+}
+
+
+/* tile_combine_ops(): composite many tiles in one call */
+
+
+PyObject *
+tile_combine_ops (PyObject *ops_obj,
+                  PyObject *dst_obj,
+                  const bool dst_has_alpha)
+{
+    if (! is_rgba16_tile(dst_obj)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "dst must be a uint16 RGBA tile array");
+        return NULL;
+    }
+    std::vector<TileCombineOp> ops;
+    std::vector<PyObject *> refs;
+    if (! parse_tile_combine_ops(ops_obj, ops, refs, 0)) {
+        release_tile_combine_refs(refs);
+        return NULL;
+    }
+    fix15_short_t *dst_p = (fix15_short_t *)
+                           PyArray_DATA((PyArrayObject *)dst_obj);
+    Py_BEGIN_ALLOW_THREADS
+    tile_combine_ops_c(ops, dst_p, dst_has_alpha);
+    Py_END_ALLOW_THREADS
+    release_tile_combine_refs(refs);
+    Py_RETURN_NONE;
+}
+
+
+/* tile_composite_rgba8(): fused compositing and conversion for display */
+
+
+static void
+tile_composite_rgba8_c (const std::vector<TileCombineOp> &ops,
+                        const fix15_short_t *bg_p,
+                        const fix15_short_t *opaque_base_p,
+                        uint8_t *dst_p,
+                        const int dst_stride,
+                        const bool dst_has_alpha)
+{
+    // Scratch tile: composite everything here before converting
+    fix15_short_t buf[tile_rgba16_size];
+    if (bg_p) {
+        memcpy(buf, bg_p, sizeof(buf));
+    }
+    else {
+        memset(buf, 0, sizeof(buf));
+    }
+    tile_combine_ops_c(ops, buf, dst_has_alpha);
+
+    if (dst_has_alpha && opaque_base_p) {
+        fix15_short_t base[tile_rgba16_size];
+        memcpy(base, opaque_base_p, sizeof(base));
+        const TileDataCombineOp *normal = combine_mode_info[CombineNormal];
+        normal->combine_data(buf, base, false, 1.0);
+        tile_convert_rgbu16_to_rgbu8_c(base, tile_rgba16_stride,
+                                       dst_p, dst_stride);
+    }
+    else if (dst_has_alpha) {
+        tile_convert_rgba16_to_rgba8_c(buf, tile_rgba16_stride,
+                                       dst_p, dst_stride);
+    }
+    else {
+        tile_convert_rgbu16_to_rgbu8_c(buf, tile_rgba16_stride,
+                                       dst_p, dst_stride);
+    }
+}
+
+
+PyObject *
+tile_composite_rgba8 (PyObject *ops_obj,
+                      PyObject *bg_obj,
+                      PyObject *opaque_base_obj,
+                      PyObject *dst_obj,
+                      const bool dst_has_alpha)
+{
+    if (bg_obj != Py_None && ! is_rgba16_tile(bg_obj)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "bg must be None or a uint16 RGBA tile array");
+        return NULL;
+    }
+    if (opaque_base_obj != Py_None && ! is_rgba16_tile(opaque_base_obj)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "opaque_base must be None or a uint16 RGBA tile array");
+        return NULL;
+    }
+    PyArrayObject* dst = ((PyArrayObject*)dst_obj);
+    if (! (PyArray_Check(dst_obj)
+           && PyArray_NDIM(dst) == 3
+           && PyArray_DIM(dst, 0) == MYPAINT_TILE_SIZE
+           && PyArray_DIM(dst, 1) == MYPAINT_TILE_SIZE
+           && PyArray_DIM(dst, 2) == 4
+           && PyArray_TYPE(dst) == NPY_UINT8
+           && PyArray_ISBEHAVED(dst)
+           && PyArray_STRIDE(dst, 1) == 4*sizeof(uint8_t)
+           && PyArray_STRIDE(dst, 2) == sizeof(uint8_t)))
+    {
+        PyErr_SetString(PyExc_TypeError,
+                        "dst must be a writeable uint8 RGBA tile array");
+        return NULL;
+    }
+    std::vector<TileCombineOp> ops;
+    std::vector<PyObject *> refs;
+    if (! parse_tile_combine_ops(ops_obj, ops, refs, 0)) {
+        release_tile_combine_refs(refs);
+        return NULL;
+    }
+    const fix15_short_t *bg_p = NULL;
+    if (bg_obj != Py_None) {
+        bg_p = (const fix15_short_t *)PyArray_DATA((PyArrayObject*)bg_obj);
+    }
+    const fix15_short_t *opaque_base_p = NULL;
+    if (opaque_base_obj != Py_None) {
+        opaque_base_p = (const fix15_short_t *)
+                        PyArray_DATA((PyArrayObject*)opaque_base_obj);
+    }
+    uint8_t *dst_p = (uint8_t *)PyArray_DATA(dst);
+    const int dst_stride = PyArray_STRIDE(dst, 0);
+    Py_BEGIN_ALLOW_THREADS
+    tile_composite_rgba8_c(ops, bg_p, opaque_base_p,
+                           dst_p, dst_stride, dst_has_alpha);
+    Py_END_ALLOW_THREADS
+    release_tile_combine_refs(refs);
+    Py_RETURN_NONE;
+}
@@ -20,6 +20,15 @@
 void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y);
 
 
+// Blends an 8bpp RGBA tile with a quarter of the tile at the next coarser
+// mipmap level, upscaled 2x with bilinear interpolation. The quarter starts
+// at (src_x, src_y) in src, and src has the given weight (0..1) in the
+// result. Used for high quality zoom at fractional scales.
+
+void tile_blend_upscaled_rgba8(PyObject *src, int src_x, int src_y,
+                               double weight, PyObject *dst);
+
+
 // Used to e.g. copy the background before starting to composite over it
 //
 // Simple array copying (numpy assignment operator) is about 13 times slower,
@@ -130,4 +139,42 @@ tile_combine (enum CombineMode mode,
               const float src_opacity);
 
 
+// Composites an ordered list of tiles into a 15-bit destination tile in one
+// call, as if tile_combine() had been called for each.
+//
+// `ops` is a sequence of (src, mode, opacity) tuples. Each src is either a
+// 15-bit RGBA tile, or a nested sequence of ops for an isolated group. A
+// group's ops are applied over a transparent temporary tile, which is then
+// combined into the tile below using the group's mode and opacity.
+// The GIL is released while compositing.
+//
+// Returns None, or NULL with an exception set if an argument is malformed.
+
+PyObject *
+tile_combine_ops (PyObject *ops,
+                  PyObject *dst,
+                  const bool dst_has_alpha);
+
+
+// Composites a list of tiles over a background, and converts the result to
+// 8bpp RGBA or RGBU in the destination. Used for display.
+//
+// `ops` is a sequence of (src, mode, opacity) tuples, as for
+// tile_combine_ops(). They are applied in order over `bg`, which may be None
+// for an empty backdrop. If dst_has_alpha is true and `opaque_base` is not None,
+// the result is composited over the opaque_base tile, and written to dst as
+// RGBU. Intermediate results live in a scratch tile which is small enough to
+// stay in the CPU cache, so dst is only touched once. The GIL is released
+// while compositing.
+//
+// Returns None, or NULL with an exception set if an argument is malformed.
+
+PyObject *
+tile_composite_rgba8 (PyObject *ops,
+                      PyObject *bg,
+                      PyObject *opaque_base,
+                      PyObject *dst,
+                      const bool dst_has_alpha);
+
+
 #endif // PIXOPS_HPP
@@ -0,0 +1,296 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Headless rendering of documents to flat image files
+
+This module backs the ``mypaint-render`` command, which flattens
+OpenRaster (and other loadable) documents to PNG or JPEG files without
+starting the GUI. Many files can be processed at once across a pool of
+worker processes, and a JSON object with per-file timings is written to
+stdout for each file as it completes.
+
+"""
+
+## Imports
+
+import os
+import sys
+import time
+import json
+import multiprocessing
+from optparse import OptionParser
+import logging
+logger = logging.getLogger(__name__)
+
+import tiledsurface
+import document
+import lib.pixbuf
+
+
+## Module constants
+
+N = tiledsurface.N
+
+#: Output formats, and the file extension used for each
+OUTPUT_FORMATS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+}
+
+#: Aliases accepted for the output formats above
+OUTPUT_FORMAT_ALIASES = {
+    "jpg": "jpeg",
+}
+
+#: Bounding box modes: the document frame, or all the layer data
+BBOX_FRAME = "frame"
+BBOX_DATA = "data"
+
+
+## Rendering
+
+def render_file(infile, outfile, format=None, bbox=BBOX_FRAME,
+                mipmap_level=0, alpha=False, quality=90):
+    """Renders a document file to a flat PNG or JPEG file
+
+    :param unicode infile: Document to load, e.g. an OpenRaster file
+    :param unicode outfile: Image file to write
+    :param str format: "png" or "jpeg"; None means guess from `outfile`
+    :param str bbox: `BBOX_FRAME` or `BBOX_DATA`
+    :param int mipmap_level: Downscale the output by 2**mipmap_level
+    :param bool alpha: Write a transparent PNG without the background
+    :param int quality: JPEG quality
+    :returns: timings and other statistics for the render
+    :rtype: dict
+
+    With `BBOX_FRAME`, the document's frame is rendered if it's enabled,
+    falling back to the data bounding box if not. The frame is normally
+    enabled for files saved by MyPaint. `BBOX_DATA` always renders the
+    union of the layers' data bounding boxes.
+
+    JPEG output never has an alpha channel, so `alpha` is ignored for
+    it.
+
+    """
+    if format is None:
+        format = guess_format(outfile)
+    format = OUTPUT_FORMAT_ALIASES.get(format, format)
+    if format not in OUTPUT_FORMATS:
+        raise ValueError("Unsupported output format %r" % (format,))
+    mipmap_level = max(0, min(int(mipmap_level),
+                              tiledsurface.MAX_MIPMAP_LEVEL))
+    if format == "jpeg":
+        alpha = False
+
+    t0 = time.time()
+    doc = document.Document()
+    try:
+        doc.load(infile)
+        t1 = time.time()
+
+        if bbox == BBOX_DATA:
+            x, y, w, h = doc.get_bbox()
+        else:
+            x, y, w, h = doc.get_effective_bbox()
+        if w == 0 or h == 0:
+            x, y, w, h = 0, 0, N, N  # allow empty documents
+        x >>= mipmap_level
+        y >>= mipmap_level
+        w = max(1, w >> mipmap_level)
+        h = max(1, h >> mipmap_level)
+
+        layers = doc.layer_stack
+        if format == "png":
+            layers.save_as_png(
+                outfile, x, y, w, h,
+                mipmap_level=mipmap_level,
+                alpha=alpha,
+                render_background=not alpha,
+            )
+        else:
+            pixbuf = layers.render_as_pixbuf(
+                x, y, w, h,
+                mipmap_level=mipmap_level,
+                alpha=False,
+                render_background=True,
+            )
+            lib.pixbuf.save(pixbuf, outfile, "jpeg", quality=str(quality))
+        t2 = time.time()
+    finally:
+        doc.cleanup()
+
+    return {
+        "input": infile,
+        "output": outfile,
+        "format": format,
+        "width": w,
+        "height": h,
+        "mipmap_level": mipmap_level,
+        "load_time": t1 - t0,
+        "render_time": t2 - t1,
+        "total_time": t2 - t0,
+    }
+
+
+def guess_format(filename):
+    """Guesses an output format from a filename's extension
+
+    >>> guess_format("foo.PNG")
+    'png'
+    >>> guess_format("foo.jpg")
+    'jpeg'
+    >>> guess_format("foo") is None
+    True
+    """
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    ext = OUTPUT_FORMAT_ALIASES.get(ext, ext)
+    if ext in OUTPUT_FORMATS:
+        return ext
+    return None
+
+
+def _render_job(job):
+    """Pool worker: renders one file, never raising
+
+    Failures are logged and returned as part of the result dict so that
+    one bad file doesn't take down the rest of a batch.
+    """
+    infile, outfile, kwargs = job
+    try:
+        return render_file(infile, outfile, **kwargs)
+    except Exception as ex:
+        logger.exception("Failed to render %r", infile)
+        return {
+            "input": infile,
+            "output": outfile,
+            "error": str(ex),
+        }
+
+
+## Command line interface
+
+def main(argv=None):
+    """Runs ``mypaint-render`` with `sys.argv`, or a list of args"""
+    parser = OptionParser(
+        usage="%prog [options] FILE...",
+        description=("Render MyPaint documents to flat image files "
+                     "without the GUI. One JSON object per input file "
+                     "is written to stdout with timing information."),
+    )
+    parser.add_option(
+        "-o", "--output", metavar="FILE",
+        help="output filename (only valid with a single input file)",
+    )
+    parser.add_option(
+        "-d", "--output-dir", metavar="DIR",
+        help="write outputs into DIR (default: next to each input)",
+    )
+    parser.add_option(
+        "-f", "--format", metavar="FMT", default=None,
+        help="output format: png or jpeg (default: png, "
+             "or guessed from --output)",
+    )
+    parser.add_option(
+        "-b", "--bbox", metavar="MODE", default=BBOX_FRAME,
+        choices=[BBOX_FRAME, BBOX_DATA],
+        help="area to render: 'frame' (the document frame if enabled) "
+             "or 'data' (all layer data); default: %default",
+    )
+    parser.add_option(
+        "-m", "--mipmap-level", metavar="N", type="int", default=0,
+        help="downscale the output by a factor of 2**N (default: %default)",
+    )
+    parser.add_option(
+        "-a", "--alpha", action="store_true", default=False,
+        help="write transparent PNGs without the background layer",
+    )
+    parser.add_option(
+        "-q", "--quality", metavar="Q", type="int", default=90,
+        help="JPEG quality (default: %default)",
+    )
+    parser.add_option(
+        "-j", "--jobs", metavar="N", type="int", default=None,
+        help="number of worker processes (default: one per CPU)",
+    )
+    options, infiles = parser.parse_args(argv)
+    if not infiles:
+        parser.error("no input files")
+    if options.output and len(infiles) > 1:
+        parser.error("--output can only be used with a single input file")
+
+    fmt = options.format
+    if fmt is None and options.output:
+        fmt = guess_format(options.output)
+    if fmt is None:
+        fmt = "png"
+    fmt = OUTPUT_FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in OUTPUT_FORMATS:
+        parser.error("unsupported output format %r" % (options.format,))
+
+    kwargs = dict(
+        format=fmt,
+        bbox=options.bbox,
+        mipmap_level=options.mipmap_level,
+        alpha=options.alpha,
+        quality=options.quality,
+    )
+    jobs = []
+    fs_enc = sys.getfilesystemencoding()
+    for infile in infiles:
+        if not isinstance(infile, unicode):
+            infile = infile.decode(fs_enc)
+        if options.output:
+            outfile = options.output
+            if not isinstance(outfile, unicode):
+                outfile = outfile.decode(fs_enc)
+        else:
+            stem = os.path.splitext(infile)[0]
+            if options.output_dir:
+                outdir = options.output_dir
+                if not isinstance(outdir, unicode):
+                    outdir = outdir.decode(fs_enc)
+                stem = os.path.join(outdir, os.path.basename(stem))
+            outfile = stem + OUTPUT_FORMATS[fmt]
+        jobs.append((infile, outfile, kwargs))
+
+    nprocs = options.jobs or multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, len(jobs)))
+    if nprocs == 1:
+        results = (_render_job(j) for j in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=nprocs)
+        results = pool.imap_unordered(_render_job, jobs)
+
+    failed = 0
+    t0 = time.time()
+    try:
+        for result in results:
+            if "error" in result:
+                failed += 1
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info("Rendered %d file(s) in %0.3fs using %d process(es), "
+                "%d failed",
+                len(jobs), time.time() - t0, nprocs, failed)
+    return 1 if failed else 0
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -73,7 +73,13 @@ class Stroke (object):
 
     empty = property(is_empty)
 
-    def render(self, surface):
+    def render(self, surface, abrupt_start=False):
+        """Replays the stroke onto a surface
+
+        :param surface: the surface to paint on
+        :param bool abrupt_start: Reset the brush & dwell before starting,
+          like an abrupt-starting `lib.command.Brushwork`
+        """
         assert self.finished
 
         # OPTIMIZE: check if parsing of settings is a performance bottleneck
@@ -91,6 +97,10 @@ class Stroke (object):
         data.shape = (len(data)/6, 6)
 
         surface.begin_atomic()
+        if abrupt_start and len(data):
+            dtime, x, y, pressure, xtilt, ytilt = data[0]
+            b.reset()
+            b.stroke_to(surface.backend, x, y, 0.0, xtilt, ytilt, 10.0)
         for dtime, x, y, pressure, xtilt, ytilt in data:
             b.stroke_to(surface.backend, x, y, pressure, xtilt, ytilt, dtime)
         surface.end_atomic()
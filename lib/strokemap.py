@@ -6,6 +6,19 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+"""Stroke shapes, for picking brushes from strokes on the canvas
+
+Each painting layer has a strokemap: a stack of `StrokeShape` objects
+recording which pixels each brushstroke changed, and with which brush
+settings. Strokemaps are saved alongside the layer data in OpenRaster
+and working files.
+
+The current file format is an indexed container (see
+`encode_strokemap()`), which can be written and parsed in linear time.
+The older stream format is still read.
+
+"""
+
 import time
 import struct
 import zlib
@@ -20,6 +33,21 @@ import idletask
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: Stack XML attribute naming the indexed strokemap of a layer
+STROKEMAP_ATTR = "mypaint_strokemap_v3"
+
+#: Stack XML attribute naming a strokemap in the old stream format
+OLD_STROKEMAP_ATTR = "mypaint_strokemap_v2"
+
+_INDEXED_MAGIC = "MYPSTRKS"
+_INDEXED_VERSION = 1
+_INDEXED_HEADER = struct.Struct("<8sIIII")  # magic, version, N, nb, ns
+_BRUSH_INDEX_DTYPE = numpy.dtype("<u4")  # compressed length
+_STROKE_INDEX_DTYPE = numpy.dtype([("brush", "<u4"), ("ntiles", "<u4")])
+_TILE_INDEX_DTYPE = numpy.dtype([("tx", "<i4"), ("ty", "<i4"),
+                                 ("length", "<u4")])
+_OLD_TILE_HEADER = struct.Struct(">iiI")  # tx, ty, length
+
 
 class StrokeShape (object):
     """The shape of a single brushstroke.
@@ -38,6 +66,9 @@ class StrokeShape (object):
 
         :param snapshot_before: Snapshot state before the stroke was made
         :param snapshot_after: Snapshot state after the stroke was made
+
+        The snapshots can be partial, as long as each holds all the tiles
+        the stroke changed which existed at the time.
         """
         assert not self.strokemap
         # extract the layer from each snapshot
@@ -63,30 +94,60 @@ class StrokeShape (object):
                                                     differences)
         self.strokemap[tx, ty] = zlib.compress(differences.tostring())
 
-    def init_from_string(self, data, translate_x, translate_y):
+    def init_from_string(self, data, translate_x, translate_y,
+                         start=0, end=None):
+        """Set the shape from a stroke record of the old stream format
+
+        :param str data: data holding the record
+        :param int translate_x: X offset in model pixels (tile-aligned)
+        :param int translate_y: Y offset in model pixels (tile-aligned)
+        :param int start: where the record starts in `data`
+        :param int end: where it ends (default: the end of `data`)
+
+        """
         assert not self.strokemap
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
-        while data:
-            tx, ty, size = struct.unpack('>iiI', data[:3*4])
-            compressed_bitmap = data[3*4:size+3*4]
+        if end is None:
+            end = len(data)
+        header_size = _OLD_TILE_HEADER.size
+        pos = start
+        while pos < end:
+            tx, ty, size = _OLD_TILE_HEADER.unpack_from(data, pos)
+            pos += header_size
+            compressed_bitmap = data[pos:pos+size]
             self.strokemap[tx + translate_x, ty + translate_y] = compressed_bitmap
-            data = data[size+3*4:]
+            pos += size
 
     def save_to_string(self, translate_x, translate_y):
+        """Returns the shape as a stroke record of the old stream format"""
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
         self.tasks.finish_all()
-        data = ''
+        chunks = []
         for (tx, ty), compressed_bitmap in self.strokemap.iteritems():
             tx, ty = tx + translate_x, ty + translate_y
-            data += struct.pack('>iiI', tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+            chunks.append(_OLD_TILE_HEADER.pack(tx, ty,
+                                                len(compressed_bitmap)))
+            chunks.append(compressed_bitmap)
+        return "".join(chunks)
+
+    def get_tiles(self):
+        """Returns the shape's tiles, for encoding elsewhere
+
+        :returns: a new dict mapping (tx, ty) to compressed 1-bit bitmaps
+        :rtype: dict
+
+        Any pending work is finished first. The returned dict isn't
+        changed by anything done to the shape later, so it can be
+        handed to another thread. See `encode_strokemap()`.
+        """
+        self.tasks.finish_all()
+        return self.strokemap.copy()
 
     def touches_pixel(self, x, y):
         self.tasks.finish_all()
@@ -177,3 +238,204 @@ class StrokeShape (object):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
                 self.strokemap.pop((tx, ty))
         return bool(self.strokemap)
+
+
+## Strokemap serialization
+
+def encode_strokemap(shapes, translate_x, translate_y):
+    """Encodes stroke shapes as indexed strokemap data
+
+    :param list shapes: (brush_string, tiles) pairs, bottom stroke first
+    :param int translate_x: X offset in model pixels (tile-aligned)
+    :param int translate_y: Y offset in model pixels (tile-aligned)
+    :returns: the encoded strokemap
+    :rtype: str
+
+    The `tiles` dicts are as returned by `StrokeShape.get_tiles()`, and
+    they aren't modified, so this can be called from a worker thread.
+    Each distinct brush is stored once.
+
+    The data is a header, then an index of the brushes, an index of the
+    strokes, and an index of the strokes' tiles, followed by the
+    brushes' zlib-compressed settings and the tiles' compressed bitmaps
+    in the same order. Everything can be located from the indices
+    without scanning, and the output is assembled in a single join.
+
+    >>> a = {(0, 0): zlib.compress("a"), (1, -1): zlib.compress("b")}
+    >>> b = {(2, 3): zlib.compress("c")}
+    >>> data = encode_strokemap([("br1", a), ("br2", b), ("br1", b)],
+    ...                         -N, 0)
+    >>> data.startswith(_INDEXED_MAGIC)
+    True
+    >>> shapes = decode_strokemap(data, N, 0)
+    >>> [s.brush_string for s in shapes]
+    ['br1', 'br2', 'br1']
+    >>> shapes[0].strokemap == a
+    True
+    >>> shapes[2].strokemap == b
+    True
+
+    """
+    assert translate_x % N == 0
+    assert translate_y % N == 0
+    translate_x /= N
+    translate_y /= N
+    brush2id = {}
+    brush_blobs = []
+    strokes = []
+    tile_index = []
+    tile_blobs = []
+    for brush_string, tiles in shapes:
+        brush_id = brush2id.get(brush_string)
+        if brush_id is None:
+            brush_id = len(brush_blobs)
+            brush2id[brush_string] = brush_id
+            brush_blobs.append(zlib.compress(brush_string))
+        strokes.append((brush_id, len(tiles)))
+        for (tx, ty), bitmap in sorted(tiles.iteritems()):
+            tile_index.append((tx + translate_x, ty + translate_y,
+                               len(bitmap)))
+            tile_blobs.append(bitmap)
+    brush_index = numpy.array([len(b) for b in brush_blobs],
+                              dtype=_BRUSH_INDEX_DTYPE)
+    stroke_index = numpy.array(strokes, dtype=_STROKE_INDEX_DTYPE)
+    tile_index = numpy.array(tile_index, dtype=_TILE_INDEX_DTYPE)
+    chunks = [
+        _INDEXED_HEADER.pack(_INDEXED_MAGIC, _INDEXED_VERSION, N,
+                             len(brush_blobs), len(strokes)),
+        brush_index.tostring(),
+        stroke_index.tostring(),
+        tile_index.tostring(),
+    ]
+    chunks.extend(brush_blobs)
+    chunks.extend(tile_blobs)
+    return "".join(chunks)
+
+
+def decode_strokemap(data, translate_x, translate_y):
+    """Decodes strokemap data, in either format
+
+    :param str data: data from `encode_strokemap()`, or old stream data
+    :param int translate_x: X offset in model pixels (tile-aligned)
+    :param int translate_y: Y offset in model pixels (tile-aligned)
+    :returns: the stroke shapes, bottom stroke first
+    :rtype: list
+
+    Both formats are parsed in time proportional to their size. The old
+    stream format was a sequence of records, each introduced by a type
+    byte: ``b`` for brush settings, ``s`` for a stroke, and ``}`` at the
+    end.
+
+    >>> a = StrokeShape()
+    >>> a.strokemap = {(0, 0): zlib.compress("a"), (1, 1): "b"}
+    >>> rec = a.save_to_string(0, 0)
+    >>> old = "".join([
+    ...     "b", struct.pack(">I", len(zlib.compress("br"))),
+    ...     zlib.compress("br"),
+    ...     "s", struct.pack(">II", 0, len(rec)), rec,
+    ...     "s", struct.pack(">II", 0, 0),
+    ...     "}",
+    ... ])
+    >>> shapes = decode_strokemap(old, N, 0)
+    >>> len(shapes)
+    2
+    >>> shapes[0].strokemap == {(1, 0): zlib.compress("a"), (2, 1): "b"}
+    True
+    >>> shapes[1].brush_string
+    'br'
+
+    """
+    if data.startswith(_INDEXED_MAGIC):
+        return _decode_indexed_strokemap(data, translate_x, translate_y)
+    return _decode_old_strokemap(data, translate_x, translate_y)
+
+
+def is_indexed_strokemap(data):
+    """True if strokemap data is in the current, indexed format"""
+    return data.startswith(_INDEXED_MAGIC)
+
+
+def _decode_indexed_strokemap(data, translate_x, translate_y):
+    """Internal: decodes data written by encode_strokemap()"""
+    assert translate_x % N == 0
+    assert translate_y % N == 0
+    translate_x /= N
+    translate_y /= N
+    magic, version, tile_size, nbrushes, nstrokes \
+        = _INDEXED_HEADER.unpack_from(data)
+    if version != _INDEXED_VERSION or tile_size != N:
+        raise ValueError("Unsupported strokemap (version %d, N=%d)"
+                         % (version, tile_size))
+    pos = _INDEXED_HEADER.size
+    brush_index = numpy.frombuffer(data, _BRUSH_INDEX_DTYPE,
+                                   nbrushes, pos)
+    pos += brush_index.nbytes
+    stroke_index = numpy.frombuffer(data, _STROKE_INDEX_DTYPE,
+                                    nstrokes, pos)
+    pos += stroke_index.nbytes
+    ntiles = int(stroke_index["ntiles"].sum())
+    tile_index = numpy.frombuffer(data, _TILE_INDEX_DTYPE, ntiles, pos)
+    pos += tile_index.nbytes
+    brushes = []
+    for length in brush_index.tolist():
+        brushes.append(zlib.decompress(data[pos:pos+length]))
+        pos += length
+    txs = (tile_index["tx"] + translate_x).tolist()
+    tys = (tile_index["ty"] + translate_y).tolist()
+    lengths = tile_index["length"].tolist()
+    shapes = []
+    i = 0
+    for brush_id, count in stroke_index.tolist():
+        tiles = {}
+        for j in xrange(i, i + count):
+            length = lengths[j]
+            tiles[txs[j], tys[j]] = data[pos:pos+length]
+            pos += length
+        i += count
+        shape = StrokeShape()
+        shape.strokemap = tiles
+        shape.brush_string = brushes[brush_id]
+        shapes.append(shape)
+    return shapes
+
+
+def _decode_old_strokemap(data, translate_x, translate_y):
+    """Internal: decodes data in the old stream format"""
+    brushes = []
+    shapes = []
+    pos = 0
+    while True:
+        t = data[pos:pos+1]
+        pos += 1
+        if t == 'b':
+            length, = struct.unpack_from('>I', data, pos)
+            pos += 4
+            brushes.append(zlib.decompress(data[pos:pos+length]))
+            pos += length
+        elif t == 's':
+            brush_id, length = struct.unpack_from('>II', data, pos)
+            pos += 2*4
+            shape = StrokeShape()
+            shape.init_from_string(data, translate_x, translate_y,
+                                   start=pos, end=pos+length)
+            shape.brush_string = brushes[brush_id]
+            shapes.append(shape)
+            pos += length
+        elif t == '}':
+            break
+        else:
+            raise ValueError("Invalid strokemap data")
+    return shapes
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
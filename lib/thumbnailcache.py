@@ -0,0 +1,204 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Asynchronous file thumbnails, cached in memory and on disk
+
+Fetching a thumbnail with `lib.helpers.freedesktop_thumbnail()` means
+reading the freedesktop.org thumbnail store, and maybe opening and
+scaling the file itself if the stored thumbnail is missing or out of
+date. That's far too slow to do on the main thread for every file a
+dialog wants to preview.
+
+A `ThumbnailCache` keeps recently used thumbnails in memory, and fetches
+the rest with a pool of worker threads. Results are delivered to
+callbacks on the main thread, via the GLib main loop. The on-disk store
+is still used and kept up to date, so it's shared with other apps.
+
+The pool isn't a `lib.workerpool.WorkerPool`. Those are owned by a
+thread which waits for their results in order, and that would block
+the UI here. Instead, each result is posted back to the main loop by a
+completion callback as soon as it's ready. The number of threads is
+taken from `lib.workerpool` all the same.
+
+"""
+
+## Imports
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GObject
+
+import lib.cache
+import lib.helpers
+import lib.workerpool
+
+
+## Module constants
+
+#: Size of the thumbnails handed out (box, px), as in the large store
+THUMBNAIL_SIZE = 256
+
+#: Default number of thumbnails kept in memory
+DEFAULT_CAPACITY = 64
+
+
+## Class defs
+
+class ThumbnailCache (object):
+    """Fetches and stores file thumbnails without blocking the UI
+
+    Thumbnails are keyed by the file's absolute path, modification time
+    and size, so a file which changes on disk gets a fresh thumbnail.
+    All methods must be called from the main thread.
+
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, threads=None):
+        """Initialize, with nothing cached
+
+        :param int capacity: Max number of thumbnails kept in memory
+        :param int threads: Number of worker threads (default: see
+          `lib.workerpool.get_default_threads()`)
+
+        The worker threads are only started when first needed.
+        """
+        super(ThumbnailCache, self).__init__()
+        self._cache = lib.cache.LRUCache(capacity=capacity)
+        if threads is None:
+            threads = lib.workerpool.get_default_threads()
+        self._threads = max(1, int(threads))
+        self._pool = None
+        self._pending = {}  # {key: [callback, ...]}
+
+    @staticmethod
+    def _get_key(filename):
+        """Internal: cache key for a file, or None if it can't be read"""
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (filename, int(st.st_mtime), st.st_size)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(processes=self._threads)
+        return self._pool
+
+    ## Fetching thumbnails
+
+    def lookup(self, filename):
+        """Returns a thumbnail if it's in memory, without waiting
+
+        :param unicode filename: File to get a thumbnail for
+        :returns: The file's thumbnail, or None if it isn't cached
+        :rtype: GdkPixbuf.Pixbuf
+        """
+        key = self._get_key(filename)
+        if key is None:
+            return None
+        return self._cache.get(key)
+
+    def request(self, filename, callback):
+        """Requests a file's thumbnail, to be delivered later
+
+        :param unicode filename: File to get a thumbnail for
+        :param callable callback: Called as ``callback(filename, pixbuf)``
+        :returns: True if the callback was called before returning
+
+        If the thumbnail is in memory, the callback is called
+        immediately. Otherwise it's fetched or generated by a worker
+        thread, and the callback is called from the main loop later.
+        The pixbuf is None if the file has no usable thumbnail.
+        """
+        key = self._get_key(filename)
+        if key is None:
+            callback(filename, None)
+            return True
+        pixbuf = self._cache.get(key)
+        if pixbuf is not None:
+            callback(filename, pixbuf)
+            return True
+        callbacks = self._pending.get(key)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return False
+        self._pending[key] = [callback]
+        self._get_pool().apply_async(
+            _fetch_thumbnail, (key[0],),
+            callback=lambda result: GObject.idle_add(
+                self._fetched_idle_cb, key, filename, result,
+            ),
+        )
+        return False
+
+    def prefetch(self, filenames):
+        """Fetches thumbnails for files in the background
+
+        :param iterable filenames: Files likely to be previewed soon
+        """
+        for filename in filenames:
+            self.request(filename, _ignore_thumbnail)
+
+    def _fetched_idle_cb(self, key, filename, result):
+        """Internal: delivers a worker's result on the main thread"""
+        pixbuf, elapsed = result
+        logger.debug("Fetched thumbnail for %r in %.3fs", key[0], elapsed)
+        if pixbuf is not None:
+            self._cache[key] = pixbuf
+        for callback in self._pending.pop(key, []):
+            try:
+                callback(filename, pixbuf)
+            except Exception:
+                logger.exception("Thumbnail callback for %r failed",
+                                 filename)
+        return False
+
+    ## Storing thumbnails
+
+    def store(self, filename, pixbuf):
+        """Stores a new thumbnail for a file which was just saved
+
+        :param unicode filename: The file, which must be closed
+        :param GdkPixbuf.Pixbuf pixbuf: Its image, at any size
+
+        The thumbnail is cached in memory straight away, and written to
+        the on-disk store by a worker thread.
+        """
+        key = self._get_key(filename)
+        if key is None or pixbuf is None:
+            return
+        pixbuf = lib.helpers.scale_proportionally(
+            pixbuf, THUMBNAIL_SIZE, THUMBNAIL_SIZE,
+        )
+        self._cache[key] = pixbuf
+        self._get_pool().apply_async(_fetch_thumbnail, (key[0], pixbuf))
+
+
+## Helper functions
+
+def _fetch_thumbnail(filename, pixbuf=None):
+    """Fetches (or stores) a thumbnail (runs in a worker thread)
+
+    :returns: (pixbuf or None, elapsed time)
+    """
+    t0 = time.time()
+    try:
+        pixbuf = lib.helpers.freedesktop_thumbnail(filename, pixbuf)
+    except Exception:
+        logger.exception("Failed to get a thumbnail for %r", filename)
+        pixbuf = None
+    return (pixbuf, time.time() - t0)
+
+
+def _ignore_thumbnail(filename, pixbuf):
+    pass
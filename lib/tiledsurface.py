@@ -24,6 +24,7 @@ import mypaintlib
 import helpers
 import math
 import pixbufsurface
+import lib.pixbuf
 from errors import FileHandlingError
 
 
@@ -32,6 +33,8 @@ from errors import FileHandlingError
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 MAX_MIPMAP_LEVEL = mypaintlib.MAX_MIPMAP_LEVEL
 
+JPEG_MAGIC = "\xff\xd8"  # SOI marker, which starts every JPEG file
+
 
 ## Tile class and marker tile constants
 
@@ -50,6 +53,11 @@ class Tile (object):
     def copy(self):
         return Tile(copy_from=self)
 
+    @property
+    def nbytes(self):
+        """Memory used by the tile's pixels, in bytes"""
+        return self.rgba.nbytes
+
 
 # tile for read-only operations on empty spots
 transparent_tile = Tile()
@@ -87,6 +95,13 @@ class MyPaintSurface (object):
                  looped=False, looped_size=(0, 0)):
         object.__init__(self)
 
+        # Deferred loading: see set_pending_load()
+        self._pending_load = None
+        self._pending_bbox = None
+
+        # Change tracking: see start_tracking_changes()
+        self._tracked_changes = None
+
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
         self.tiledict = {}
@@ -138,6 +153,57 @@ class MyPaintSurface (object):
                 s.mipmap = None
         return mipmaps
 
+    ## Deferred loading
+
+    @property
+    def tiledict(self):
+        """The surface's tiles, as a dict of Tiles keyed by (tx, ty)
+
+        Accessing this finishes any pending load first.
+        """
+        if self._pending_load is not None:
+            self.finish_pending_load()
+        return self._tiledict
+
+    @tiledict.setter
+    def tiledict(self, d):
+        self._tiledict = d
+
+    def set_pending_load(self, load_func, bbox):
+        """Defers loading the surface's tiles until they're needed
+
+        :param callable load_func: Called with no args to load the tiles
+        :param helpers.Rect bbox: Estimated bounding box of the tiles
+
+        The surface must be empty. `load_func` is called by
+        `finish_pending_load()`, which happens automatically the first
+        time the surface's tiles, or its mipmaps' tiles, are needed.
+        Until then, `get_bbox()` returns the estimate, and reading tiles
+        which lie outside it gives the transparent tile without loading
+        anything. Writes, snapshots, and reads of tiles overlapping the
+        estimate all finish the load first. Passing None for
+        `load_func` cancels a pending load.
+        """
+        assert self.mipmap_level == 0
+        for surface in (self._mipmaps or [self]):
+            surface._pending_load = load_func
+            surface._pending_bbox = bbox
+
+    @property
+    def load_is_pending(self):
+        """True if loading the surface's tiles has been deferred"""
+        return self._pending_load is not None
+
+    def finish_pending_load(self):
+        """Loads the surface's tiles now, if loading was deferred"""
+        load_func = self._pending_load
+        if load_func is None:
+            return
+        for surface in (self._mipmaps or [self]):
+            surface._pending_load = None
+            surface._pending_bbox = None
+        load_func()
+
     def end_atomic(self):
         bbox = self._backend.end_atomic()
         if (bbox[2] > 0 and bbox[3] > 0):
@@ -239,7 +305,20 @@ class MyPaintSurface (object):
             tx = tx % (self.looped_size[0] / N)
             ty = ty % (self.looped_size[1] / N)
 
+        if readonly and self._pending_load is not None:
+            # Nothing to load out here, e.g. in the canvas margins
+            size = N << self.mipmap_level
+            tile_rect = helpers.Rect(tx*size, ty*size, size, size)
+            if not tile_rect.overlaps(self._pending_bbox):
+                return transparent_tile.rgba
+
         t = self.tiledict.get((tx, ty))
+        changes = self._tracked_changes
+        if changes is not None and not readonly and (tx, ty) not in changes:
+            # Keep the original, and make sure it's copied below
+            changes[(tx, ty)] = t
+            if t is not None:
+                t.readonly = True
         if t is None:
             if readonly:
                 t = transparent_tile
@@ -341,6 +420,44 @@ class MyPaintSurface (object):
                     return
             mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
 
+    def add_tile_ops(self, ops, dst_has_alpha, tx, ty, mipmap_level=0,
+                     opacity=1.0, mode=mypaintlib.CombineNormal):
+        """Appends the op for compositing one tile of this surface to a list
+
+        :param list ops: list of ``(src, mode, opacity)`` tuples to extend
+
+        The other parameters are as for `composite_tile()`, and the op
+        appended must have the same effect as calling it would.
+        Nothing is appended if the op would do nothing.
+        """
+        dst_in = mypaintlib.CombineDestinationIn
+        if opacity == 0 and mode != dst_in:
+            return
+        if self.mipmap_level < mipmap_level:
+            self.mipmap.add_tile_ops(ops, dst_has_alpha, tx, ty,
+                                     mipmap_level, opacity, mode)
+            return
+        with self.tile_request(tx, ty, readonly=True) as src:
+            if src is transparent_tile.rgba and mode != dst_in:
+                return
+            ops.append((src, mode, opacity))
+
+    def get_tile_array(self, tx, ty, mipmap_level=0):
+        """Returns one tile of this surface as a NumPy array, for reading
+
+        :param tx: tile X coordinate, in model tile space
+        :param ty: tile Y coordinate, in model tile space
+        :param mipmap_level: mipmap level to use
+        :returns: uint16 NxNx4 array, shared with the surface
+
+        The returned array must not be modified, and should be used
+        straight away.
+        """
+        if self.mipmap_level < mipmap_level:
+            return self.mipmap.get_tile_array(tx, ty, mipmap_level)
+        with self.tile_request(tx, ty, readonly=True) as src:
+            return src
+
     ## Snapshotting
 
     def save_snapshot(self):
@@ -371,12 +488,93 @@ class MyPaintSurface (object):
         if not bbox.empty():
             self.notify_observers(*bbox)
 
+    ## Change tracking
+
+    def start_tracking_changes(self):
+        """Starts recording which tiles get written to
+
+        While tracking, the first write to each tile position keeps the
+        tile which was there before. `stop_tracking_changes()` returns
+        just those positions' tiles, so the cost of recording a change
+        depends on its size, not on the size of the whole surface.
+        Only writes made via `tile_request()` are tracked.
+        """
+        assert self.mipmap_level == 0
+        assert self._tracked_changes is None
+        self._tracked_changes = {}
+
+    def stop_tracking_changes(self):
+        """Stops tracking, and returns the tiles written to
+
+        :returns: ``(before, after)``: partial snapshots of the surface
+        :rtype: tuple of SurfaceSnapshot
+
+        The two snapshots hold the tiles at the positions written to,
+        from before tracking started and as they are now. Positions
+        which had no tile at the time are absent. Like a full snapshot's
+        tiles, all of them are read-only afterwards.
+        """
+        changes = self._tracked_changes
+        assert changes is not None
+        self._tracked_changes = None
+        tiledict = self.tiledict
+        before = SurfaceSnapshot()
+        before.tiledict = {}
+        after = SurfaceSnapshot()
+        after.tiledict = {}
+        for pos, old in changes.iteritems():
+            new = tiledict.get(pos)
+            if old is new:
+                continue
+            if old is not None:
+                before.tiledict[pos] = old
+            if new is not None:
+                new.readonly = True
+                after.tiledict[pos] = new
+        return (before, after)
+
+    def load_partial_snapshot(self, sshot, positions):
+        """Loads some of a snapshot's tiles, leaving the others alone
+
+        :param SurfaceSnapshot sshot: snapshot to load tiles from
+        :param iterable positions: the (tx, ty) positions to load
+
+        Positions which have no tile in `sshot` are cleared. Use this
+        with the partial snapshots from `stop_tracking_changes()`.
+        """
+        tiledict = self.tiledict
+        src = sshot.tiledict
+        dirty = []
+        for pos in positions:
+            t = src.get(pos)
+            if tiledict.get(pos) is t:
+                continue
+            if t is None:
+                del tiledict[pos]
+            else:
+                tiledict[pos] = t
+            self._mark_mipmap_dirty(*pos)
+            dirty.append(pos)
+        bbox = get_tiles_bbox(dirty)
+        if not bbox.empty():
+            self.notify_observers(*bbox)
+
     ## Loading tile data
 
     def load_from_surface(self, other):
         """Loads tile data from another surface, via a snapshot"""
         self.load_snapshot(other.save_snapshot())
 
+    def load_tiles(self, tiles):
+        """Loads read-only tiles, replacing the internal tiledict
+
+        :param dict tiles: Tile objects, keyed by (tx, ty)
+
+        The tiles are used as they are, so they must be read-only. They
+        are copied before being modified, like those of a snapshot.
+        """
+        self._load_tiledict(tiles)
+
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
         self.tiledict = {}
@@ -427,6 +625,71 @@ class MyPaintSurface (object):
         string when conversion or PNG reading fails.
 
         """
+        filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
+
+        def load_png(get_buffer):
+            return mypaintlib.load_png_fast_progressive(
+                filename_sys,
+                get_buffer,
+                convert_to_srgb,
+            )
+
+        return self._load_from_png_progressive(load_png, x, y, feedback_cb)
+
+    def load_from_png_stream(self, fp, x, y, feedback_cb=None,
+                             convert_to_srgb=True,
+                             **kwargs):
+        """Load from a PNG file object, one tilerow at a time.
+
+        :param file fp: The file-like object to read PNG data from
+        :param int x: X-coordinate at which to load the replacement data
+        :param int y: Y-coordinate at which to load the replacement data
+        :param bool convert_to_srgb: If True, convert to sRGB
+        :param callable feedback_cb: Called every few tile rows
+        :param dict \*\*kwargs: Ignored
+
+        This works like `load_from_png()`, and is useful for PNGs
+        inside zipfiles. No more than one strip of 8bpp image data is
+        held in memory at once. The GIL is released while decoding,
+        except for reads from `fp`.
+
+        """
+        def load_png(get_buffer):
+            return mypaintlib.load_png_fast_progressive_from_file(
+                fp,
+                get_buffer,
+                convert_to_srgb,
+            )
+
+        return self._load_from_png_progressive(load_png, x, y, feedback_cb)
+
+    def _load_from_jpeg_stream(self, fp, x, y, feedback_cb):
+        """Internal: loads from a JPEG file object, one tilerow at a time"""
+        def load_jpeg(get_buffer):
+            return mypaintlib.load_jpeg_fast_progressive_from_file(
+                fp,
+                get_buffer,
+            )
+
+        return self._load_from_png_progressive(
+            load_jpeg, x, y, feedback_cb,
+            errmsg=_("JPEG reader failed: %s"),
+        )
+
+    def _load_from_png_progressive(self, load_png, x, y, feedback_cb,
+                                   errmsg=None):
+        """Internal: loads the result of a progressive PNG loader
+
+        :param callable load_png: Called with the get-buffer callback
+          to pass to the native PNG loader, and returns its result.
+        :param unicode errmsg: Message for the FileHandlingError raised
+          on failure, with a "%s" for the details.
+
+        The native JPEG loader uses the same get-buffer protocol.
+
+        """
+        if errmsg is None:
+            errmsg = _("PNG reader failed: %s")
         dirty_tiles = set(self.tiledict.keys())
         self.tiledict = {}
 
@@ -474,15 +737,10 @@ class MyPaintSurface (object):
                     with self.tile_request(tx, ty, readonly=False) as dst:
                         mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
 
-        filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
         try:
-            flags = mypaintlib.load_png_fast_progressive(
-                filename_sys,
-                get_buffer,
-                convert_to_srgb,
-            )
+            flags = load_png(get_buffer)
         except (IOError, OSError, RuntimeError) as ex:
-            raise FileHandlingError(_("PNG reader failed: %s") % str(ex))
+            raise FileHandlingError(errmsg % str(ex))
         consume_buf()  # also process the final chunk of data
         logger.debug("PNG loader flags: %r", flags)
 
@@ -493,6 +751,97 @@ class MyPaintSurface (object):
         # return the bbox of the loaded image
         return state['frame_size']
 
+    def load_from_pixbuf_stream(self, fp, x, y, feedback_cb=None,
+                                **kwargs):
+        """Load from any image file object GdkPixbuf can read, in strips
+
+        :param file fp: The file-like object to read image data from
+        :param int x: X-coordinate at which to load the replacement data
+        :param int y: Y-coordinate at which to load the replacement data
+        :param callable feedback_cb: Called every few chunks of data
+        :param dict \*\*kwargs: Ignored
+        :returns: the dimensions of the loaded image, as (x,y,w,h)
+
+        Rows are converted into tiles one tile row at a time, as soon as
+        the decoder has finished with them, rather than after the whole
+        image has been decoded. This avoids having a second full-size
+        copy of a big image in memory, as `load_from_numpy()` makes.
+        Fully transparent tiles are skipped.
+
+        JPEGs are decoded natively, straight into strips, so no
+        full-size copy of the image exists at all. Other formats, and
+        JPEGs that the native loader can't handle, are decoded by
+        GdkPixbuf. Its loader keeps its own full-size pixbuf.
+
+        """
+        pos = fp.tell()
+        if fp.read(len(JPEG_MAGIC)) == JPEG_MAGIC:
+            fp.seek(pos)
+            try:
+                return self._load_from_jpeg_stream(fp, x, y, feedback_cb)
+            except FileHandlingError as ex:
+                logger.warning("Using GdkPixbuf instead: %s", ex)
+        fp.seek(pos)
+
+        dirty_tiles = set(self.tiledict.keys())
+        self.tiledict = {}
+
+        state = {}
+        state['buf'] = None  # one tile row, as wide as the image
+        state['ty'] = None  # tile row being filled into buf
+        state['frame_size'] = None
+
+        def strip_cb(pixbuf, row, rows):
+            img_w = pixbuf.get_width()
+            buf_x0 = x/N*N
+            if state['buf'] is None:
+                state['frame_size'] = x, y, img_w, pixbuf.get_height()
+                buf_w = ((x+img_w-1)/N+1)*N - buf_x0
+                state['buf'] = numpy.empty((N, buf_w, 4), 'uint8')
+            buf = state['buf']
+            arr = helpers.gdkpixbuf2numpy(pixbuf)
+            channels = arr.shape[2]
+            end = row + rows
+            while row < end:
+                ty = (y+row)/N
+                if ty != state['ty']:
+                    if state['ty'] is not None:
+                        consume_buf()
+                    buf.fill(0)
+                    state['ty'] = ty
+                n = min(end, (ty+1)*N - y) - row
+                dst = buf[y+row-ty*N:y+row-ty*N+n, x-buf_x0:x-buf_x0+img_w]
+                dst[:, :, :channels] = arr[row:row+n]
+                if channels == 3:
+                    dst[:, :, 3] = 255
+                row += n
+
+        def consume_buf():
+            ty = state['ty']
+            buf = state['buf']
+            for i in xrange(buf.shape[1]/N):
+                tx = x/N + i
+                src = buf[:, i*N:(i+1)*N, :]
+                if src[:, :, 3].any():
+                    with self.tile_request(tx, ty, readonly=False) as dst:
+                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
+                else:
+                    # Rows can come more than once (see lib.pixbuf)
+                    self.tiledict.pop((tx, ty), None)
+
+        t0 = time.time()
+        lib.pixbuf.load_from_stream_in_strips(fp, strip_cb, feedback_cb)
+        if state['ty'] is not None:
+            consume_buf()  # also process the final chunk of data
+        logger.debug("%.3fs loading image in strips", time.time() - t0)
+
+        dirty_tiles.update(self.tiledict.keys())
+        bbox = get_tiles_bbox(dirty_tiles)
+        self.notify_observers(*bbox)
+
+        # return the bbox of the loaded image
+        return state['frame_size']
+
     def render_as_pixbuf(self, *args, **kwargs):
         if not self.tiledict:
             logger.warning('empty surface')
@@ -510,13 +859,26 @@ class MyPaintSurface (object):
             kwargs['single_tile_pattern'] = True
         pixbufsurface.save_as_png(self, filename, *args, **kwargs)
 
+    def encode_as_png(self, *args, **kwargs):
+        """Encodes the surface as PNG data (see `save_as_png()`)"""
+        if 'alpha' not in kwargs:
+            kwargs['alpha'] = True
+
+        if len(self.tiledict) == 1:
+            kwargs['single_tile_pattern'] = True
+        return pixbufsurface.encode_as_png(self, *args, **kwargs)
+
     def get_tiles(self):
         return self.tiledict
 
     def get_bbox(self):
+        if self._pending_load is not None:
+            return self._pending_bbox.copy()
         return get_tiles_bbox(self.tiledict)
 
     def is_empty(self):
+        if self._pending_load is not None:
+            return self._pending_bbox.empty()
         return not self.tiledict
 
     def remove_empty_tiles(self):
@@ -0,0 +1,209 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Worker thread pools which give feedback while they're waited on
+
+Encoding and decoding PNG or JPEG data is done by native code which
+releases the GIL, so loading, saving and exporting spread that work
+over a pool of threads. The thread which owns a `WorkerPool`, usually
+the main thread, collects the results in order. While it waits, it
+calls a feedback callback now and then, so the UI can stay responsive.
+Only a few jobs are kept queued at once, which bounds the memory used
+by their data.
+
+With one thread, there is no pool: jobs run straight away in the
+calling thread.
+
+"""
+
+## Imports
+
+import sys
+import time
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+## Module constants
+
+#: Default number of worker threads (None means one per CPU)
+DEFAULT_THREADS = None
+
+#: Time between feedback callbacks while waiting (seconds)
+FEEDBACK_INTERVAL = 0.1
+
+
+## Functions
+
+def get_default_threads():
+    """Number of worker threads to use when none is specified
+
+    :returns: `DEFAULT_THREADS`, or else the number of CPUs
+    :rtype: int
+
+    Every pool of worker threads in the program should use this, so
+    that thread counts are set in one place.
+    """
+    return max(1, int(DEFAULT_THREADS or multiprocessing.cpu_count()))
+
+
+## Class defs
+
+class WorkerPool (object):
+    """Runs jobs in worker threads, and waits for them with feedback
+
+    >>> pool = WorkerPool(threads=4)
+    >>> results = [pool.apply_async(pow, i, 2) for i in xrange(5)]
+    >>> [pool.wait(r) for r in results]
+    [0, 1, 4, 9, 16]
+    >>> done = []
+    >>> for i in xrange(20):
+    ...     pool.submit(done.append, i)
+    >>> pool.close()
+    >>> sorted(done) == range(20)
+    True
+
+    Exceptions raised by jobs are re-raised when they're waited for.
+
+    >>> pool = WorkerPool(threads=1)
+    >>> r = pool.apply_async(int, "x")
+    >>> pool.wait(r)
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    >>> pool.close()
+
+    """
+
+    def __init__(self, threads=None, feedback_cb=None):
+        """Initialize, starting the worker threads
+
+        :param int threads: number of worker threads (default: see
+          `DEFAULT_THREADS`)
+        :param callable feedback_cb: called periodically while waiting
+
+        """
+        super(WorkerPool, self).__init__()
+        if threads is None:
+            threads = get_default_threads()
+        #: Number of worker threads
+        self.threads = max(1, int(threads))
+        self._pool = None
+        if self.threads > 1:
+            self._pool = ThreadPool(processes=self.threads)
+        #: Max number of jobs queued by `submit()` at once. Callers
+        #: keeping their own queue of results should use it too.
+        self.max_pending = self.threads * 2
+        self._pending = collections.deque()
+        self._feedback_cb = feedback_cb
+        self._last_feedback = time.time()
+
+    ## Running jobs
+
+    def apply_async(self, func, *args, **kwargs):
+        """Starts a job, and returns its result for `wait()`
+
+        :param callable func: the job, run in a worker thread
+        :returns: an object with the API of `AsyncResult`
+
+        """
+        if self._pool is None:
+            return _ImmediateResult(func, args, kwargs)
+        return self._pool.apply_async(func, args, kwargs)
+
+    def wait(self, result):
+        """Waits for a job to finish, and returns what it returned
+
+        :param result: returned by `apply_async()`
+
+        Any exception raised by the job is re-raised here.
+        """
+        while not result.ready():
+            result.wait(FEEDBACK_INTERVAL)
+            self.feedback()
+        return result.get()
+
+    def submit(self, func, *args, **kwargs):
+        """Starts a job whose return value isn't needed
+
+        If too many jobs are queued, this waits for the oldest ones.
+        Their exceptions are re-raised here, or by `close()`.
+        """
+        self._pending.append(self.apply_async(func, *args, **kwargs))
+        while len(self._pending) > self.max_pending:
+            self.wait(self._pending.popleft())
+        self.feedback()
+
+    def feedback(self):
+        """Calls the feedback callback, unless it was called just now"""
+        if self._feedback_cb is None:
+            return
+        now = time.time()
+        if now - self._last_feedback >= FEEDBACK_INTERVAL:
+            self._last_feedback = now
+            self._feedback_cb()
+
+    ## Finishing up
+
+    def close(self):
+        """Waits for all submitted jobs, then stops the threads"""
+        try:
+            while self._pending:
+                self.wait(self._pending.popleft())
+        except:
+            self.abort()
+            raise
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def abort(self):
+        """Stops the threads, abandoning any jobs still queued"""
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+class _ImmediateResult (object):
+    """A job which was run straight away, looking like an AsyncResult"""
+
+    def __init__(self, func, args, kwargs):
+        super(_ImmediateResult, self).__init__()
+        self._value = None
+        self._exc_info = None
+        try:
+            self._value = func(*args, **kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._value
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
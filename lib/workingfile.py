@@ -0,0 +1,309 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Native working file format, with memory-mapped tiles
+
+OpenRaster files store each layer as a PNG, so every save and load has
+to encode or decode every pixel of every layer. MyPaint's own working
+file format stores the tiles of each paintable layer as they are held in
+memory instead: 15-bit premultiplied RGBA, each tile compressed
+separately with zlib.
+
+The container is an uncompressed ZIP file, laid out like an OpenRaster
+file. It has the same ``stack.xml`` and strokemaps, but each painting
+layer's ``src`` names a tile store (`TILES_SUFFIX`) rather than a PNG.
+A tile store is a header, an index mapping tile coordinates to the
+offsets of their compressed data, and then the data itself.
+
+Working files are opened by memory-mapping them. Loading a layer just
+reads its index, and its tiles are decompressed the first time their
+pixels are needed. When saving, tiles which haven't been touched are
+copied into the new file without being decompressed, so both loading
+and saving take time in proportion to the number of tiles touched.
+
+"""
+
+## Imports
+
+import os
+import mmap
+import zlib
+import struct
+import zipfile
+import weakref
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+
+import tiledsurface
+from tiledsurface import N
+
+
+## Module constants
+
+#: File extension of working files
+FILE_EXTENSION = ".mypaint"
+
+#: Mimetype of working files (the first entry in the container)
+MIMETYPE = "application/x-mypaint-working"
+
+#: File name suffix of tile stores within the container
+TILES_SUFFIX = ".tiles"
+
+#: zlib compression level for tile data
+COMPRESSION_LEVEL = 1
+
+_TILES_MAGIC = "MYPTILES"
+_TILES_VERSION = 1
+_TILES_HEADER = struct.Struct("<8sIII")  # magic, version, N, count
+_TILES_INDEX_ENTRY = struct.Struct("<iiII")  # tx, ty, offset, length
+
+# Live TileSources, so that files can be released before being replaced
+_sources = weakref.WeakValueDictionary()
+
+# Spill files to delete once their TileSources are gone: {ref: filename}
+_spill_files = {}
+
+
+## Class defs
+
+class TileSource (object):
+    """A working file, memory-mapped for reading tiles from"""
+
+    def __init__(self, filename):
+        """Initialize, mapping the file
+
+        :param unicode filename: the working file to map
+
+        """
+        super(TileSource, self).__init__()
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        _sources[id(self)] = self
+
+    def read(self, offset, length):
+        """Reads a range of bytes from the file"""
+        return self._data[offset:offset+length]
+
+    def member_offset(self, zinfo):
+        """Returns the offset of an uncompressed ZIP member's data
+
+        :param zipfile.ZipInfo zinfo: the member
+        :rtype: int
+
+        """
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile("%r is compressed" % (zinfo.filename,))
+        header = self.read(zinfo.header_offset, zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            raise zipfile.BadZipfile("Truncated file header")
+        header = struct.unpack(zipfile.structFileHeader, header)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad magic number for file header")
+        return (zinfo.header_offset + zipfile.sizeFileHeader
+                + header[zipfile._FH_FILENAME_LENGTH]
+                + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+    def load_tiles(self, zinfo):
+        """Reads a tile store's index, returning a dict of mapped tiles
+
+        :param zipfile.ZipInfo zinfo: the tile store's ZIP member
+        :returns: MappedTiles, keyed by (tx, ty)
+        :rtype: dict
+
+        """
+        base = self.member_offset(zinfo)
+        header = self.read(base, _TILES_HEADER.size)
+        if len(header) != _TILES_HEADER.size:
+            raise ValueError("Truncated tile store %r" % (zinfo.filename,))
+        magic, version, tile_size, count = _TILES_HEADER.unpack(header)
+        if magic != _TILES_MAGIC or version != _TILES_VERSION:
+            raise ValueError("Not a tile store: %r" % (zinfo.filename,))
+        if tile_size != N:
+            raise ValueError("Tile store %r has %dpx tiles, not %dpx"
+                             % (zinfo.filename, tile_size, N))
+        entry_size = _TILES_INDEX_ENTRY.size
+        index = self.read(base + _TILES_HEADER.size, count * entry_size)
+        if len(index) != count * entry_size:
+            raise ValueError("Truncated tile store %r" % (zinfo.filename,))
+        tiles = {}
+        for i in xrange(count):
+            tx, ty, offset, length = _TILES_INDEX_ENTRY.unpack_from(
+                index, i * entry_size,
+            )
+            tiles[(tx, ty)] = MappedTile(self, base + offset, length)
+        return tiles
+
+    def detach(self):
+        """Reads the whole file into memory, and unmaps it
+
+        Tiles loaded from the file remain usable. On some platforms, a
+        file can't be replaced while it's mapped.
+        """
+        if isinstance(self._data, str):
+            return
+        data = self._data[:]
+        self._data.close()
+        self._file.close()
+        self._data = data
+
+
+class MappedTile (tiledsurface.Tile):
+    """A tile whose pixels are decompressed from a working file on demand
+
+    Mapped tiles are always read-only, so the surfaces they belong to
+    replace them with ordinary private copies before painting on them.
+
+    """
+
+    def __init__(self, source, offset, length):
+        # No supercall: that would allocate pixel memory.
+        object.__init__(self)
+        self._source = source
+        self._offset = offset
+        self._length = length
+        self._rgba = None
+        self.readonly = True
+
+    @property
+    def rgba(self):
+        """The tile's pixels, decompressed the first time they're used"""
+        if self._rgba is None:
+            data = zlib.decompress(self.compressed_data())
+            rgba = numpy.fromstring(data, dtype="<u2")
+            rgba = rgba.astype("uint16", copy=False).reshape((N, N, 4))
+            self._rgba = rgba
+        return self._rgba
+
+    @property
+    def nbytes(self):
+        """Memory used by the tile's pixels: none until decompressed"""
+        if self._rgba is None:
+            return 0
+        return self._rgba.nbytes
+
+    def compressed_data(self):
+        """The tile's compressed pixels, as stored in the working file"""
+        return self._source.read(self._offset, self._length)
+
+
+## Module functions
+
+def encode_tiles(tiles):
+    """Encodes tiles as a tile store
+
+    :param dict tiles: Tiles, keyed by (tx, ty), which won't be modified
+    :returns: the tile store's data
+    :rtype: str
+
+    This can be called from worker threads. Mapped tiles are copied
+    without being decompressed.
+
+    >>> t = tiledsurface.Tile()
+    >>> t.rgba[10, 20] = (1, 2, 3, 4)
+    >>> data = encode_tiles({(3, -2): t, (0, 0): tiledsurface.Tile()})
+    >>> data.startswith(_TILES_MAGIC)
+    True
+
+    Fully transparent tiles are skipped.
+
+    >>> _TILES_HEADER.unpack_from(data)[-1]
+    1
+
+    """
+    blobs = []
+    index = []
+    offset = _TILES_HEADER.size
+    for (tx, ty), tile in sorted(tiles.iteritems()):
+        if isinstance(tile, MappedTile):
+            blob = tile.compressed_data()
+        else:
+            rgba = tile.rgba
+            if not rgba[:, :, 3].any():
+                continue
+            rgba = numpy.ascontiguousarray(rgba, dtype="<u2")
+            blob = zlib.compress(rgba.tostring(), COMPRESSION_LEVEL)
+        index.append((tx, ty, len(blob)))
+        blobs.append(blob)
+    offset += len(index) * _TILES_INDEX_ENTRY.size
+    chunks = [_TILES_HEADER.pack(_TILES_MAGIC, _TILES_VERSION, N,
+                                 len(index))]
+    for tx, ty, length in index:
+        chunks.append(_TILES_INDEX_ENTRY.pack(tx, ty, offset, length))
+        offset += length
+    chunks.extend(blobs)
+    return "".join(chunks)
+
+
+def spill_tiles(tiles, filename):
+    """Writes tiles out to a file, and returns mapped stand-ins for them
+
+    :param list tiles: Tiles to write, which won't be modified
+    :param unicode filename: New file to write them to
+    :returns: one read-only MappedTile per tile, in the same order
+    :rtype: list
+
+    This is used to move pixel data which isn't needed often out of
+    memory. The tiles returned have the same pixels as those passed in,
+    but they're only decompressed from the file when used. The file is
+    deleted once none of them are in use any more.
+
+    """
+    offset = 0
+    index = []
+    with open(filename, "wb") as fp:
+        for tile in tiles:
+            if isinstance(tile, MappedTile):
+                blob = tile.compressed_data()
+            else:
+                rgba = numpy.ascontiguousarray(tile.rgba, dtype="<u2")
+                blob = zlib.compress(rgba.tostring(), COMPRESSION_LEVEL)
+            fp.write(blob)
+            index.append((offset, len(blob)))
+            offset += len(blob)
+    if not index:
+        os.remove(filename)
+        return []
+    source = TileSource(filename)
+    ref = weakref.ref(source, _spill_source_freed_cb)
+    _spill_files[ref] = filename
+    return [MappedTile(source, o, n) for (o, n) in index]
+
+
+def _spill_source_freed_cb(ref):
+    """Internal: deletes a spill file once nothing can read from it"""
+    filename = _spill_files.pop(ref, None)
+    if filename is None:
+        return
+    try:
+        os.remove(filename)
+    except OSError as err:
+        # Normal on Windows; the doc's tempdir cleanup gets it later.
+        logger.debug("Cannot remove spill file %r yet: %r", filename, err)
+
+
+def release_file(filename):
+    """Detaches every TileSource mapping a file (see TileSource.detach)"""
+    path = os.path.realpath(filename)
+    for source in list(_sources.values()):
+        if os.path.realpath(source.filename) == path:
+            source.detach()
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,280 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Ordered ZIP writer with entries encoded in parallel
+
+Saving an OpenRaster file is dominated by PNG compression of the
+layers. The native PNG encoder releases the GIL while it compresses, so
+this writer hands the encoding of each entry to a pool of worker
+threads, and streams the encoded data straight into the archive without
+using any tempfiles. Entries always appear in the archive in the order
+they were submitted, whichever worker finishes first.
+
+Entries can also be copied raw from an earlier version of the archive,
+without being decompressed or decoded. This makes resaving a document
+with mostly unchanged layers cheap.
+
+"""
+
+## Imports
+
+import zipfile
+import collections
+import struct
+import uuid
+import logging
+logger = logging.getLogger(__name__)
+
+from lib.workerpool import WorkerPool
+
+
+## Module constants
+
+# Kinds of pending entry
+_DATA = 0
+_FILE = 1
+_DEFERRED = 2
+_RAW_COPY = 3
+
+
+## Class defs
+
+class OrderedZipWriter (object):
+    """Writes ZIP entries in order, encoding deferred ones in parallel
+
+    >>> import tempfile, shutil, os
+    >>> d = tempfile.mkdtemp()
+    >>> zpath = os.path.join(d, "test.zip")
+    >>> z = OrderedZipWriter(zpath, threads=4)
+    >>> z.writestr("mimetype", "text/plain")
+    >>> for i in xrange(10):
+    ...     z.writestr_deferred("data/%02d.txt" % (i,), str, i)
+    >>> z.writestr("index.txt", "the end")
+    >>> z.close()
+    >>> names = zipfile.ZipFile(zpath).namelist()
+    >>> names[0], names[-1], len(names)
+    ('mimetype', 'index.txt', 12)
+    >>> names[1:-1] == sorted(names[1:-1])
+    True
+
+    Entries can be copied from an earlier archive, under new names:
+
+    >>> prev = zipfile.ZipFile(zpath)
+    >>> z2 = OrderedZipWriter(os.path.join(d, "test2.zip"), previous=prev)
+    >>> z2.copy_from_previous("data/03.txt", "three.txt")
+    True
+    >>> z2.copy_from_previous("data/99.txt", "nothing.txt")
+    False
+    >>> z2.close()
+    >>> prev.close()
+    >>> zipfile.ZipFile(z2.filename).read("three.txt")
+    '3'
+    >>> shutil.rmtree(d, ignore_errors=True)
+
+    All entries are written with sensible permissions, working around
+    http://bugs.python.org/issue3394. Encoder functions run in worker
+    threads, so they must not touch the GUI; `feedback_cb` is instead
+    called from the thread that owns the writer while it waits.
+
+    """
+
+    def __init__(self, filename, compression=zipfile.ZIP_STORED,
+                 threads=None, feedback_cb=None,
+                 previous=None, previous_id=None):
+        """Initialize, opening the ZIP file for writing
+
+        :param unicode filename: the file to create
+        :param int compression: the ZIP compression type for entries
+        :param int threads: number of encoder threads (default: see
+          `lib.workerpool.DEFAULT_THREADS`)
+        :param callable feedback_cb: called periodically while waiting
+        :param zipfile.ZipFile previous: earlier archive to copy from
+        :param previous_id: identifies `previous` (see `archive_id`)
+
+        """
+        super(OrderedZipWriter, self).__init__()
+        self._zip = zipfile.ZipFile(filename, 'w', compression=compression)
+        self._pool = WorkerPool(threads, feedback_cb)
+        self._pending = collections.deque()
+        #: Unique identifier for the archive being written. Callers can
+        #: remember it alongside the names of the entries they write,
+        #: and later pass it as `previous_id` to allow raw copies.
+        #: Set it to None if the entries aren't worth remembering.
+        self.archive_id = uuid.uuid4().hex
+        #: The earlier archive which entries can be copied from
+        self.previous = previous
+        #: The identifier of `previous`, or None
+        self.previous_id = None
+        if previous is not None:
+            self.previous_id = previous_id
+
+    @property
+    def filename(self):
+        """The name of the file being written"""
+        return self._zip.filename
+
+    ## Adding entries
+
+    def writestr(self, name, data):
+        """Adds an entry with the given data
+
+        :param str name: name to store the data under
+        :param str data: data to store
+
+        """
+        self._pending.append((_DATA, self._make_zinfo(name), data))
+        self._flush(block=False)
+
+    def write(self, filename, name):
+        """Adds an entry copied from a file
+
+        :param unicode filename: file to copy data from
+        :param str name: name to store the data under
+
+        """
+        self._pending.append((_FILE, name, filename))
+        self._flush(block=False)
+
+    def writestr_deferred(self, name, func, *args, **kwargs):
+        """Adds an entry whose data is computed by a worker thread
+
+        :param str name: name to store the data under
+        :param callable func: returns the data to store, as a str
+        :param \*args: positional args for `func`
+        :param \*\*kwargs: keyword args for `func`
+
+        Any exception raised by `func` is re-raised by a later call to
+        one of the methods of this object.
+
+        """
+        zinfo = self._make_zinfo(name)
+        result = self._pool.apply_async(func, *args, **kwargs)
+        self._pending.append((_DEFERRED, zinfo, result))
+        self._flush(block=False)
+        # Bound the amount of encoded data held in memory at once
+        while len(self._pending) > self._pool.max_pending:
+            self._flush_one()
+
+    def copy_from_previous(self, previous_name, name):
+        """Adds an entry copied raw from the previous archive
+
+        :param str previous_name: name of the entry in `previous`
+        :param str name: name to store the data under
+        :returns: whether a copy will be made
+        :rtype: bool
+
+        The entry's data is copied without being decompressed, so the
+        copy is cheap. Nothing is added if there is no previous archive,
+        or if it has no usable entry named `previous_name`.
+
+        """
+        if self.previous is None:
+            return False
+        try:
+            src_info = self.previous.getinfo(previous_name)
+        except KeyError:
+            return False
+        if src_info.flag_bits & 0x01:  # encrypted
+            return False
+        self._pending.append((_RAW_COPY, self._make_zinfo(name), src_info))
+        self._flush(block=False)
+        return True
+
+    ## Finishing up
+
+    def close(self):
+        """Writes all remaining entries, and closes the ZIP file"""
+        try:
+            self._flush(block=True)
+        except:
+            self.abort()
+            raise
+        self._pool.close()
+        self._zip.close()
+
+    def abort(self):
+        """Stops all encoding, and closes the (incomplete) file"""
+        self._pending.clear()
+        self._pool.abort()
+        self._zip.close()
+
+    ## Internals
+
+    @staticmethod
+    def _make_zinfo(name):
+        zinfo = zipfile.ZipInfo(name)
+        zinfo.external_attr = 0100644 << 16
+        return zinfo
+
+    def _flush(self, block):
+        """Write pending entries in order, optionally waiting for all"""
+        while self._pending:
+            kind, zinfo, payload = self._pending[0]
+            if not block and kind == _DEFERRED and not payload.ready():
+                return
+            self._flush_one()
+
+    def _flush_one(self):
+        """Write the oldest pending entry, waiting for it if needed"""
+        kind, zinfo, payload = self._pending[0]
+        if kind == _FILE:
+            self._zip.write(payload, zinfo)
+        elif kind == _RAW_COPY:
+            self._copy_raw(zinfo, payload)
+        else:
+            if kind == _DEFERRED:
+                payload = self._pool.wait(payload)
+            self._zip.writestr(zinfo, payload)
+        self._pending.popleft()
+
+    def _copy_raw(self, zinfo, src_info):
+        """Copy an entry's compressed data from the previous archive
+
+        The zipfile module has no public API for this, so the local
+        header is parsed here, and the data is appended the same way
+        `ZipFile.writestr()` does it.
+        """
+        src_fp = self.previous.fp
+        src_fp.seek(src_info.header_offset)
+        header = src_fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            raise zipfile.BadZipfile("Truncated file header")
+        header = struct.unpack(zipfile.structFileHeader, header)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad magic number for file header")
+        src_fp.seek(header[zipfile._FH_FILENAME_LENGTH]
+                    + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        data = src_fp.read(src_info.compress_size)
+        if len(data) != src_info.compress_size:
+            raise zipfile.BadZipfile("Truncated data for %r"
+                                     % (src_info.filename,))
+        zinfo.date_time = src_info.date_time
+        zinfo.compress_type = src_info.compress_type
+        zinfo.CRC = src_info.CRC
+        zinfo.compress_size = src_info.compress_size
+        zinfo.file_size = src_info.file_size
+        z = self._zip
+        zinfo.header_offset = z.fp.tell()
+        z._writecheck(zinfo)
+        z._didModify = True
+        z.fp.write(zinfo.FileHeader())
+        z.fp.write(data)
+        z.fp.flush()
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+
+
+## Module testing
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
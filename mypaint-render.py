@@ -0,0 +1,52 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Headless batch renderer: flattens documents to PNG or JPEG files.
+
+This script just works out where the python modules are, then hands
+over to `lib.render.main()`. Run with ``--help`` for usage.
+"""
+
+import sys
+import os
+import logging
+logger = logging.getLogger('mypaint-render')
+
+
+def setup_paths():
+    """Puts the MyPaint modules on sys.path (installed or source tree)"""
+    join = os.path.join
+    scriptdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    if os.path.basename(scriptdir) == 'bin':
+        # Normal POSIX installation, see mypaint.py
+        prefix = os.path.dirname(scriptdir)
+        sys.path.insert(0, join(prefix, 'share', 'mypaint'))
+        sys.path.insert(0, join(prefix, 'lib', 'mypaint'))
+        sys.path.insert(0, join(prefix, 'share'))  # for libmypaint
+    elif all(os.path.exists(join(scriptdir, d)) for d in ['lib', 'gui']):
+        # Running from within the source tree
+        sys.path.insert(0, scriptdir)
+    else:
+        raise RuntimeError("Unknown install type; could not determine paths")
+
+
+if __name__ == '__main__':
+    log_format = "%(levelname)s: %(name)s: %(message)s"
+    logging_level = logging.WARNING
+    if os.environ.get("MYPAINT_DEBUG", False):
+        logging_level = logging.DEBUG
+    logging.basicConfig(format=log_format, level=logging_level,
+                        stream=sys.stderr)
+    setup_paths()
+    try:
+        from lib import mypaintlib
+    except ImportError:
+        logger.critical("We are not correctly installed or compiled!")
+        raise
+    import lib.render
+    sys.exit(lib.render.main(sys.argv[1:]))
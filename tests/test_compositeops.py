@@ -124,3 +124,59 @@ for mode in xrange(mypaintlib.NumCombineModes):
         print "  %s needs localizable UI strings" % (mode_name,)
     if all_ok:
         print "ok"
+
+# The fused display path must match combining then converting separately
+print "tile_composite_rgba8",
+all_ok = True
+for mode in xrange(mypaintlib.NumCombineModes):
+    for dst_has_alpha in (True, False):
+        dst = numpy.empty((N, N, 4), dtype='uint16')
+        dst[...] = dst_orig[...]
+        mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, 0.75)
+        expected = numpy.empty((N, N, 4), dtype='uint8')
+        if dst_has_alpha:
+            mypaintlib.tile_convert_rgba16_to_rgba8(dst, expected)
+        else:
+            mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, expected)
+        fused = numpy.empty((N, N, 4), dtype='uint8')
+        mypaintlib.tile_composite_rgba8([(src, mode, 0.75)], dst_orig, None,
+                                        fused, dst_has_alpha)
+        if not (fused == expected).all():
+            if all_ok:
+                print "**FAILED**"
+                all_ok = False
+            print ("  %s differs from tile_combine (dst_has_alpha=%r)"
+                   % (mypaintlib.combine_mode_get_info(mode)["name"],
+                      dst_has_alpha))
+if all_ok:
+    print "ok"
+
+# Op lists must match the equivalent sequence of tile_combine() calls
+print "tile_combine_ops",
+all_ok = True
+for mode in xrange(mypaintlib.NumCombineModes):
+    # Isolated group: src composited over a transparent tile, then combined
+    expected = numpy.empty((N, N, 4), dtype='uint16')
+    expected[...] = dst_orig[...]
+    group = numpy.zeros((N, N, 4), dtype='uint16')
+    mypaintlib.tile_combine(mypaintlib.CombineNormal, src, group, True, 1.0)
+    mypaintlib.tile_combine(mode, dst_orig, group, True, 0.5)
+    mypaintlib.tile_combine(mode, group, expected, True, 0.75)
+    mypaintlib.tile_combine(mypaintlib.CombineNormal, src, expected,
+                            True, 0.25)
+    result = numpy.empty((N, N, 4), dtype='uint16')
+    result[...] = dst_orig[...]
+    ops = [
+        ([(src, mypaintlib.CombineNormal, 1.0),
+          (dst_orig, mode, 0.5)], mode, 0.75),
+        (src, mypaintlib.CombineNormal, 0.25),
+    ]
+    mypaintlib.tile_combine_ops(ops, result, True)
+    if not (result == expected).all():
+        if all_ok:
+            print "**FAILED**"
+            all_ok = False
+        print ("  %s differs from tile_combine"
+               % (mypaintlib.combine_mode_get_info(mode)["name"],))
+if all_ok:
+    print "ok"
@@ -281,6 +281,357 @@ def docPaint():
     assert pngs_equal('test_docPaint_alpha.png', 'correct_docPaint_alpha.png')
 
 
+def paint_brushwork(doc, events):
+    cmd = command.Brushwork(doc, doc.layer_stack.current_path)
+    t_old = events[0][0]
+    for t, x, y, pressure in events:
+        cmd.stroke_to(t - t_old, x, y, pressure, 0.0, 0.0)
+        t_old = t
+    assert cmd.stop_recording()
+    doc.do(cmd)
+
+
+def strokemapLazy():
+    import zipfile
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')[:200]
+    paint_brushwork(doc, events)
+    doc.save('test_strokemap1.ora')
+
+    # Strokemaps are parsed on first use, and resaved as they were if
+    # they haven't been used.
+    doc2 = document.Document(b)
+    doc2.load('test_strokemap1.ora')
+    doc2.save('test_strokemap2.ora')
+    z1 = zipfile.ZipFile('test_strokemap1.ora')
+    z2 = zipfile.ZipFile('test_strokemap2.ora')
+    names = [n for n in z1.namelist() if n.endswith('strokemap.dat')]
+    assert len(names) == 1
+    assert z1.read(names[0]) == z2.read(names[0])
+    t, x, y, pressure = events[100]
+    assert doc2.layer_stack[0].get_stroke_info_at(x, y) is not None
+    doc.cleanup()
+    doc2.cleanup()
+
+
+def lazyLoadMargins():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')[:200]
+    paint_brushwork(doc, events)
+    doc.save('test_lazy1.ora')
+    doc2 = document.Document(b)
+    doc2.load('test_lazy1.ora', lazy=True)
+    root = doc2.layer_stack
+    surface = root[0]._surface
+    assert surface.load_is_pending
+
+    # Drawing the canvas margins doesn't decode anything, whatever the
+    # rendering mode or zoom level.
+    N = tiledsurface.N
+    bbox = root[0].get_bbox()
+    tx = (bbox.x + bbox.w) // N + 4
+    ty = bbox.y // N
+    dst = numpy.zeros((N, N, 4), 'uint8')
+    root.composite_tile(dst, True, tx, ty, 0, display=True)
+    root.current_layer_solo = True
+    root.composite_tile(dst, True, tx, ty, 0, display=True)
+    root.current_layer_solo = False
+    root.composite_tile(dst, True, tx//4 + 1, ty//4, 2, display=True)
+    assert surface.load_is_pending
+
+    # Anything which needs the layer's pixels still gets them
+    root.finish_lazy_load()
+    assert not surface.load_is_pending
+    assert not root[0].get_bbox().empty()
+    doc.cleanup()
+    doc2.cleanup()
+
+
+def workingFileRoundtrip():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')[:400]
+    paint_brushwork(doc, events[:200])
+    doc.add_layer(1)
+    paint_brushwork(doc, events[200:])
+
+    # Working files keep the tiles exactly, and where they were
+    doc.save('test_wf1.mypaint')
+    doc2 = document.Document(b)
+    doc2.load('test_wf1.mypaint')
+    assert doc.get_bbox() == doc2.get_bbox()
+    assert len(doc2.layer_stack) == len(doc.layer_stack)
+    for i, (l1, l2) in enumerate(zip(doc.layer_stack, doc2.layer_stack)):
+        assert l1.get_bbox() == l2.get_bbox()
+        l1.save_as_png('test_wf_a%d.png' % (i,))
+        l2.save_as_png('test_wf_b%d.png' % (i,))
+        assert pngs_equal('test_wf_a%d.png' % (i,), 'test_wf_b%d.png' % (i,))
+    doc2.save('test_wf2.mypaint')
+    assert files_equal('test_wf1.mypaint', 'test_wf2.mypaint')
+    doc.cleanup()
+    doc2.cleanup()
+
+
+def saveThumbnail():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')
+    paint_brushwork(doc, events)
+
+    # Thumbnails made while saving look like separately rendered ones
+    expected = doc.render_thumbnail()
+    expected_arr = helpers.gdkpixbuf2numpy(expected)[..., :3]
+    for filename in ('test_thumb.png', 'test_thumb.jpg', 'test_thumb.ora'):
+        thumbnail = doc.save(filename)
+        assert thumbnail is not None
+        assert thumbnail.get_width() == expected.get_width()
+        assert thumbnail.get_height() == expected.get_height()
+        arr = helpers.gdkpixbuf2numpy(thumbnail)[..., :3]
+        diff = abs(arr.astype(int) - expected_arr.astype(int))
+        assert diff.mean() < 4, (filename, diff.mean())
+    doc.cleanup()
+
+
+def pixbufStreamLoad():
+    import lib.pixbuf
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')[:200]
+    paint_brushwork(doc, events)
+    doc.save('test_stream.jpg')
+
+    # Loading in strips gives the same tiles as loading it all at once
+    doc2 = document.Document(b)
+    doc2.load('test_stream.jpg')
+    doc3 = document.Document(b)
+    doc3.load_from_pixbuf(lib.pixbuf.load_from_file('test_stream.jpg'))
+    assert doc2.get_bbox() == doc3.get_bbox()
+    doc2.layer_stack.save_as_png('test_stream2.png')
+    doc3.layer_stack.save_as_png('test_stream3.png')
+    assert files_equal('test_stream2.png', 'test_stream3.png')
+
+    # Other formats fall back to GdkPixbuf, with the same results
+    s = tiledsurface.Surface()
+    with open('test_stream2.png', 'rb') as fp:
+        s.load_from_pixbuf_stream(fp, 0, 0)
+    s.save_as_png('test_stream4.png')
+    s2 = tiledsurface.Surface()
+    s2.load_from_png('test_stream2.png', 0, 0, convert_to_srgb=False)
+    s2.save_as_png('test_stream5.png')
+    assert files_equal('test_stream4.png', 'test_stream5.png')
+    doc.cleanup()
+    doc2.cleanup()
+    doc3.cleanup()
+
+
+def saveDeepZoom():
+    import math
+    import shutil
+    import struct
+    import lib.deepzoom
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    paint_brushwork(doc, numpy.loadtxt('painting30sec.dat')[:200])
+    x, y, cw, ch = doc.layer_stack.get_bbox()
+    # Odd dimensions, with blank space right of the painting
+    w, h = cw + 1001, ch + 1
+    if os.path.isdir('test_dzi_files'):
+        shutil.rmtree('test_dzi_files')
+    lib.deepzoom.save_dzi(doc.layer_stack, 'test_dzi.dzi', (x, y, w, h),
+                          alpha=True)
+
+    # One level per halving, down to a single pixel
+    max_level = int(math.ceil(math.log(max(w, h), 2)))
+    levels = sorted(int(n) for n in os.listdir('test_dzi_files'))
+    assert levels == range(max_level + 1)
+
+    # Edge tiles are cropped to the level's size, rounded up
+    size = lib.deepzoom.TILE_SIZE
+    for level in levels:
+        scale = 2 ** (max_level - level)
+        lw = -(-w // scale)
+        lh = -(-h // scale)
+        level_dir = os.path.join('test_dzi_files', str(level))
+        for name in os.listdir(level_dir):
+            col, row = [int(i) for i in name[:-4].split('_')]
+            with open(os.path.join(level_dir, name), 'rb') as fp:
+                tw, th = struct.unpack('>II', fp.read(24)[16:24])
+            assert tw == min(size, lw - col*size), (level, name, tw)
+            assert th == min(size, lh - row*size), (level, name, th)
+
+    # Fully transparent tiles aren't written
+    names = os.listdir(os.path.join('test_dzi_files', str(max_level)))
+    cols = set(int(name.split('_')[0]) for name in names)
+    assert cols and all(col*size < cw for col in cols)
+    assert len(names) < (-(-w // size)) * (-(-h // size))
+    doc.cleanup()
+
+
+def undoMemoryBudget():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    # Without a tempdir, old steps can't be spilled to disk
+    doc = document.Document(b, painting_only=True)
+    stack = doc.command_stack
+    events = numpy.loadtxt('painting30sec.dat')[:500]
+
+    # Plenty of memory: everything is kept
+    for i in xrange(5):
+        paint_brushwork(doc, events[i*100:(i+1)*100])
+    assert len(stack.undo_stack) == 5
+    used = stack.get_memory_use()
+    assert 0 < used <= stack.memory_budget
+
+    # Tiles shared with the document aren't counted
+    doc.undo()
+    assert stack.get_memory_use() > 0
+    doc.redo()
+    assert stack.get_memory_use() == used
+
+    # Nor are layers which are still part of the document
+    layer = doc.layer_stack.current
+    doc.set_layer_visibility(False, layer)
+    assert stack.get_memory_use() == used
+    doc.set_layer_visibility(True, layer)
+
+    # No memory at all: only the minimum number of steps is kept
+    stack.memory_budget = 0
+    stack.min_steps = 2
+    paint_brushwork(doc, events[400:])
+    assert len(stack.undo_stack) == 2
+    assert stack.get_memory_use() > 0
+
+    stack.clear()
+    assert stack.get_memory_use() == 0
+    doc.cleanup()
+
+
+def undoSpill():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    stack = doc.command_stack
+    events = numpy.loadtxt('painting30sec.dat')[:600]
+    paint_brushwork(doc, events[:100])
+    doc.layer_stack.save_as_png('test_spill1.png')
+    for i in xrange(1, 5):
+        paint_brushwork(doc, events[i*100:(i+1)*100])
+    used = stack.get_memory_use()
+
+    # Old steps are moved to disk rather than forgotten
+    stack.memory_budget = 0
+    stack.min_steps = 1
+    paint_brushwork(doc, events[500:])
+    assert len(stack.undo_stack) == 6
+    assert stack.spilled_steps > 0
+    assert stack.get_memory_use() < used
+    assert os.listdir(os.path.join(doc.tempdir, 'undo'))
+
+    # ... and read back when undone
+    stack.memory_budget = 1024**3
+    for i in xrange(5):
+        doc.undo()
+    assert stack.spilled_steps == 1  # the first step, not undone
+    doc.layer_stack.save_as_png('test_spill2.png')
+    assert pngs_equal('test_spill1.png', 'test_spill2.png')
+    doc.cleanup()
+
+
+def undoDelta():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b, painting_only=True)
+    layer = doc.layer_stack.current
+    events = numpy.loadtxt('painting30sec.dat')
+    paint_brushwork(doc, events[:1000])
+    doc.layer_stack.save_as_png('test_delta1.png')
+    n_strokes = len(layer.strokes)
+    paint_brushwork(doc, events[1000:1100])
+    doc.layer_stack.save_as_png('test_delta2.png')
+
+    # Only the tiles the stroke changed are kept
+    delta = doc.get_last_command()._delta
+    n_tiles = len(delta.surface_after.tiledict)
+    assert 0 < n_tiles < len(layer._surface.tiledict)
+    assert len(delta.surface_before.tiledict) <= n_tiles
+
+    # Undo and redo patch them in and out
+    doc.undo()
+    assert len(layer.strokes) == n_strokes
+    doc.layer_stack.save_as_png('test_delta3.png')
+    assert pngs_equal('test_delta1.png', 'test_delta3.png')
+    doc.redo()
+    assert len(layer.strokes) == n_strokes + 1
+    doc.layer_stack.save_as_png('test_delta4.png')
+    assert pngs_equal('test_delta2.png', 'test_delta4.png')
+
+    # Painting after an undo leaves the undone tiles alone
+    doc.undo()
+    paint_brushwork(doc, events[1100:1200])
+    doc.undo()
+    doc.layer_stack.save_as_png('test_delta5.png')
+    assert pngs_equal('test_delta1.png', 'test_delta5.png')
+    doc.cleanup()
+
+
+def docJournal():
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b, journal=True)
+    events = numpy.loadtxt('painting30sec.dat')[:400]
+    paint_brushwork(doc, events[:200])
+    paint_brushwork(doc, events[200:])
+    doc.undo()
+    doc.redo()
+    doc.add_layer((0,))
+    doc.undo()
+
+    # rebuild it in another document, as if after a crash
+    doc2 = document.Document(b, journal=True)
+    journal_dir = os.path.join(doc.tempdir, 'recovery')
+    doc2.recover_from_journal(journal_dir)
+    assert len(doc2.layer_stack) == len(doc.layer_stack)
+    assert doc2.get_bbox() == doc.get_bbox()
+    doc.layer_stack[0].save_as_png('test_docJournal_a.png')
+    doc2.layer_stack[0].save_as_png('test_docJournal_b.png')
+    assert pngs_equal('test_docJournal_a.png', 'test_docJournal_b.png')
+    doc.cleanup()
+    doc2.cleanup()
+
+
+def docAutosave():
+    import shutil
+    import tempfile
+    import lib.autosave
+    b = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    doc = document.Document(b)
+    events = numpy.loadtxt('painting30sec.dat')
+    layer = doc.layer_stack.current
+    paint_brushwork(doc, events[:200])
+    layer.save_as_png('test_docAutosave_a.png')
+    dirname = tempfile.mkdtemp()
+    autosaver = lib.autosave.Autosaver(doc, dirname)
+    results = []
+
+    def autosave_finished_cb(autosaver, *args):
+        results.append(args)
+
+    autosaver.autosave_finished += autosave_finished_cb
+    assert autosaver.autosave()
+    # Painting can carry on while the snapshot is saved
+    paint_brushwork(doc, events[200:400])
+    autosaver.close()
+    assert len(results) == 1
+    filename, blocked, elapsed = results[0]
+    print 'autosave: %.3fs blocked, %.3fs in background' % (blocked, elapsed)
+
+    doc2 = document.Document(b)
+    doc2.load(filename)
+    doc2.layer_stack.current.save_as_png('test_docAutosave_b.png')
+    assert pngs_equal('test_docAutosave_a.png', 'test_docAutosave_b.png')
+    shutil.rmtree(dirname)
+    doc.cleanup()
+    doc2.cleanup()
+
+
 def saveFrame():
     print 'test-saving various frame sizes...'
     cnt = 0
@@ -316,6 +667,17 @@ options, tests = parser.parse_args()
 directPaint()
 brushPaint()
 #    docPaint()
+strokemapLazy()
+lazyLoadMargins()
+workingFileRoundtrip()
+saveThumbnail()
+pixbufStreamLoad()
+saveDeepZoom()
+undoMemoryBudget()
+undoSpill()
+undoDelta()
+docJournal()
+docAutosave()
 
 #saveFrame()
 
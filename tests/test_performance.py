@@ -159,6 +159,22 @@ def load_ora():
     yield stop_measurement
 
 
+@nogui_test
+def load_ora_single_thread():
+    """Like load_ora, but decoding layer PNGs in one thread only"""
+    from lib import document
+    import lib.workerpool
+    d = document.Document()
+    threads = lib.workerpool.DEFAULT_THREADS
+    lib.workerpool.DEFAULT_THREADS = 1
+    try:
+        yield start_measurement
+        d.load('bigimage.ora')
+        yield stop_measurement
+    finally:
+        lib.workerpool.DEFAULT_THREADS = threads
+
+
 @nogui_test
 def save_ora():
     from lib import document
@@ -180,6 +196,23 @@ def save_ora_again():
     yield stop_measurement
 
 
+@nogui_test
+def save_ora_single_thread():
+    """Like save_ora, but encoding layer PNGs in one thread only"""
+    from lib import document
+    import lib.workerpool
+    d = document.Document()
+    d.load('bigimage.ora')
+    threads = lib.workerpool.DEFAULT_THREADS
+    lib.workerpool.DEFAULT_THREADS = 1
+    try:
+        yield start_measurement
+        d.save('test_save.ora')
+        yield stop_measurement
+    finally:
+        lib.workerpool.DEFAULT_THREADS = threads
+
+
 @nogui_test
 def save_png():
     from lib import document
@@ -190,6 +223,53 @@ def save_png():
     yield stop_measurement
 
 
+@nogui_test
+def save_jpeg():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save('test_save.jpg')
+    yield stop_measurement
+
+
+@nogui_test
+def save_dzi():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save('test_save.dzi')
+    yield stop_measurement
+
+
+@nogui_test
+def save_png_multifile():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save('test_save.png', multifile=True)
+    yield stop_measurement
+
+
+@nogui_test
+def save_png_multifile_single_thread():
+    """Like save_png_multifile, but exporting one layer at a time"""
+    from lib import document
+    import lib.workerpool
+    d = document.Document()
+    d.load('bigimage.ora')
+    threads = lib.workerpool.DEFAULT_THREADS
+    lib.workerpool.DEFAULT_THREADS = 1
+    try:
+        yield start_measurement
+        d.save('test_save.png', multifile=True)
+        yield stop_measurement
+    finally:
+        lib.workerpool.DEFAULT_THREADS = threads
+
+
 @nogui_test
 def save_png_layer():
     from lib import document
@@ -200,6 +280,58 @@ def save_png_layer():
     yield stop_measurement
 
 
+def _save_with_png_compression(filename, profile):
+    """Saves bigimage.ora with a PNG compression profile, and its size"""
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save(filename, png_compression=profile)
+    yield stop_measurement
+    print 'size =', os.path.getsize(filename)
+
+
+@nogui_test
+def save_png_fast():
+    return _save_with_png_compression('test_save.png', "fast")
+
+
+@nogui_test
+def save_png_best():
+    return _save_with_png_compression('test_save.png', "best")
+
+
+@nogui_test
+def save_ora_fast():
+    return _save_with_png_compression('test_save.ora', "fast")
+
+
+@nogui_test
+def save_ora_best():
+    return _save_with_png_compression('test_save.ora', "best")
+
+
+@nogui_test
+def strokemap_save_load():
+    """Encodes and decodes a big strokemap, in the indexed format"""
+    import zlib
+    import numpy
+    from lib import strokemap
+    bitmap = numpy.zeros((strokemap.N, strokemap.N), 'uint8')
+    bitmap[10:20, 5:50] = 1
+    bitmap = zlib.compress(bitmap.tostring())
+    shapes = []
+    for i in xrange(500):
+        tiles = {}
+        for j in xrange(400):
+            tiles[i + j % 20, j // 20] = bitmap
+        shapes.append(("brush %d" % (i % 7,), tiles))
+    yield start_measurement
+    data = strokemap.encode_strokemap(shapes, 0, 0)
+    strokemap.decode_strokemap(data, 0, 0)
+    yield stop_measurement
+
+
 @nogui_test
 def brushengine_paint_hires():
     from lib import tiledsurface, brush
@@ -18,6 +18,7 @@ from lib.document import Document
 TEST_BIGIMAGE = "bigimage.ora"
 
 FakeAlloc = namedtuple("FakeAlloc", ["x", "y", "width", "height"])
+FakeApp = namedtuple("FakeApp", ["preferences"])
 
 
 class TiledDrawWidget (gui.tileddrawwidget.TiledDrawWidget):
@@ -41,6 +42,7 @@ def test_scroll(
     save_pngs=False,
     set_modes=None,
     use_background=True,
+    high_quality_zoom=False,
 ):
     """Test scroll performance
 
@@ -61,6 +63,12 @@ def test_scroll(
             assert model.layer_stack.deepget(path, None).mode == mode
     model.layer_stack.background_visible = use_background
     model.layer_stack._render_cache.clear()
+    app = tdw.app
+    if high_quality_zoom:
+        tdw.app = FakeApp(preferences={
+            "view.high_quality_zoom": True,
+            "view.real_alpha_checks": True,
+        })
 
     radius = min(width, height) * turn_radius
     alloc = FakeAlloc(0, 0, width, height)
@@ -97,6 +105,7 @@ def test_scroll(
                 surf.write_to_png(filename)
             nframes += 1
     dt = time.clock() - start
+    tdw.app = app
     for i in range(num_undos_needed):
         model.undo()
     if set_modes:
@@ -144,6 +153,21 @@ TESTS = [
         zoom=1.0,
         # No blank tiles visible onscreen at 100% zoom and above.
     )),
+    # High quality zoom at fractional scales, against the default
+    ("scroll_0.35x", test_scroll, dict(
+        zoom=0.35,
+    )),
+    ("scroll_0.35x_hq", test_scroll, dict(
+        zoom=0.35,
+        high_quality_zoom=True,
+    )),
+    ("scroll_0.7x", test_scroll, dict(
+        zoom=0.7,
+    )),
+    ("scroll_0.7x_hq", test_scroll, dict(
+        zoom=0.7,
+        high_quality_zoom=True,
+    )),
     ("scroll_2x", test_scroll, dict(
         zoom=2.0,
     )),